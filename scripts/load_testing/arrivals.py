@@ -0,0 +1,267 @@
+"""
+Open-loop scheduling of flow starts at a target arrival rate.
+
+With plain min_wait/max_wait think times every simulated user waits for
+its last flow to finish before starting the next one, so when the IdP
+slows down we send it less traffic and the latencies look better than
+they are (coordinated omission). In open-loop mode flows start on a
+fixed schedule of arrivals instead, whether or not earlier ones have
+finished, and each flow is timed from when it was *meant* to start.
+
+Rates are flows per second for this process, per task. Set them with:
+
+* ARRIVAL_RATE: a total rate, split across tasks by their @task weights.
+* ARRIVAL_RATES: per task overrides, e.g.
+  'idp_login_logout=5,idp_create_account=1'.
+* ARRIVAL_RATES_FILE: a JSON object of the same, re-read whenever it
+  changes, so rates can be turned up or down during a run. Its rates are
+  for the whole run: each of WORKER_COUNT processes runs its share.
+* ARRIVAL_PROCESS: 'poisson' (default) or 'fixed' intervals.
+
+Run enough clients (-c) that one is always free to pick up an arrival.
+When they are all busy, arrivals queue up and show as schedule lag in
+the flow transaction table (see transactions.py).
+"""
+import json
+import os
+import random
+import sys
+import time
+
+import gevent
+import locust
+
+import transactions
+
+
+class ArrivalClock(object):
+    """
+    Intended start times for one task at `rate` arrivals per second.
+    """
+
+    def __init__(self, rate, poisson=True, rng=random):
+        self.poisson = poisson
+        self._rng = rng
+        self.rate = 0
+        self.next = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate, now=None):
+        """
+        Changes the rate from now on. Arrivals that are already overdue
+        stay overdue rather than being forgiven.
+        """
+        now = time.time() if now is None else now
+        self.rate = rate
+        if rate <= 0:
+            self.next = None
+        elif self.next is None or self.next > now:
+            self.next = now + self._gap()
+
+    def tick(self):
+        """
+        Claims the next arrival and returns its intended start time.
+        """
+        intended = self.next
+        self.next += self._gap()
+        return intended
+
+    def _gap(self):
+        if self.poisson:
+            return self._rng.expovariate(self.rate)
+        return 1.0 / self.rate
+
+
+class OpenLoopSchedule(object):
+    """
+    Arrival clocks for every task, shared by all users in a process.
+    """
+
+    def __init__(self, rates, poisson=True, rates_file=None, tasks=None,
+                 share=1.0):
+        self.poisson = poisson
+        # This process's share of the rates in rates_file.
+        self.share = share
+        # The task names there are, if known, so rates can't be set for
+        # one that doesn't exist.
+        self.tasks = None if tasks is None else set(tasks)
+        self.clocks = {}
+        for name, rate in rates.items():
+            self.set_rate(name, rate)
+        self.rates_file = rates_file
+        self._rates_file_mtime = None
+        self._rates_file_checked = 0
+
+    def set_rate(self, name, rate):
+        if self.tasks is not None and name not in self.tasks:
+            raise ValueError('No task named {!r}, expected one of {}'.format(
+                name, ', '.join(sorted(self.tasks))
+            ))
+        if name in self.clocks:
+            self.clocks[name].set_rate(rate)
+        else:
+            self.clocks[name] = ArrivalClock(rate, self.poisson)
+
+    def claim(self):
+        """
+        The (task name, intended start) of the earliest pending arrival,
+        or None if every rate is zero.
+        """
+        self._reload_rates_file()
+        pending = [
+            (clock.next, name)
+            for name, clock in self.clocks.items()
+            if clock.next is not None
+        ]
+        if not pending:
+            return None
+        _, name = min(pending)
+        return name, self.clocks[name].tick()
+
+    def _reload_rates_file(self):
+        if not self.rates_file or time.time() - self._rates_file_checked < 1:
+            return
+        self._rates_file_checked = time.time()
+        try:
+            mtime = os.path.getmtime(self.rates_file)
+            if mtime == self._rates_file_mtime:
+                return
+            with open(self.rates_file) as f:
+                rates = json.load(f)
+        except (IOError, OSError, ValueError) as error:
+            sys.stderr.write('Could not read {}: {}\n'.format(
+                self.rates_file, error
+            ))
+            return
+        self._rates_file_mtime = mtime
+        for name, rate in rates.items():
+            try:
+                self.set_rate(name, float(rate) * self.share)
+            except ValueError as error:
+                sys.stderr.write('Ignoring {} in {}: {}\n'.format(
+                    name, self.rates_file, error
+                ))
+
+
+def parse_rates(spec):
+    """
+    'a=1,b=2.5' -> {'a': 1.0, 'b': 2.5}
+    """
+    rates = {}
+    for pair in spec.split(','):
+        if pair.strip():
+            name, rate = pair.split('=')
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def schedule_from_env(weights):
+    """
+    The OpenLoopSchedule the ARRIVAL_* settings describe for tasks with
+    the given {name: weight}, or None to stay closed-loop.
+    """
+    total = os.getenv('ARRIVAL_RATE')
+    overrides = os.getenv('ARRIVAL_RATES')
+    rates_file = os.getenv('ARRIVAL_RATES_FILE')
+    if not (total or overrides or rates_file):
+        return None
+
+    rates = dict.fromkeys(weights, 0.0)
+    if total:
+        weight_sum = float(sum(weights.values()))
+        for name, weight in weights.items():
+            rates[name] = float(total) * weight / weight_sum
+    if overrides:
+        rates.update(parse_rates(overrides))
+
+    return OpenLoopSchedule(
+        rates,
+        poisson=os.getenv('ARRIVAL_PROCESS', 'poisson') != 'fixed',
+        rates_file=rates_file,
+        tasks=weights,
+        share=1.0 / int(os.getenv('WORKER_COUNT', 1))
+    )
+
+
+def task_weights(tasks):
+    """
+    TaskSet.tasks repeats each task once per unit of weight.
+    """
+    weights = {}
+    for task in tasks:
+        weights[task.__name__] = weights.get(task.__name__, 0) + 1
+    return weights
+
+
+class OpenLoopTaskSet(locust.TaskSet):
+    """
+    A TaskSet that runs closed-loop as usual unless ARRIVAL_* is set,
+    in which case tasks start when the shared schedule says so.
+
+    Every task runs as a flow transaction named after it. In open-loop
+    mode that transaction is timed from the task's intended start, and
+    how late it actually started is its 'schedule lag' step.
+    """
+
+    _schedule = None
+    _configured = False
+    # Closed-loop think time in ms, as a callable, in place of
+    # min_wait/max_wait; set from a workload profile (workload.py).
+    think_time = None
+
+    def __init__(self, parent):
+        super(OpenLoopTaskSet, self).__init__(parent)
+        cls = type(self)
+        if not cls._configured:
+            cls._schedule = schedule_from_env(task_weights(self.tasks))
+            cls._configured = True
+        self._tasks_by_name = dict((t.__name__, t) for t in self.tasks)
+
+    @classmethod
+    def set_rate(cls, name, rate):
+        """
+        Changes a task's arrival rate for every user in this process.
+        """
+        if cls._schedule is None:
+            cls._schedule = OpenLoopSchedule(
+                {}, tasks=task_weights(cls.tasks)
+            )
+            cls._configured = True
+        cls._schedule.set_rate(name, rate)
+
+    def get_next_task(self):
+        if self._schedule is None:
+            task = super(OpenLoopTaskSet, self).get_next_task()
+
+            def closed_loop(taskset):
+                with transactions.Transaction(task.__name__):
+                    taskset.execute_task(task)
+            return closed_loop
+
+        slot = self._schedule.claim()
+        while slot is None:
+            gevent.sleep(1)
+            slot = self._schedule.claim()
+        name, intended = slot
+
+        delay = intended - time.time()
+        if delay > 0:
+            gevent.sleep(delay)
+
+        def arrival(taskset):
+            taskset._run_arrival(name, intended)
+        return arrival
+
+    def wait(self):
+        # The schedule is the only pacing in open-loop mode.
+        if self._schedule is not None:
+            return
+        if self.think_time is not None:
+            self._sleep(self.think_time() / 1000.0)
+        else:
+            super(OpenLoopTaskSet, self).wait()
+
+    def _run_arrival(self, name, intended):
+        with transactions.Transaction(name, start=intended) as transaction:
+            transaction.step('schedule lag', (time.time() - intended) * 1000)
+            self._tasks_by_name[name](self)
@@ -0,0 +1,354 @@
+"""
+Static assets fetched the way a browser would, with its HTTP cache.
+
+The flows only ask for pages, but a browser also asks for each page's
+stylesheets, scripts, icons and images, and for the fonts and images
+its stylesheets point to. Most of those come out of its cache: the
+fingerprinted files under /assets and /packs are fresh for a year, and
+the rest are revalidated with If-None-Match or If-Modified-Since and
+come back as a 304. Set ASSETS and every page a user gets (a 200 of
+text/html) has its assets fetched after it, ASSET_CONNECTIONS at a
+time, through a cache of the user's own that honours Cache-Control
+(no-store, no-cache, max-age), Expires and ETag/Last-Modified. How
+long that takes is the 'assets' step of the flow (see transactions.py).
+
+Each asset request is reported to locust as 'asset: <kind>', and each
+asset looked up as an entry of the 'assets' table: grouped by how the
+cache answered (fresh, revalidated, downloaded or failed), per kind.
+When the run ends, the requests and bytes assets added are printed
+against those of the pages alone.
+
+Settings:
+* ASSETS: fetch assets.
+* ASSET_CONNECTIONS: the most asset requests a user has in flight at
+  once (default 6, as browsers allow per host).
+* ASSET_CACHE: 'user' (default) keeps each user's cache for as long as
+  the user runs, as a returning visitor's browser would. 'journey'
+  empties it when a journey starts, as for a first visit every time.
+  'none' fetches everything every time.
+* ASSET_HOSTS: other hosts, comma separated, to fetch assets from, such
+  as a CDN. Only the host under test's are fetched otherwise.
+
+Usage:
+ASSETS=1 ASSET_CACHE=journey make load_test type=locustfile
+"""
+import os
+import re
+import sys
+import time
+from email.utils import mktime_tz, parsedate_tz
+from urllib.parse import urljoin, urlsplit
+
+import gevent.pool
+from gevent.lock import BoundedSemaphore
+import locust
+from locust import runners
+
+from extract import Page
+import results
+import transactions
+
+CACHES = ('user', 'journey', 'none')
+OUTCOMES = ('fresh', 'revalidated', 'downloaded', 'failed')
+
+CSS_URL = re.compile(br'url\(\s*[\'"]?([^\'")\s]+)[\'"]?\s*\)')
+CSS_IMPORT = re.compile(br'@import\s+[\'"]([^\'"]+)[\'"]')
+MAX_AGE = re.compile(r'\bmax-age\s*=\s*(\d+)')
+KINDS = {
+    'css': 'css', 'js': 'js',
+    'woff': 'font', 'woff2': 'font', 'ttf': 'font', 'otf': 'font',
+    'eot': 'font',
+    'png': 'image', 'jpg': 'image', 'jpeg': 'image', 'gif': 'image',
+    'svg': 'image', 'webp': 'image', 'ico': 'image',
+}
+
+asset_stats = results.table(
+    'assets', 'Static assets, by cache outcome (ms)', ('Outcome', 'Kind'),
+    nested=True
+)
+
+
+def record(outcome, kind, ms, failed=False):
+    asset_stats.record(outcome, results.TOTAL, ms, failed)
+    asset_stats.record(outcome, kind, ms, failed)
+
+
+def kind_of(url):
+    """
+    css, js, font or image, going by the extension, else other.
+    """
+    path = urlsplit(url).path
+    return KINDS.get(path.rsplit('.', 1)[-1].lower(), 'other')
+
+
+def css_refs(base_url, content):
+    """
+    (kind, url) of the fonts, images and stylesheets a stylesheet loads.
+    """
+    refs = []
+    for pattern in (CSS_IMPORT, CSS_URL):
+        for match in pattern.finditer(content):
+            ref = match.group(1).decode('utf-8', 'replace')
+            if ref.startswith(('data:', '#')):
+                continue
+            url = urljoin(base_url, ref)
+            refs.append((kind_of(url), url))
+    return refs
+
+
+def freshness(headers, now):
+    """
+    How long a response may be used without asking again, in seconds:
+    max-age, else Expires, else a tenth of how long ago it last changed,
+    as browsers guess. None if it mustn't be stored at all.
+    """
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    if 'no-store' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return 0
+    match = MAX_AGE.search(cache_control)
+    if match:
+        return int(match.group(1))
+    date = http_date(headers.get('Date')) or now
+    expires = headers.get('Expires')
+    if expires is not None:
+        # An invalid Expires, such as 0, means already expired.
+        return max(0, (http_date(expires) or date) - date)
+    last_modified = http_date(headers.get('Last-Modified'))
+    if last_modified is not None:
+        return max(0, (date - last_modified) / 10.0)
+    return 0
+
+
+def http_date(value):
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed else None
+
+
+class Entry(object):
+    """
+    What the cache knows about one URL. The body isn't kept, only what
+    it takes to revalidate it and, for a stylesheet, what it loads.
+    """
+
+    def __init__(self, etag, last_modified, fresh_until, refs):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fresh_until = fresh_until
+        self.refs = refs
+
+
+class AssetCache(object):
+    """
+    One user's browser cache, and the fetching that goes through it.
+    """
+
+    def __init__(self, request, base_url, hosts=(), connections=6,
+                 scope='user'):
+        if scope not in CACHES:
+            raise ValueError(
+                'Unknown ASSET_CACHE {!r}, expected one of {}'.format(
+                    scope, ', '.join(CACHES)
+                )
+            )
+        self.request = request
+        self.hosts = set(hosts) | {urlsplit(base_url).netloc}
+        self.connections = connections
+        self.scope = scope
+        self.entries = {}
+        # The journey the entries were cached in, for scope 'journey'.
+        self.journey = None
+
+    def load(self, page):
+        """
+        Fetches page's assets and what they load in turn, and returns
+        once they are all in.
+        """
+        if self.scope == 'journey':
+            journey = transactions.journey()
+            if journey is not self.journey:
+                self.entries = {}
+                self.journey = journey
+        # A stylesheet's fonts are queued as soon as it's in, so the
+        # group grows as it goes; only the requests wait for a slot.
+        group = gevent.pool.Group()
+        slots = BoundedSemaphore(self.connections)
+        seen = set()
+
+        def fetch(kind, url):
+            for ref in self.fetch(kind, url, slots):
+                queue(*ref)
+
+        def queue(kind, url):
+            url = urljoin(page.url, url).split('#')[0]
+            if url in seen or urlsplit(url).netloc not in self.hosts:
+                return
+            seen.add(url)
+            group.spawn(fetch, kind, url)
+
+        for kind, url in page.assets:
+            queue(kind, url)
+        group.join()
+
+    def fetch(self, kind, url, slots):
+        """
+        Gets one asset, from the cache if it's still fresh there, and
+        returns what it loads.
+        """
+        entry = self.entries.get(url)
+        if entry is not None and entry.fresh_until > time.time():
+            record('fresh', kind, 0)
+            return entry.refs
+        headers = {}
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+
+        with slots:
+            start = time.time()
+            resp = self.request(
+                'GET', url, name='asset: {}'.format(kind), headers=headers
+            )
+            ms = (time.time() - start) * 1000
+        if resp.status_code == 304 and entry is not None:
+            outcome = 'revalidated'
+        elif resp.status_code == 200:
+            outcome = 'downloaded'
+        else:
+            record('failed', kind, ms, True)
+            _load.add('assets', 0)
+            return []
+        _load.add('assets', len(resp.content or b''))
+        record(outcome, kind, ms)
+
+        if outcome == 'downloaded':
+            refs = css_refs(resp.url, resp.content) if kind == 'css' else []
+        else:
+            refs = entry.refs
+        now = time.time()
+        lifetime = freshness(resp.headers, now)
+        if lifetime is None or self.scope == 'none':
+            self.entries.pop(url, None)
+        else:
+            self.entries[url] = Entry(
+                resp.headers.get('ETag')
+                or (entry.etag if entry is not None else None),
+                resp.headers.get('Last-Modified')
+                or (entry.last_modified if entry is not None else None),
+                now + lifetime,
+                refs,
+            )
+        return refs
+
+
+class Load(object):
+    """
+    Requests and bytes received, for pages and for assets. Counts since
+    the last report to the master, or all of them in a local run; a
+    master adds up the workers' here.
+    """
+
+    def __init__(self):
+        self.counts = {'pages': [0, 0], 'assets': [0, 0]}
+
+    def add(self, what, received):
+        counts = self.counts[what]
+        counts[0] += 1
+        counts[1] += received
+
+    def serialize(self):
+        return self.counts
+
+    def merge(self, data):
+        for what, (requests, received) in data.items():
+            self.counts[what][0] += requests
+            self.counts[what][1] += received
+
+    def print_summary(self, out=sys.stdout):
+        pages, assets = self.counts['pages'], self.counts['assets']
+        if not pages[0]:
+            return
+        out.write('Load from assets, over pages alone\n')
+        out.write(' {:<10} {:>12} {:>14}\n'.format('', 'requests', 'KB'))
+        for label, (requests, received) in (
+            ('pages', pages), ('assets', assets),
+        ):
+            out.write(' {:<10} {:>12} {:>14.1f}\n'.format(
+                label, requests, received / 1024.0
+            ))
+        out.write(' {:<10} {:>12} {:>14}\n'.format(
+            'added',
+            '+{:.0%}'.format(assets[0] / float(pages[0])),
+            '+{:.0%}'.format(assets[1] / float(pages[1] or 1)),
+        ))
+        outcomes = [
+            (outcome, asset_stats.entries[(outcome, results.TOTAL)].count)
+            for outcome in OUTCOMES
+            if (outcome, results.TOTAL) in asset_stats.entries
+        ]
+        looked_up = float(sum(count for _, count in outcomes))
+        if looked_up:
+            out.write(' cache: {}\n'.format(', '.join(
+                '{} {:.1%}'.format(outcome, count / looked_up)
+                for outcome, count in outcomes
+            )))
+        out.write('\n')
+
+
+_load = Load()
+
+
+def fetch_with(client):
+    """
+    Has every page client gets load its assets, through a cache of the
+    user's own.
+    """
+    request = client.request
+    cache = AssetCache(
+        request,
+        client.base_url,
+        [host for host in os.getenv('ASSET_HOSTS', '').split(',') if host],
+        int(os.getenv('ASSET_CONNECTIONS', 6)),
+        os.getenv('ASSET_CACHE', 'user'),
+    )
+
+    def page_request(method, url, **kwargs):
+        resp = request(method, url, **kwargs)
+        if resp.status_code != 200:
+            _load.add('pages', 0)
+            return resp
+        _load.add('pages', len(resp.content or b''))
+        content_type = resp.headers.get('Content-Type') or ''
+        if content_type.startswith('text/html'):
+            start = time.time()
+            # Kept for the flow, see extract.resp_to_page.
+            resp.page = Page(resp.content, resp.url)
+            transactions.step('client parse', (time.time() - start) * 1000)
+            start = time.time()
+            cache.load(resp.page)
+            transactions.step('assets', (time.time() - start) * 1000)
+        return resp
+    client.request = page_request
+
+
+def on_report_to_master(client_id, data):
+    data['assets'] = _load.serialize()
+    _load.counts = Load().counts
+
+
+def on_slave_report(client_id, data):
+    if 'assets' in data:
+        _load.merge(data['assets'])
+
+
+def on_quitting():
+    if isinstance(runners.locust_runner, runners.SlaveLocustRunner):
+        return
+    _load.print_summary()
+
+
+locust.events.report_to_master += on_report_to_master
+locust.events.slave_report += on_slave_report
+locust.events.quitting += on_quitting
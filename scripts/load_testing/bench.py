@@ -0,0 +1,313 @@
+"""
+Benchmarks for the load test harness' own hot paths.
+
+Every helper that runs once per request or per signup (page parsing with
+extract.Page and the older pyquery helpers, phone number generation,
+made-up identities) is timed on the recorded pages in fixtures/ and
+reported as calls per CPU second, along with the memory one call needs
+at its peak and the memory left behind per call (tracemalloc).
+
+Raw speed depends on the box, so speeds are also stored relative to a
+fixed pure-Python reference loop measured in the same run. Baselines in
+bench_baselines.json are compared that way, and any helper that got
+more than --threshold slower, or needs that much more peak memory,
+is flagged and the run exits non-zero.
+
+Usage:
+python bench.py [--seconds 1.0] [--only extract/] [--threshold 0.25]
+python bench.py --save     # after an intended change, to update baselines
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+from extract import Page, authenticity_token, resp_to_dom
+from fasthttp import FastResponse
+import foney
+import identities
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, 'fixtures')
+BASELINES = os.path.join(HERE, 'bench_baselines.json')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name + '.html'), 'rb') as f:
+        return f.read()
+
+
+def response(name):
+    return FastResponse(
+        'GET', 'http://localhost:3000/' + name, 200, {}, fixture(name)
+    )
+
+
+token = authenticity_token
+
+# What each flow reads from each page, the pyquery way and the scan way.
+PAGES = {
+    'sign_in': (
+        lambda dom: token(dom),
+        lambda page: page.authenticity_token(),
+    ),
+    'login_two_factor_sms': (
+        lambda dom: (dom.find('#code').attr('value'), token(dom)),
+        lambda page: (page.code, page.authenticity_token()),
+    ),
+    'account': (
+        lambda dom: (
+            dom.find('a[href="/manage/password"]'),
+            dom.find('a[href="/api/saml/logout"]').attr('href'),
+        ),
+        lambda page: (
+            page.link('/manage/password', exact=True), page.sign_out_link
+        ),
+    ),
+    'manage_password': (
+        lambda dom: token(dom),
+        lambda page: page.authenticity_token(),
+    ),
+    'sign_up_enter_email': (
+        lambda dom: token(dom),
+        lambda page: page.authenticity_token(),
+    ),
+    'sign_up_verify_email': (
+        lambda dom: (
+            dom.find("a[href*='confirmation_token']")[0].attrib['href']
+        ),
+        lambda page: page.confirmation_link,
+    ),
+    'sign_up_enter_password': (
+        lambda dom: (
+            dom.find('[name="confirmation_token"]:first').attr('value'),
+            token(dom),
+        ),
+        lambda page: (page.confirmation_token, page.authenticity_token()),
+    ),
+    'phone_setup': (
+        lambda dom: token(dom, '#new_user_phone_form'),
+        lambda page: page.authenticity_token('#new_user_phone_form'),
+    ),
+    'sign_up_personal_key': (
+        lambda dom: (
+            dom.find('.my4.border-box.separator-text').text(),
+            token(dom, '#confirm-key'),
+        ),
+        lambda page: (
+            page.personal_key, page.authenticity_token('#confirm-key')
+        ),
+    ),
+}
+
+
+def cases():
+    """
+    name -> the function to time, built fresh so setup isn't timed.
+    """
+    suite = OrderedDict()
+    for name in sorted(PAGES):
+        old, new = PAGES[name]
+        resp = response(name)
+        dom = resp_to_dom(resp)
+        suite['extract/' + name] = (
+            lambda new=new, resp=resp: new(Page(resp.content, resp.url))
+        )
+        suite['pyquery/' + name] = (
+            lambda old=old, resp=resp: old(resp_to_dom(resp))
+        )
+        suite['authenticity_token/' + name] = lambda dom=dom: token(dom)
+
+    suite['foney/area_codes'] = foney.area_codes
+    suite['foney/prefixes'] = foney.prefixes
+    suite['foney/phone_numbers'] = foney.phone_numbers
+    numbers = foney.phone_numbers().unique()
+    suite['foney/next_unique'] = lambda: next(numbers)
+    suite['identities/make'] = identities.IdentityFactory(seed=0)
+    return suite
+
+
+def reference():
+    # A fixed, dependency-free mix of calls, string formatting and
+    # dict work to calibrate against.
+    d = {}
+    for i in range(200):
+        d['{}-{}'.format(i, i * 7)] = str(i).zfill(6)
+    return sorted(d.items())
+
+
+def ops_per_sec(fn, seconds):
+    """
+    Calls fn repeatedly for about `seconds` of CPU time
+    and returns how many calls per CPU second it managed.
+    """
+    calls = 0
+    batch = 1
+    start = time.process_time()
+    elapsed = 0.0
+    while elapsed < seconds:
+        for _ in range(batch):
+            fn()
+        calls += batch
+        batch *= 2
+        elapsed = time.process_time() - start
+    return calls / elapsed
+
+
+def measure(fn, seconds, repeat=5):
+    """
+    (best calls/sec, median calls/sec relative to reference()).
+
+    The reference loop is timed alongside fn in each of `repeat` rounds,
+    so a box that slows down part way through slows both. Anything else
+    running only ever makes a round slower, so like timeit, the best
+    round is the raw speed.
+    """
+    rounds = []
+    for _ in range(repeat):
+        reference_ops = ops_per_sec(reference, seconds / repeat / 2)
+        ops = ops_per_sec(fn, seconds / repeat)
+        rounds.append((ops, ops / reference_ops))
+    relative = sorted(r for _, r in rounds)[repeat // 2]
+    return max(ops for ops, _ in rounds), relative
+
+
+def memory(fn, calls=50):
+    """
+    (peak bytes one call needs, bytes left allocated per call).
+    """
+    fn()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        for _ in range(calls):
+            fn()
+        kept = (tracemalloc.get_traced_memory()[0] - base) / (calls + 1.0)
+    finally:
+        tracemalloc.stop()
+    return peak, kept
+
+
+def run(seconds, only=None):
+    """
+    {name: {'ops': calls/sec, 'relative': calls/sec vs reference(),
+    'peak': bytes, 'kept': bytes/call}}
+    """
+    results = OrderedDict()
+    for name, fn in cases().items():
+        if only and only not in name:
+            continue
+        ops, relative = measure(fn, seconds)
+        peak, kept = memory(fn)
+        results[name] = {
+            'ops': ops,
+            'relative': relative,
+            'peak': peak,
+            'kept': kept,
+        }
+    return results
+
+
+def load_baselines(path=BASELINES):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(results, path=BASELINES):
+    baselines = load_baselines(path)
+    for name, result in results.items():
+        baselines[name] = {
+            'relative': round(result['relative'], 6),
+            'peak': result['peak'],
+        }
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def regressions(result, baseline, threshold):
+    """
+    What got worse than the baseline by more than threshold, if anything.
+    """
+    found = []
+    if result['relative'] < baseline['relative'] * (1 - threshold):
+        found.append('{:.0%} slower'.format(
+            1 - result['relative'] / baseline['relative']
+        ))
+    # Small pages' peaks move by a few hundred bytes between runs.
+    if result['peak'] > baseline['peak'] * (1 + threshold) + 1024:
+        found.append('{:.0%} more peak memory'.format(
+            result['peak'] / float(baseline['peak'] or 1) - 1
+        ))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--seconds', type=float, default=1.0,
+                        help='CPU seconds to spend on each measurement')
+    parser.add_argument('--only', metavar='SUBSTRING',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction worse than baseline that counts as '
+                             'a regression')
+    parser.add_argument('--save', action='store_true',
+                        help='write these results as the new baselines')
+    args = parser.parse_args()
+
+    results = run(args.seconds, args.only)
+    baselines = load_baselines()
+
+    print('{:<40} {:>12} {:>10} {:>10} {:>10} {:>10}'.format(
+        'benchmark', 'calls/s', 'vs base', 'peak KiB', 'kept B', ''))
+    failed = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        change = ''
+        flags = []
+        if baseline:
+            change = '{:+.0%}'.format(
+                result['relative'] / baseline['relative'] - 1
+            )
+            flags = regressions(result, baseline, args.threshold)
+        print('{:<40} {:>12.0f} {:>10} {:>10.1f} {:>10.0f} {:>10}'.format(
+            name, result['ops'], change, result['peak'] / 1024.0,
+            result['kept'], 'REGRESSED' if flags else ''))
+        if flags:
+            failed.append((name, flags))
+
+    # A core that has to parse every page of the mix once spends the
+    # sum of the per-page costs, so combine as a harmonic mean.
+    pages = [n[len('extract/'):] for n in results if n.startswith('extract/')]
+    if pages and all('pyquery/' + p in results for p in pages):
+        before = len(pages) / sum(
+            1 / results['pyquery/' + p]['ops'] for p in pages
+        )
+        after = len(pages) / sum(
+            1 / results['extract/' + p]['ops'] for p in pages
+        )
+        print('\nAll pages: {:.0f} responses/s with pyquery, {:.0f} with '
+              'extract.Page ({:.1f}x).'.format(before, after, after / before))
+
+    if args.save:
+        save_baselines(results)
+        print('Saved baselines to {}.'.format(BASELINES))
+    elif failed:
+        print('\nRegressions beyond {:.0%}:'.format(args.threshold))
+        for name, flags in failed:
+            print('  {}: {}'.format(name, ', '.join(flags)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+"""
+Two archived runs compared endpoint by endpoint, with a regression gate.
+
+Run the same scenario before and after a release with STATS_ARCHIVE set
+(see results.py), then compare the two archives. For every entry of the
+'requests' and 'flows' tables that both runs have, this compares:
+
+* latency: the change in a percentile (p95 by default) with a bootstrap
+  confidence interval. Each resample draws every histogram bucket's
+  count from a Poisson distribution around it (the Poisson bootstrap),
+  so the cost depends on the number of buckets, not requests. A
+  two-sample Kolmogorov-Smirnov test on the full histograms must also
+  find the two distributions different.
+* throughput: the change in requests (or flows) per second over each
+  run, with a confidence interval for the ratio of two Poisson rates.
+* errors: the change in the share that failed, by a two-proportion test.
+
+Each entry gets a verdict. It is 'regressed' if any of the three got
+significantly worse by at least --min-change (latency and throughput,
+relative) or ERROR_FLOOR (errors, absolute). It is 'improved' if one got
+that much better and none got worse, and 'noise' otherwise. Entries with
+fewer than --min-count in either run are 'too few', and those missing
+from the candidate are 'missing'.
+
+Each --slo names the entries that gate a release, as a glob over the
+names printed (e.g. 'requests:POST /login/two_factor/sms' or
+'flows:login'). The exit status is 1 if any of them regressed or went
+missing, 2 if a --slo matches nothing, and 0 otherwise.
+
+Usage:
+python compare.py before.json after.json --slo 'flows:login' \
+    --slo 'requests:POST /login/two_factor/sms' [--metric p99]
+"""
+import argparse
+import fnmatch
+import math
+import random
+import sys
+
+import results
+
+METRICS = {'p50': 0.5, 'p90': 0.9, 'p95': 0.95, 'p99': 0.99, 'mean': None}
+TABLES = ('requests', 'flows')
+VERDICTS = ('regressed', 'improved', 'noise', 'too few', 'missing')
+# The smallest rise in the share of failures that counts, however
+# significant.
+ERROR_FLOOR = 0.001
+
+
+def histogram(distribution):
+    """
+    (values, counts) of a results distribution's non-empty buckets.
+    """
+    values, counts = [], []
+    for value, count in distribution.buckets():
+        values.append(value)
+        counts.append(count)
+    return values, counts
+
+
+def statistic(values, counts, quantile):
+    """
+    The quantile of a histogram, or its mean when quantile is None.
+    """
+    total = sum(counts)
+    if not total:
+        return 0.0
+    if quantile is None:
+        return sum(v * c for v, c in zip(values, counts)) / float(total)
+    wanted = max(int(total * quantile + 0.5), 1)
+    seen = 0
+    for value, count in zip(values, counts):
+        seen += count
+        if seen >= wanted:
+            return value
+    return values[-1]
+
+
+def poisson(rng, mean):
+    if mean > 30:
+        return max(0, int(round(rng.gauss(mean, math.sqrt(mean)))))
+    # Knuth's method, for the small counts of the tail buckets.
+    limit = math.exp(-mean)
+    k, product = 0, rng.random()
+    while product > limit:
+        k += 1
+        product *= rng.random()
+    return k
+
+
+def bootstrap(base, candidate, quantile, resamples, confidence, rng):
+    """
+    The relative change in the statistic from base to candidate, with
+    its confidence interval, as (change, low, high).
+    """
+    before = statistic(base[0], base[1], quantile)
+    after = statistic(candidate[0], candidate[1], quantile)
+    change = after / before - 1 if before else 0.0
+    changes = []
+    for _ in range(resamples):
+        resampled_before = statistic(
+            base[0], [poisson(rng, c) for c in base[1]], quantile
+        )
+        resampled_after = statistic(
+            candidate[0], [poisson(rng, c) for c in candidate[1]], quantile
+        )
+        if resampled_before:
+            changes.append(resampled_after / resampled_before - 1)
+    if not changes:
+        return change, change, change
+    changes.sort()
+    tail = (1 - confidence) / 2
+    return (
+        change,
+        changes[int(tail * (len(changes) - 1))],
+        changes[int((1 - tail) * (len(changes) - 1))],
+    )
+
+
+def ks_test(base, candidate):
+    """
+    (D, p) of a two-sample Kolmogorov-Smirnov test on two histograms,
+    with the asymptotic p-value.
+    """
+    n, m = float(sum(base[1])), float(sum(candidate[1]))
+    points = sorted(set(base[0]) | set(candidate[0]))
+    before = dict(zip(*base))
+    after = dict(zip(*candidate))
+    seen_before = seen_after = 0
+    d = 0.0
+    for value in points:
+        seen_before += before.get(value, 0)
+        seen_after += after.get(value, 0)
+        d = max(d, abs(seen_before / n - seen_after / m))
+    en = math.sqrt(n * m / (n + m))
+    return d, kolmogorov((en + 0.12 + 0.11 / en) * d)
+
+
+def kolmogorov(x):
+    """
+    The chance of a KS statistic this large, by the Kolmogorov
+    distribution's series.
+    """
+    if x < 0.2:
+        return 1.0
+    total = 0.0
+    for k in range(1, 101):
+        term = 2 * (-1) ** (k - 1) * math.exp(-2 * k * k * x * x)
+        total += term
+        if abs(term) < 1e-10:
+            break
+    return min(max(total, 0.0), 1.0)
+
+
+def z_value(confidence):
+    """
+    The two-sided normal critical value for a confidence level.
+    """
+    low, high = 0.0, 10.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if math.erfc(mid / math.sqrt(2)) > 1 - confidence:
+            low = mid
+        else:
+            high = mid
+    return low
+
+
+def rate_change(before, before_seconds, after, after_seconds, z):
+    """
+    The relative change in a rate of events, with its confidence
+    interval, from the normal approximation to the log of the ratio of
+    two Poisson counts.
+    """
+    if not before or not after:
+        return None
+    ratio = (after / after_seconds) / (before / before_seconds)
+    spread = z * math.sqrt(1.0 / before + 1.0 / after)
+    return (
+        ratio - 1, ratio * math.exp(-spread) - 1, ratio * math.exp(spread) - 1
+    )
+
+
+def proportion_z(failed_before, before, failed_after, after):
+    pooled = (failed_before + failed_after) / float(before + after)
+    spread = math.sqrt(pooled * (1 - pooled) * (1.0 / before + 1.0 / after))
+    if not spread:
+        return 0.0
+    change = failed_after / float(after) - failed_before / float(before)
+    return change / spread
+
+
+class Comparison(object):
+    """
+    One entry of one table, in both runs.
+    """
+
+    def __init__(self, key, base, candidate):
+        self.key = key
+        self.base = base
+        self.candidate = candidate
+        self.metric = None
+        self.latency = None
+        self.ks = None
+        self.throughput = None
+        self.errors = None
+        self.verdict = None
+        self.reasons = []
+
+    def judge(self, min_change, alpha, z):
+        worse, better = [], []
+        if self.latency is not None:
+            change, low, high = self.latency
+            different = self.ks[1] < alpha
+            if different and low > 0 and change >= min_change:
+                worse.append('latency')
+            elif different and high < 0 and change <= -min_change:
+                better.append('latency')
+        if self.throughput is not None:
+            change, low, high = self.throughput
+            if high < 0 and change <= -min_change:
+                worse.append('throughput')
+            elif low > 0 and change >= min_change:
+                better.append('throughput')
+        if self.errors is not None:
+            before, after, score = self.errors
+            if score > z and after - before >= ERROR_FLOOR:
+                worse.append('errors')
+            elif score < -z and before - after >= ERROR_FLOOR:
+                better.append('errors')
+        if worse:
+            self.verdict, self.reasons = 'regressed', worse
+        elif better:
+            self.verdict, self.reasons = 'improved', better
+        else:
+            self.verdict = 'noise'
+
+
+def entry_name(table, group, name):
+    label = '{} {}'.format(group, name).strip() if name != results.TOTAL \
+        else group
+    return '{}:{}'.format(table, label)
+
+
+def compare(base, candidate, tables=TABLES, metric='p95', resamples=1000,
+            confidence=0.95, min_change=0.05, min_count=30, seed=0):
+    """
+    A Comparison per entry of the named tables in the base archive (see
+    results.read_archive), in table order.
+    """
+    rng = random.Random(seed)
+    z = z_value(confidence)
+    alpha = 1 - confidence
+    base_seconds = base['ended'] - base['started']
+    candidate_seconds = candidate['ended'] - candidate['started']
+    found = []
+    for table in tables:
+        if table not in base['tables']:
+            continue
+        _, before_table = base['tables'][table]
+        after_table = candidate['tables'].get(table, (None, None))[1]
+        for group, name in before_table.keys():
+            before = before_table.entries[(group, name)]
+            after = None
+            if after_table is not None:
+                after = after_table.entries.get((group, name))
+            comparison = Comparison(
+                entry_name(table, group, name), before, after
+            )
+            found.append(comparison)
+            if after is None or not after.count:
+                comparison.verdict = 'missing'
+                continue
+            if before.count < min_count or after.count < min_count:
+                comparison.verdict = 'too few'
+                continue
+            before_histogram = histogram(before)
+            after_histogram = histogram(after)
+            comparison.metric = (
+                statistic(
+                    before_histogram[0], before_histogram[1], METRICS[metric]
+                ),
+                statistic(
+                    after_histogram[0], after_histogram[1], METRICS[metric]
+                ),
+            )
+            comparison.latency = bootstrap(
+                before_histogram, after_histogram, METRICS[metric],
+                resamples, confidence, rng
+            )
+            comparison.ks = ks_test(before_histogram, after_histogram)
+            comparison.throughput = rate_change(
+                before.count, base_seconds, after.count, candidate_seconds, z
+            )
+            comparison.errors = (
+                before.failures / float(before.count),
+                after.failures / float(after.count),
+                proportion_z(
+                    before.failures, before.count,
+                    after.failures, after.count
+                ),
+            )
+            comparison.judge(min_change, alpha, z)
+    return found
+
+
+def gate(comparisons, slos):
+    """
+    (exit status, [(slo, comparisons it failed on)]) for the --slo globs.
+    """
+    failed = []
+    status = 0
+    for slo in slos:
+        matched = [
+            c for c in comparisons if fnmatch.fnmatchcase(c.key, slo)
+        ]
+        if not matched:
+            failed.append((slo, []))
+            status = 2
+            continue
+        bad = [c for c in matched if c.verdict in ('regressed', 'missing')]
+        if bad:
+            failed.append((slo, bad))
+            status = status or 1
+    return status, failed
+
+
+def print_report(comparisons, metric, out=sys.stdout):
+    def interval(found):
+        if found is None:
+            return '-'
+        change, low, high = found
+        return '{:+.1%} [{:+.1%}, {:+.1%}]'.format(change, low, high)
+
+    out.write(' {:<50} {:>15} {:>27} {:>7} {:>27} {:>15}  {}\n'.format(
+        'Entry', metric + ' ms', metric + ' change', 'KS p', 'throughput',
+        'errors', 'verdict'
+    ))
+    for c in comparisons:
+        out.write(' {:<50} {:>15} {:>27} {:>7} {:>27} {:>15}  {}\n'.format(
+            c.key[:50],
+            '{:.1f} -> {:.1f}'.format(*c.metric) if c.metric else '-',
+            interval(c.latency),
+            '{:.3f}'.format(c.ks[1]) if c.ks else '-',
+            interval(c.throughput),
+            '{:.2%} -> {:.2%}'.format(*c.errors[:2]) if c.errors else '-',
+            c.verdict + (
+                ' ({})'.format(', '.join(c.reasons)) if c.reasons else ''
+            ),
+        ))
+    counts = dict((verdict, 0) for verdict in VERDICTS)
+    for c in comparisons:
+        counts[c.verdict] += 1
+    out.write('\n{}\n'.format(', '.join(
+        '{} {}'.format(counts[verdict], verdict)
+        for verdict in VERDICTS if counts[verdict]
+    )))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('base', help='the STATS_ARCHIVE of the run before')
+    parser.add_argument('candidate', help='and of the run after')
+    parser.add_argument('--table', action='append',
+                        help="tables to compare (default 'requests' and "
+                             "'flows')")
+    parser.add_argument('--metric', choices=sorted(METRICS), default='p95',
+                        help='the latency statistic to compare')
+    parser.add_argument('--slo', action='append', default=[],
+                        metavar='GLOB',
+                        help="entries that fail the comparison if they "
+                             "regress, e.g. 'flows:login'; repeatable")
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--resamples', type=int, default=1000,
+                        help='bootstrap resamples per entry')
+    parser.add_argument('--min-change', type=float, default=0.05,
+                        help='the smallest relative change that counts')
+    parser.add_argument('--min-count', type=int, default=30,
+                        help='fewer samples than this in either run are '
+                             'too few to judge')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    comparisons = compare(
+        results.read_archive(args.base),
+        results.read_archive(args.candidate),
+        args.table or TABLES,
+        args.metric,
+        args.resamples,
+        args.confidence,
+        args.min_change,
+        args.min_count,
+        args.seed,
+    )
+    print_report(comparisons, args.metric)
+    status, failed = gate(comparisons, args.slo)
+    for slo, bad in failed:
+        if not bad:
+            print('SLO {} matches no entry.'.format(slo))
+        for c in bad:
+            print('SLO {}: {} {}.'.format(slo, c.key, c.verdict))
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
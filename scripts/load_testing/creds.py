@@ -0,0 +1,178 @@
+"""
+Exclusive leases on the seeded test accounts.
+
+Given the rake task:
+rake dev:random_users NUM_USERS=1000 SCRYPT_COST='800$8$1$'
+
+We should have 1000 existing users with credentials matching:
+* email address testuser0@example.com through testuser999@example.com
+* the password "salty pickles"
+* a phone number between +1 (415) 555-0000 and +1 (415) 555-0999
+  (see phone()).
+
+Note that YOU MUST run the rake task to put these users in the DB first.
+
+Every simulated user leases one of those accounts for the length of a
+task, so no two tasks ever sign in as the same person at the same time.
+Leases are POSIX record locks on one byte range per account in a shared
+file, which makes them exclusive across every process on the host and
+frees them automatically if a process dies. The same byte range holds
+the account's current password, so a task that changes it leaves the
+next lease holder knowing what to sign in with.
+
+When running distributed, give each worker its own slice of the ID range
+with WORKER_INDEX and WORKER_COUNT so hosts never share an account.
+If you re-seed the database, delete LEASE_FILE so the recorded passwords
+go back to the default.
+"""
+import contextlib
+import errno
+import fcntl
+import os
+import random
+import tempfile
+import time
+
+DEFAULT_PASSWORD = 'salty pickles'
+
+# Bytes reserved per account for its current password.
+SLOT_SIZE = 64
+
+
+class NoCredentialsAvailable(Exception):
+    pass
+
+
+def worker_slice(num_users, index, count):
+    """
+    The (first, count) of the index-th of count contiguous slices
+    of the num_users seeded accounts.
+    """
+    if not 0 <= index < count:
+        raise ValueError(
+            'worker {} is out of range for {} workers'.format(index, count)
+        )
+    first = num_users * index // count
+    return first, num_users * (index + 1) // count - first
+
+
+def phone(user_id):
+    """
+    The phone number rake dev:random_users gave testuser{user_id}.
+    """
+    return '+1 (415) 555-{:04d}'.format(user_id)
+
+
+class CredentialLeases(object):
+    """
+    Hands out testuser{first}..testuser{first + count - 1} one at a time.
+    """
+
+    def __init__(self, first=0, count=1000, path=None):
+        if path is None:
+            path = os.path.join(
+                tempfile.gettempdir(), 'identity-idp-load-test-leases'
+            )
+        self.first = first
+        self.count = count
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        # Record locks belong to the process, so greenlets in this process
+        # also have to keep out of each other's way.
+        self._held = set()
+
+    @classmethod
+    def from_env(cls):
+        num_users = int(os.getenv('NUM_USERS', 1000))
+        first, count = worker_slice(
+            num_users,
+            int(os.getenv('WORKER_INDEX', 0)),
+            int(os.getenv('WORKER_COUNT', 1))
+        )
+        return cls(first, count, os.getenv('LEASE_FILE'))
+
+    def acquire(self, timeout=30, usable=None):
+        """
+        Leases a free account, waiting up to `timeout` seconds for one.
+        Returns the credentials dict login() expects, plus its 'id'.
+        usable(user_id) can pass over accounts that are free but
+        shouldn't be used yet, as pacing.py does.
+        """
+        deadline = time.time() + timeout
+        while True:
+            start = random.randrange(self.count)
+            for offset in range(self.count):
+                user_id = self.first + (start + offset) % self.count
+                if user_id in self._held or (
+                    usable is not None and not usable(user_id)
+                ):
+                    continue
+                if self._lock(user_id):
+                    self._held.add(user_id)
+                    return {
+                        'id': user_id,
+                        'email': 'testuser{}@example.com'.format(user_id),
+                        'password': self._read_password(user_id),
+                    }
+            if time.time() >= deadline:
+                raise NoCredentialsAvailable(
+                    'All {} accounts from testuser{} are leased. '
+                    'Seed more users or run fewer clients.'.format(
+                        self.count, self.first
+                    )
+                )
+            time.sleep(0.05)
+
+    def release(self, credentials):
+        user_id = credentials['id']
+        fcntl.lockf(
+            self._fd, fcntl.LOCK_UN, SLOT_SIZE, user_id * SLOT_SIZE
+        )
+        self._held.discard(user_id)
+
+    @contextlib.contextmanager
+    def lease(self, timeout=30):
+        credentials = self.acquire(timeout)
+        try:
+            yield credentials
+        finally:
+            self.release(credentials)
+
+    def set_password(self, credentials, password):
+        """
+        Records that a leased account's password is now `password`.
+        """
+        encoded = password.encode('utf-8')
+        if len(encoded) >= SLOT_SIZE:
+            raise ValueError('Passwords must be under {} bytes'.format(
+                SLOT_SIZE
+            ))
+        if credentials['id'] not in self._held:
+            raise ValueError('testuser{} is not leased by this process'.format(
+                credentials['id']
+            ))
+        os.pwrite(
+            self._fd,
+            encoded.ljust(SLOT_SIZE, b'\0'),
+            credentials['id'] * SLOT_SIZE
+        )
+        credentials['password'] = password
+
+    def _lock(self, user_id):
+        try:
+            fcntl.lockf(
+                self._fd,
+                fcntl.LOCK_EX | fcntl.LOCK_NB,
+                SLOT_SIZE,
+                user_id * SLOT_SIZE
+            )
+        except (IOError, OSError) as error:
+            if error.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+        return True
+
+    def _read_password(self, user_id):
+        slot = os.pread(self._fd, SLOT_SIZE, user_id * SLOT_SIZE)
+        password = slot.rstrip(b'\0')
+        return password.decode('utf-8') if password else DEFAULT_PASSWORD
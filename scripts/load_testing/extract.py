@@ -0,0 +1,267 @@
+"""
+Single-pass field extraction for the pages the load test flows scrape.
+
+Each step of login(), signup(), change_pass() and logout() only needs one
+or two values from the page it gets back: a CSRF token, the prefilled
+OTP code, a confirmation link and so on. Building a full lxml tree for
+that costs more CPU than the HTTP request itself, so Page walks the raw
+response bytes once with precompiled patterns and keeps only those
+fields. Anything the scan doesn't cover falls back to pyquery through
+Page.dom, which is only built the first time it is asked for.
+"""
+from html import unescape
+import re
+import time
+
+import pyquery
+
+import transactions
+
+# Only the tags that carry fields we care about. Everything else on the
+# page is skipped by the regex engine without being looked at. Rails
+# always renders tag names in lower case.
+TAG = re.compile(br'<(/?)(form|input|a|div)\b([^>]*)>')
+# A pass of its own, so that pages whose assets nobody wants don't pay
+# for the many tags in their <head>.
+ASSET_TAG = re.compile(br'<(link|script|img)\b([^>]*)>')
+ATTRIBUTE = re.compile(
+    br'([^\s=/>]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))'
+)
+# Inputs and links are by far the most common tags we stop at, and only
+# ever need one or two attributes, so they get their own patterns.
+NAME = re.compile(br'\bname\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+VALUE = re.compile(br'\bvalue\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+HREF = re.compile(br'\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+SRC = re.compile(br'\bsrc\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+# What <link rel="preload" as="..."> fetches, by asset kind.
+PRELOAD_KINDS = {
+    'style': 'css', 'script': 'js', 'font': 'font', 'image': 'image',
+}
+PERSONAL_KEY_WORD = re.compile(
+    br'data-personal-key=["\']word["\'][^>]*>\s*([^<\s]+)'
+)
+
+
+def text(value):
+    value = value.decode('utf-8', 'replace')
+    if '&' in value:
+        value = unescape(value)
+    return value
+
+
+def attributes(raw):
+    """
+    Parses the attribute bytes of one tag into a dict of str.
+    """
+    attrs = {}
+    for name, double, single, bare in ATTRIBUTE.findall(raw):
+        attrs[name.lower().decode('ascii', 'replace')] = text(
+            double or single or bare
+        )
+    return attrs
+
+
+def attribute(pattern, raw):
+    """
+    The value of the single attribute `pattern` looks for, or None.
+    """
+    match = pattern.search(raw)
+    if match is None:
+        return None
+    double, single = match.groups()
+    # value="" is a value too, not a miss.
+    return text(double if double is not None else single)
+
+
+def asset(tag, raw):
+    """
+    (kind, url) of what a browser would fetch for a link, script or img
+    tag, or None.
+    """
+    if tag == b'img':
+        url = attribute(SRC, raw)
+        return ('image', url) if url else None
+    if tag == b'script':
+        url = attribute(SRC, raw)
+        return ('js', url) if url else None
+    attrs = attributes(raw)
+    rel = attrs.get('rel', '').lower().split()
+    if 'stylesheet' in rel:
+        kind = 'css'
+    elif 'icon' in rel:
+        # Not apple-touch-icon or mask-icon, which only some devices get.
+        kind = 'image'
+    elif 'preload' in rel:
+        kind = PRELOAD_KINDS.get(attrs.get('as'))
+    else:
+        return None
+    url = attrs.get('href')
+    return (kind, url) if kind and url else None
+
+
+class Page(object):
+    """
+    The fields of one response that the flows read, from a single scan.
+
+    * tokens: authenticity_token values by the id of their form. The
+      first token on the page is also stored under None.
+    * inputs: the value of the first input with each name.
+    * links: every anchor href, in page order.
+    * forms: every form action, in page order.
+    * personal_key: the words of the personal key block, space separated.
+    * assets: (kind, url) of the stylesheets, scripts, icons and images
+      a browser would fetch for the page, in page order. Found on first
+      use, by a pass of their own (see ASSET_TAG).
+    """
+
+    def __init__(self, content, url=None):
+        self.content = content
+        self.url = url
+        self.tokens = {}
+        self.inputs = {}
+        self.links = []
+        self.forms = []
+        self.personal_key = None
+        self._assets = None
+        self._dom = None
+        self._scan()
+
+    def _scan(self):
+        form_id = None
+        key_start = None
+
+        for match in TAG.finditer(self.content):
+            closing, tag, raw = match.groups()
+
+            if tag == b'div':
+                if key_start is None and b'separator-text' in raw:
+                    key_start = match.end()
+                continue
+            if tag == b'form':
+                if closing:
+                    form_id = None
+                else:
+                    attrs = attributes(raw)
+                    form_id = attrs.get('id')
+                    self.forms.append(attrs.get('action'))
+                continue
+            if closing:
+                continue
+
+            if tag == b'a':
+                href = attribute(HREF, raw)
+                if href is not None:
+                    self.links.append(href)
+                continue
+
+            name = attribute(NAME, raw)
+            if name is None:
+                continue
+            value = attribute(VALUE, raw)
+            if name == 'authenticity_token':
+                self.tokens.setdefault(None, value)
+                if form_id is not None:
+                    self.tokens.setdefault(form_id, value)
+            self.inputs.setdefault(name, value)
+
+        if key_start is not None:
+            words = PERSONAL_KEY_WORD.findall(self.content, key_start)
+            self.personal_key = ' '.join(w.decode('ascii') for w in words)
+
+    def authenticity_token(self, form_id=None):
+        """
+        The first CSRF token on the page, or the one inside the form with
+        the given id ('#new_user_phone_form' and 'new_user_phone_form'
+        both work).
+        """
+        if form_id:
+            form_id = form_id.lstrip('#')
+        return self.tokens.get(form_id)
+
+    @property
+    def code(self):
+        """
+        The prefilled OTP code (#code) on 2FA pages in load testing mode.
+        """
+        return self.inputs.get('code')
+
+    @property
+    def confirmation_token(self):
+        return self.inputs.get('confirmation_token')
+
+    @property
+    def confirmation_link(self):
+        return self.link('confirmation_token')
+
+    @property
+    def sign_out_link(self):
+        return self.link('/api/saml/logout', exact=True)
+
+    def link(self, href, exact=False):
+        """
+        The first link whose href is, or contains, the given string.
+        """
+        for link in self.links:
+            if link == href or (not exact and href in link):
+                return link
+        return None
+
+    @property
+    def assets(self):
+        if self._assets is None:
+            self._assets = [
+                found for found in (
+                    asset(*match.groups())
+                    for match in ASSET_TAG.finditer(self.content)
+                ) if found is not None
+            ]
+        return self._assets
+
+    @property
+    def dom(self):
+        """
+        The full pyquery document, for anything the scan doesn't cover.
+        """
+        if self._dom is None:
+            self._dom = pyquery.PyQuery(self.content)
+        return self._dom
+
+    def find(self, selector):
+        return self.dom.find(selector)
+
+
+def authenticity_token(dom, id=None):
+    """
+    Retrieves the CSRF auth token from the DOM for submission.
+    If you need to differentiate between multiple CSRF tokens on one page,
+    pass the optional ID of the parent form (with hash)
+    """
+    selector = 'input[name="authenticity_token"]:first'
+
+    if id:
+        selector = '{} {}'.format(id, selector)
+    return dom.find(selector).attr('value')
+
+
+def resp_to_dom(resp):
+    """
+    Little helper to check response status is 200
+    and return the DOM, cause we do that a lot.
+    """
+    resp.raise_for_status()
+    return pyquery.PyQuery(resp.content)
+
+
+def resp_to_page(resp):
+    """
+    Like resp_to_dom, but returns a scanned Page instead of a DOM.
+    The scan counts towards the current flow's client parse time, once:
+    the page is kept on resp, e.g. for assets.py to share.
+    """
+    resp.raise_for_status()
+    page = getattr(resp, 'page', None)
+    if page is None:
+        start = time.time()
+        page = resp.page = Page(resp.content, resp.url)
+        transactions.step('client parse', (time.time() - start) * 1000)
+    return page
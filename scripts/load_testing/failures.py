@@ -0,0 +1,278 @@
+"""
+Failures counted by signature, with a few of their pages kept on disk.
+
+A failure message with a page or its headers formatted into it is a new
+error every time, and locust keeps every distinct error (and the
+exception, response and all) until the run ends. So when things go
+wrong at thousands of users, memory grows with every failure. Here each
+failure is reduced to a signature: the method, the endpoint, the status
+and the message with numbers, ids, emails and query strings taken out,
+plus the flash or form error the page showed. Locust's failures table is
+keyed by that instead, and only a count is kept per signature.
+
+For each signature a random sample of FAILURE_SAMPLES pages (reservoir
+sampling, so early and late failures are equally likely to be kept) is
+written to FAILURE_DIR, one directory per signature with the signature
+itself in signature.txt. The most common signatures are printed when the
+run ends.
+
+Settings:
+* FAILURE_DIR: where to write the sampled pages (default 'failures').
+  Workers of a distributed run each write their own, with their
+  WORKER_INDEX appended.
+* FAILURE_SAMPLES: pages to keep per signature (default 5, 0 for none).
+* FAILURE_SIGNATURES: the most signatures to tell apart (default 1000).
+  Past that, new ones are counted per endpoint and status as '(other)'.
+
+Flows report a failure with report(resp, message) rather than putting
+the page in the message.
+"""
+from collections import namedtuple
+from html import unescape
+import hashlib
+import os
+import random
+import re
+import sys
+import time
+from urllib.parse import urlsplit
+
+import locust
+from locust import runners
+from locust.stats import StatsError, global_stats
+
+from timeseries import worker_path
+
+MAX_TEXT = 160
+OTHER = '(other)'
+
+# Flash messages and simple_form's error notification are both alerts.
+ALERT = re.compile(
+    br'<div class="alert alert-[\w-]+"[^>]*>(.*?)</div>', re.DOTALL
+)
+TAG = re.compile(r'<[^>]*>')
+URL = re.compile(r'\b(?:https?://[^/\s]+)?(/[^\s?#"\'<>]*)[?#][^\s"\'<>]*')
+HOST = re.compile(r'\bhttps?://[^/\s]+')
+EMAIL = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+ID = re.compile(
+    r'\b(?:[0-9a-f]{8}-(?:[0-9a-f]{4}-){3}[0-9a-f]{12}|[0-9a-f]{16,})\b',
+    re.IGNORECASE
+)
+NUMBER = re.compile(r'\b\d+\b')
+SPACE = re.compile(r'\s+')
+
+Signature = namedtuple('Signature', 'method name status text')
+
+
+class Failure(Exception):
+    """
+    A failed check on a response. Only the message is part of what
+    locust sees; the response is kept for sampling.
+    """
+
+    def __init__(self, message, response=None):
+        super(Failure, self).__init__(message)
+        self.response = response
+
+
+def normalize(text):
+    """
+    text with what varies between otherwise identical failures (query
+    strings, hosts, emails, ids and numbers) replaced, and whitespace
+    collapsed.
+    """
+    text = URL.sub(r'\1?...', text)
+    text = HOST.sub('', text)
+    text = EMAIL.sub('<email>', text)
+    text = ID.sub('<id>', text)
+    text = NUMBER.sub('N', text)
+    return SPACE.sub(' ', text).strip()
+
+
+def flash(content):
+    """
+    The text of the first alert on a page, if it has one.
+    """
+    if not content:
+        return None
+    match = ALERT.search(content)
+    if match is None:
+        return None
+    return unescape(TAG.sub(' ', match.group(1).decode('utf-8', 'replace')))
+
+
+def describe(exception):
+    if isinstance(exception, Failure):
+        return str(exception)
+    # requests' HTTPError and the like.
+    return '{}: {}'.format(type(exception).__name__, exception)
+
+
+def signature(method, name, exception):
+    response = getattr(exception, 'response', None)
+    text = normalize(describe(exception))
+    alert = flash(getattr(response, 'content', None))
+    if alert:
+        text = '{} [{}]'.format(text, normalize(alert))
+    if len(text) > MAX_TEXT:
+        text = text[:MAX_TEXT - 3] + '...'
+    return Signature(
+        method, name, getattr(response, 'status_code', None) or 0, text
+    )
+
+
+def digest(sig):
+    return hashlib.md5(repr(tuple(sig)).encode('utf-8')).hexdigest()[:12]
+
+
+class FailureLog(object):
+    """
+    Counts per signature, and a reservoir of pages per signature on disk.
+    """
+
+    def __init__(self, directory, samples=5, max_signatures=1000):
+        self.directory = directory
+        self.samples = samples
+        self.max_signatures = max_signatures
+        # Every failure this process has seen, for sampling.
+        self.seen = {}
+        # Failures since the last report to the master, or all of them
+        # in a local run; a master adds up the workers' here.
+        self.counts = {}
+
+    def record(self, method, name, exception):
+        sig = signature(method, name, exception)
+        if sig not in self.seen and len(self.seen) >= self.max_signatures:
+            sig = sig._replace(text=OTHER)
+        seen = self.seen[sig] = self.seen.get(sig, 0) + 1
+        self.add(sig, 1)
+        if self.samples:
+            slot = seen - 1 if seen <= self.samples else random.randrange(seen)
+            if slot < self.samples:
+                self.sample(sig, slot, exception)
+        return sig
+
+    def add(self, sig, count):
+        self.counts[sig] = self.counts.get(sig, 0) + count
+
+    def path(self, sig):
+        return os.path.join(self.directory, digest(sig))
+
+    def sample(self, sig, slot, exception):
+        path = self.path(sig)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+            with open(os.path.join(path, 'signature.txt'), 'w') as f:
+                f.write('{} {} {}\n{}\n'.format(*sig))
+        response = getattr(exception, 'response', None)
+        with open(os.path.join(path, '{}.html'.format(slot)), 'wb') as f:
+            f.write('<!-- {} {} at {}: {} -->\n'.format(
+                sig.method,
+                getattr(response, 'url', sig.name),
+                time.strftime('%Y-%m-%d %H:%M:%S'),
+                describe(exception).replace('--', '- -'),
+            ).encode('utf-8'))
+            f.write(getattr(response, 'content', None) or b'')
+
+    def serialize(self):
+        return [list(sig) + [count] for sig, count in self.counts.items()]
+
+    def merge(self, data):
+        for entry in data:
+            self.add(Signature(*entry[:4]), entry[4])
+
+    def print_table(self, top=20, out=sys.stdout):
+        if not self.counts:
+            return
+        ranked = sorted(self.counts.items(), key=lambda item: -item[1])
+        out.write('Failures by signature ({} of {}, samples in {})\n'.format(
+            min(top, len(ranked)), len(ranked), self.directory
+        ))
+        out.write(' {:>8} {:<7} {:<40} {:>6}  {}\n'.format(
+            'count', 'method', 'name', 'status', 'signature'
+        ))
+        for sig, count in ranked[:top]:
+            out.write(' {:>8} {:<7} {:<40} {:>6}  {}\n'.format(
+                count, sig.method, sig.name[:40], sig.status, sig.text
+            ))
+        out.write('\n')
+
+
+def report(resp, message, name=None):
+    """
+    Fails resp with message, keeping the page for sampling. A response
+    from catch_response=True is failed as usual. Any other has already
+    been counted, so the failure is counted alongside it, as verify.py
+    does for its steps.
+    """
+    exception = Failure(message, resp)
+    if hasattr(resp, 'locust_request_meta') and not resp._is_reported:
+        resp.failure(exception)
+        return
+    meta = getattr(resp, 'locust_request_meta', None)
+    if meta is None:
+        method = getattr(resp, 'method', None) or resp.request.method
+        elapsed = getattr(resp, 'elapsed', None)
+        meta = {
+            'method': method,
+            # Where the check failed, after any redirects.
+            'name': urlsplit(resp.url).path,
+            'response_time': int(elapsed.total_seconds() * 1000)
+            if elapsed else 0,
+        }
+    locust.events.request_failure.fire(
+        request_type=meta['method'],
+        name=name or meta['name'],
+        response_time=meta['response_time'],
+        exception=exception,
+    )
+
+
+_log = None
+
+
+def log():
+    global _log
+    if _log is None:
+        _log = FailureLog(
+            worker_path(os.getenv('FAILURE_DIR', 'failures')),
+            int(os.getenv('FAILURE_SAMPLES', 5)),
+            int(os.getenv('FAILURE_SIGNATURES', 1000)),
+        )
+    return _log
+
+
+def on_request_failure(request_type, name, response_time, exception):
+    sig = log().record(request_type, name, exception)
+    # Locust has just filed the exception under its repr; file it under
+    # the signature instead, which also lets go of the response.
+    key = StatsError.create_key(request_type, name, exception)
+    entry = global_stats.errors.pop(key, None)
+    if entry is None:
+        return
+    text = '{} {}'.format(sig.status, sig.text) if sig.status else sig.text
+    key = StatsError.create_key(request_type, name, text)
+    if key not in global_stats.errors:
+        global_stats.errors[key] = StatsError(request_type, name, text)
+    global_stats.errors[key].occurences += entry.occurences
+
+
+def on_report_to_master(client_id, data):
+    data['failures'] = log().serialize()
+    log().counts = {}
+
+
+def on_slave_report(client_id, data):
+    log().merge(data.get('failures', ()))
+
+
+def on_quitting():
+    if isinstance(runners.locust_runner, runners.SlaveLocustRunner):
+        return
+    log().print_table()
+
+
+locust.events.request_failure += on_request_failure
+locust.events.report_to_master += on_report_to_master
+locust.events.slave_report += on_slave_report
+locust.events.quitting += on_quitting
@@ -0,0 +1,538 @@
+"""
+A non-blocking HTTP engine for running the same flows with many more users.
+
+locust.HttpLocust gives every simulated user a requests.Session, which
+costs a lot of CPU per request and keeps its own idle connections open,
+so one process runs out of steam at a few hundred users. Set
+HTTP_ENGINE=fast and the locustfile's users get a FastHttpSession
+instead. It understands the same subset of the requests API that the
+flows use (get/post with data, auth, name and catch_response, and
+responses with url, status_code, content, raise_for_status, success and
+failure), so login(), logout(), signup() and change_pass() don't change.
+
+* Requests go out over geventhttpclient, on keep-alive connections from
+  one pool per host that every user in the process shares. Its size is
+  FAST_HTTP_POOL_SIZE (default 100); idle users hold no connections, so
+  tens of thousands of open sessions fit in one process.
+* Each user keeps its own cookies, so sessions stay separate.
+* Every request fires locust's request_success/request_failure events
+  just as HttpSession does, and every redirect hop is a step of the
+  flow it happened in (see transactions.py).
+* Each exchange on the wire (a request, or one hop of its redirects) is
+  broken down into phases in the 'phases' table: waiting for a pooled
+  connection, then for a new connection its DNS lookup, TCP connect and
+  TLS handshake, then time to first byte and the body download. When the
+  run ends, how often each request got a new connection rather than
+  reusing one is printed too. FAST_HTTP_KEEPALIVE=0 closes every
+  connection after one exchange, to measure what reuse is worth.
+"""
+import base64
+import json
+import os
+import re
+import sys
+import time
+from email.utils import parsedate_tz, mktime_tz
+from urllib.parse import urlencode, urljoin, urlsplit
+
+import gevent
+from geventhttpclient import HTTPClient
+from geventhttpclient.response import HTTPParseError
+import locust
+from locust import runners
+from locust.exception import CatchResponseError, LocustError, ResponseError
+from requests.exceptions import (
+    ConnectionError, HTTPError, RequestException, TooManyRedirects
+)
+
+import results
+import transactions
+
+POOL_SIZE = int(os.getenv('FAST_HTTP_POOL_SIZE', 100))
+KEEPALIVE = os.getenv('FAST_HTTP_KEEPALIVE', '1') != '0'
+TIMEOUT = 60
+MAX_REDIRECTS = 30
+
+ABSOLUTE_URL = re.compile(r'^https?://', re.I)
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+PHASES = ('pool wait', 'dns', 'connect', 'tls', 'ttfb', 'body')
+# Only exchanges that opened a connection have these.
+CONNECTION_PHASES = ('dns', 'connect', 'tls')
+
+phase_stats = results.table(
+    'phases', 'Request phases, per exchange (ms)', ('Phase', 'Request'),
+    nested=True
+)
+
+# (scheme, host, port) -> HTTPClient, shared by every user in the process.
+_clients = {}
+# The Timing of the exchange each greenlet is in the middle of.
+_timings = {}
+
+
+class Timing(object):
+    """
+    Where one exchange's time went, in ms by phase.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.socket_at = None
+
+    def add(self, phase, ms):
+        self.phases[phase] = self.phases.get(phase, 0) + ms
+
+    def get(self, *phases):
+        return sum(self.phases.get(phase, 0) for phase in phases)
+
+
+def timed(fn, phase):
+    """
+    fn, adding the time each call takes to the current exchange's phase.
+    """
+    def wrapped(*args, **kwargs):
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timing = _timings.get(gevent.getcurrent())
+            if timing is not None:
+                timing.add(phase, (time.time() - start) * 1000)
+    return wrapped
+
+
+def instrument(pool):
+    """
+    Times the pool's DNS lookups, connects and TLS handshakes, and the
+    wait for a connection, into the current exchange's Timing.
+
+    The TLS handshake can only be told apart from the connect where the
+    pool wraps sockets with its own ssl_context; otherwise it counts as
+    part of the connect.
+    """
+    create_socket = pool._create_socket
+    get_socket = pool.get_socket
+    pool._resolve = timed(pool._resolve, 'dns')
+    context = getattr(pool, 'ssl_context', None)
+    if context is not None:
+        context.wrap_socket = timed(context.wrap_socket, 'tls')
+
+    def timed_create_socket():
+        timing = _timings.get(gevent.getcurrent())
+        start = time.time()
+        before = timing.get('dns', 'tls') if timing else 0
+        try:
+            return create_socket()
+        finally:
+            if timing is not None:
+                timing.add('connect', (time.time() - start) * 1000 - (
+                    timing.get('dns', 'tls') - before
+                ))
+
+    def timed_get_socket():
+        timing = _timings.get(gevent.getcurrent())
+        start = time.time()
+        before = timing.get(*CONNECTION_PHASES) if timing else 0
+        sock = get_socket()
+        if timing is not None:
+            timing.socket_at = time.time()
+            timing.add('pool wait', (timing.socket_at - start) * 1000 - (
+                timing.get(*CONNECTION_PHASES) - before
+            ))
+        return sock
+
+    pool._create_socket = timed_create_socket
+    pool.get_socket = timed_get_socket
+
+
+def client_for(scheme, host, port):
+    key = (scheme, host, port)
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = HTTPClient(
+            host,
+            port,
+            ssl=scheme == 'https',
+            concurrency=POOL_SIZE,
+            connection_timeout=TIMEOUT,
+            network_timeout=TIMEOUT,
+        )
+        instrument(client._connection_pool)
+    return client
+
+
+def record_phases(request, timings, failed):
+    for timing in timings:
+        for phase in PHASES:
+            if phase in timing.phases:
+                # Differences of clock readings can come out a hair
+                # below zero.
+                ms = max(timing.phases[phase], 0)
+                phase_stats.record(phase, results.TOTAL, ms, failed)
+                phase_stats.record(phase, request, ms, failed)
+
+
+def print_connections(out=sys.stdout):
+    """
+    Per request, how many exchanges needed a new connection and the
+    average of each phase. Connection phases are averaged over the
+    exchanges that opened one.
+    """
+    entries = phase_stats.entries
+    requests = [
+        name for phase, name in phase_stats.keys()
+        if phase == 'pool wait' and name != results.TOTAL
+    ]
+    if not requests:
+        return
+    out.write('Connections ({}, pool of {} per host)\n'.format(
+        'keep-alive' if KEEPALIVE else 'no keep-alive', POOL_SIZE
+    ))
+    out.write((' {:<44} {:>9} {:>8} {:>8}' + ' {:>9}' * len(PHASES) + '\n')
+              .format('Request', 'exchanges', 'new', 'reused', *PHASES))
+    row_format = ' {:<44} {:>9} {:>8} {:>8.1%}' + ' {:>9.1f}' * len(PHASES)
+    for request in [results.TOTAL] + requests:
+        used = entries[('pool wait', request)].count
+        new = entries.get(('connect', request))
+        new = new.count if new is not None else 0
+        out.write((row_format + '\n').format(
+            request or '(total)', used, new, 1 - new / float(used), *(
+                entries[(phase, request)].avg
+                if (phase, request) in entries else 0
+                for phase in PHASES
+            )
+        ))
+    out.write('\n')
+
+
+def header_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+class CookieJar(object):
+    """
+    One user's cookies, by host.
+
+    Paths and domains are ignored, which is all a single IdP host needs;
+    expiry is only used to notice a cookie being deleted.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+
+    def header(self, host):
+        cookies = self.hosts.get(host)
+        if not cookies:
+            return None
+        return '; '.join(
+            '{}={}'.format(name, value) for name, value in cookies.items()
+        )
+
+    def update(self, host, set_cookie_headers):
+        for header in set_cookie_headers:
+            pair, _, attributes = header.partition(';')
+            name, _, value = pair.partition('=')
+            name = name.strip()
+            if not name:
+                continue
+            cookies = self.hosts.setdefault(host, {})
+            if self._expired(attributes):
+                cookies.pop(name, None)
+            else:
+                cookies[name] = value.strip()
+
+    def clear(self):
+        self.hosts.clear()
+
+    @staticmethod
+    def _expired(attributes):
+        expires = None
+        for attribute in attributes.split(';'):
+            key, _, value = attribute.partition('=')
+            key = key.strip().lower()
+            if key == 'max-age':
+                # Max-Age wins over Expires.
+                try:
+                    return int(value) <= 0
+                except ValueError:
+                    continue
+            if key == 'expires':
+                expires = value.strip()
+        if expires:
+            parsed = parsedate_tz(expires)
+            return parsed is not None and mktime_tz(parsed) <= time.time()
+        return False
+
+
+class FastResponse(object):
+    """
+    The parts of a requests.Response that the flows use.
+    """
+
+    def __init__(self, method, url, status_code=0, headers=None,
+                 content=None, error=None):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers if headers is not None else {}
+        self.content = content
+        self.error = error
+
+    @property
+    def text(self):
+        return (self.content or b'').decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    @property
+    def ok(self):
+        try:
+            self.raise_for_status()
+        except RequestException:
+            return False
+        return True
+
+    def raise_for_status(self):
+        if self.error:
+            raise self.error
+        if 400 <= self.status_code < 600:
+            raise HTTPError('{} Error for url: {}'.format(
+                self.status_code, self.url
+            ), response=self)
+
+
+class FastResponseContextManager(FastResponse):
+    """
+    A response from catch_response=True, reported when the with block
+    exits, exactly like locust.clients.ResponseContextManager.
+    """
+
+    _is_reported = False
+
+    def __init__(self, response, request_meta):
+        self.__dict__ = response.__dict__
+        self.locust_request_meta = request_meta
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, traceback):
+        if self._is_reported:
+            return exc is None
+        if exc:
+            if isinstance(value, ResponseError):
+                self.failure(value)
+            else:
+                return False
+        else:
+            try:
+                self.raise_for_status()
+            except RequestException as e:
+                self.failure(e)
+            else:
+                self.success()
+        return True
+
+    def success(self):
+        locust.events.request_success.fire(
+            request_type=self.locust_request_meta['method'],
+            name=self.locust_request_meta['name'],
+            response_time=self.locust_request_meta['response_time'],
+            response_length=self.locust_request_meta['content_size'],
+        )
+        self._is_reported = True
+
+    def failure(self, exc):
+        if isinstance(exc, str):
+            exc = CatchResponseError(exc)
+        locust.events.request_failure.fire(
+            request_type=self.locust_request_meta['method'],
+            name=self.locust_request_meta['name'],
+            response_time=self.locust_request_meta['response_time'],
+            exception=exc,
+        )
+        self._is_reported = True
+
+
+class FastHttpSession(object):
+    """
+    A stand-in for locust's HttpSession: one user's cookies on top of
+    the process' shared connection pools.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.cookies = CookieJar()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('PUT', url, data=data, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.request('PATCH', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def request(self, method, url, name=None, catch_response=False,
+                data=None, params=None, headers=None, auth=None,
+                allow_redirects=True):
+        if not ABSOLUTE_URL.match(url):
+            url = self.base_url + url
+        if params:
+            url += ('&' if '?' in url else '?') + urlencode(params)
+
+        start = time.time()
+        timings = []
+        response = self._send(method, url, data, headers, auth,
+                              allow_redirects, timings)
+        parts = urlsplit(url)
+        request_meta = {
+            'method': method,
+            # As HttpSession names it: the path_url requests sends.
+            'name': name or (parts.path or '/') + ('?' + parts.query
+                                                   if parts.query else ''),
+            'response_time': int((time.time() - start) * 1000),
+            'content_size': len(response.content or b''),
+        }
+        record_phases(
+            '{} {}'.format(method, request_meta['name']), timings,
+            not response.ok
+        )
+
+        if catch_response:
+            return FastResponseContextManager(response, request_meta)
+        try:
+            response.raise_for_status()
+        except RequestException as e:
+            locust.events.request_failure.fire(
+                request_type=request_meta['method'],
+                name=request_meta['name'],
+                response_time=request_meta['response_time'],
+                exception=e,
+            )
+        else:
+            locust.events.request_success.fire(
+                request_type=request_meta['method'],
+                name=request_meta['name'],
+                response_time=request_meta['response_time'],
+                response_length=request_meta['content_size'],
+            )
+        return response
+
+    def _send(self, method, url, data, headers, auth, allow_redirects,
+              timings):
+        request_headers = dict(headers or {})
+        if not KEEPALIVE:
+            request_headers['Connection'] = 'close'
+        body = None
+        if data is not None:
+            if isinstance(data, (dict, list, tuple)):
+                body = urlencode(data).encode('utf-8')
+                request_headers.setdefault(
+                    'Content-Type', 'application/x-www-form-urlencoded'
+                )
+            else:
+                body = data
+        if auth:
+            # Like requests, only sent to the host that was asked for.
+            auth_host = urlsplit(url).netloc
+            auth_header = 'Basic ' + base64.b64encode(
+                '{}:{}'.format(*auth).encode('utf-8')
+            ).decode('ascii')
+
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            hop_headers = dict(request_headers)
+            cookie = self.cookies.header(parts.hostname)
+            if cookie:
+                hop_headers['Cookie'] = cookie
+            if auth and parts.netloc == auth_host:
+                hop_headers['Authorization'] = auth_header
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            hop_start = time.time()
+            timing = _timings[gevent.getcurrent()] = Timing()
+            try:
+                raw = client_for(
+                    parts.scheme, parts.hostname, parts.port
+                ).request(method, path, body=body, headers=hop_headers)
+                headers_at = time.time()
+                try:
+                    content = raw.read()
+                finally:
+                    raw.release()
+            except (IOError, OSError, HTTPParseError) as e:
+                return FastResponse(method, url, error=ConnectionError(e))
+            finally:
+                del _timings[gevent.getcurrent()]
+            ms = (time.time() - hop_start) * 1000
+            timing.add('ttfb', (headers_at - timing.socket_at) * 1000)
+            timing.add('body', (time.time() - headers_at) * 1000)
+            timings.append(timing)
+
+            self.cookies.update(
+                parts.hostname, header_list(raw.get('set-cookie'))
+            )
+            location = raw.get('location')
+            is_redirect = raw.status_code in REDIRECT_CODES and bool(location)
+            transactions.hop(method, url, ms, is_redirect)
+            if not (is_redirect and allow_redirects):
+                return FastResponse(
+                    method, url, raw.status_code, raw.info(), content
+                )
+
+            url = urljoin(url, location)
+            if raw.status_code in (301, 302, 303) and method != 'HEAD':
+                # Browsers (and requests) follow these with a plain GET.
+                method = 'GET'
+                body = None
+                request_headers.pop('Content-Type', None)
+
+        return FastResponse(method, url, error=TooManyRedirects(
+            'Exceeded {} redirects.'.format(MAX_REDIRECTS)
+        ))
+
+
+def on_quitting():
+    if isinstance(runners.locust_runner, runners.SlaveLocustRunner):
+        return
+    print_connections()
+
+
+locust.events.quitting += on_quitting
+
+
+class FastHttpLocust(locust.Locust):
+    """
+    Like locust.HttpLocust, but with a FastHttpSession as self.client.
+    """
+
+    client = None
+
+    def __init__(self):
+        super(FastHttpLocust, self).__init__()
+        if self.host is None:
+            raise LocustError(
+                'You must specify the base host. Either in the host '
+                'attribute in the Locust class, or on the command line '
+                'using the --host option.'
+            )
+        self.client = FastHttpSession(base_url=self.host)
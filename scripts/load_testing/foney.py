@@ -1,4 +1,6 @@
 # thanks to https://gist.github.com/ifnull/a32fcc90cd60f6e85b57
+import math
+import random
 
 
 def area_codes(count_start=200, count=1000):
@@ -52,13 +54,145 @@ def prefixes(count_start=200, count=1000):
     return co
 
 
-def phone_numbers(npa=206, count_start=1, count=1000):
-    pns = []
+def shuffled(size, seed=None):
+    """
+    Generator of range(size) in a random order that never repeats.
+
+    Walks the range with a random stride that is coprime with its size,
+    which visits every position exactly once while only keeping the
+    stride and offset around.
+    """
+    if not size:
+        return
+
+    rng = random.Random(seed)
+    offset = rng.randrange(size)
+    stride = 1
+    if size > 2:
+        stride = rng.randrange(1, size)
+        while math.gcd(stride, size) != 1:
+            stride = rng.randrange(1, size)
+
+    for step in range(size):
+        yield (offset + step * stride) % size
+
+
+class PhoneNumberSpace(object):
+    """
+    A lazy, read-only sequence of every NPA + CO + subscriber combination.
+
+    Nothing is materialized: the number at any index is computed by
+    decomposing the index into its NPA, CO and subscriber parts, so the
+    space costs the same handful of bytes whether it holds one number
+    or a few hundred million. It supports len(), indexing, slicing,
+    iteration and `in` like the list phone_numbers() used to return.
+
+    Slices are views over the same space, which makes it cheap to hand
+    each load-generating process its own disjoint shard().
+    """
+
+    def __init__(self, npas=None, cos=None, subscribers=range(1, 1000),
+                 indices=None):
+        self.npas = tuple(area_codes() if npas is None else npas)
+        self.cos = tuple(prefixes() if cos is None else cos)
+        self.subscribers = subscribers
+        self._per_npa = len(self.cos) * len(self.subscribers)
+
+        if indices is None:
+            indices = range(len(self.npas) * self._per_npa)
+        self._indices = indices
+
+    def __len__(self):
+        return len(self._indices)
 
-    for co in prefixes():
-        for sub in range(count_start, count):
-            sub = "%04d" % sub
-            pn = '{0}{1}{2}'.format(npa, co, sub)
-            pns.append(pn)
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._view(self._indices[key])
+        return self._number(self._indices[key])
 
-    return pns
+    def __iter__(self):
+        for i in self._indices:
+            yield self._number(i)
+
+    def __contains__(self, number):
+        try:
+            self.index(number)
+        except ValueError:
+            return False
+        return True
+
+    def __repr__(self):
+        return '<PhoneNumberSpace of {} numbers>'.format(len(self))
+
+    def index(self, number):
+        """
+        Position of a 10 digit number in this space,
+        or ValueError if it isn't in it.
+        """
+        number = str(number)
+        try:
+            if len(number) != 10:
+                raise ValueError
+            npa = self.npas.index(int(number[:3]))
+            co = self.cos.index(int(number[3:6]))
+            sub = self.subscribers.index(int(number[6:]))
+        except ValueError:
+            raise ValueError('{} is not in this space'.format(number))
+
+        i = npa * self._per_npa + co * len(self.subscribers) + sub
+        try:
+            return self._indices.index(i)
+        except ValueError:
+            raise ValueError('{} is not in this space'.format(number))
+
+    def random(self, rng=random):
+        """
+        A uniformly random number from the space.
+        Numbers may repeat; see unique() if they must not.
+        """
+        return self[rng.randrange(len(self))]
+
+    def unique(self, seed=None):
+        """
+        Generator of numbers in a random order that never repeats
+        until the whole space has been drawn.
+        """
+        for i in shuffled(len(self), seed):
+            yield self[i]
+
+    def shard(self, index, count):
+        """
+        The index-th of count contiguous, non-overlapping slices.
+        """
+        if not 0 <= index < count:
+            raise ValueError(
+                'shard {} is out of range for {} shards'.format(index, count)
+            )
+        size = len(self)
+        return self[size * index // count:size * (index + 1) // count]
+
+    def _view(self, indices):
+        return PhoneNumberSpace(
+            npas=self.npas,
+            cos=self.cos,
+            subscribers=self.subscribers,
+            indices=indices
+        )
+
+    def _number(self, i):
+        npa, rest = divmod(i, self._per_npa)
+        co, sub = divmod(rest, len(self.subscribers))
+        return '{0}{1}{2:04d}'.format(
+            self.npas[npa], self.cos[co], self.subscribers[sub]
+        )
+
+
+def phone_numbers(npa=206, count_start=1, count=1000):
+    """
+    Every number in one area code, in the same order the old eagerly
+    built list used, as a lazy PhoneNumberSpace.
+    """
+    return PhoneNumberSpace(
+        npas=(npa,),
+        subscribers=range(count_start, count)
+    )
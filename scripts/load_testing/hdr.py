@@ -0,0 +1,230 @@
+"""
+Fixed-memory, log-bucketed latency histograms in the style of HdrHistogram.
+
+Values are recorded in microseconds. Below 2 * 10 ** digits they are
+counted exactly; above that every power of two is split into the same
+number of linear sub-buckets, so any recorded value can be read back to
+within 10 ** -digits of itself, all the way out to an hour. The counts
+live in one preallocated list whose size depends only on the settings,
+recording is a bit_length and an increment, and two histograms with the
+same settings merge by adding their counts, with nothing lost.
+
+encode() packs a histogram into a short base64 string (zero runs are
+collapsed, the rest are varints, then zlib) for shipping from workers
+to the master or archiving a run.
+"""
+import base64
+import struct
+import zlib
+
+# An hour, in microseconds. Anything slower is counted as this.
+HIGHEST_TRACKABLE = 3600 * 1000 * 1000
+
+HEADER = struct.Struct('>BBQQQQQ')
+VERSION = 1
+
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+class Histogram(object):
+    """
+    A latency distribution with `digits` significant decimal digits.
+
+    Takes and reports milliseconds like the rest of the harness, and
+    counts failures alongside so it can stand in for a stats entry.
+    """
+
+    def __init__(self, digits=2):
+        self.digits = digits
+        # Exact counts up to sub_buckets, then half that many linear
+        # buckets per power of two.
+        self._bits = (2 * 10 ** digits - 1).bit_length()
+        self._sub_buckets = 1 << self._bits
+        self._half = self._sub_buckets >> 1
+        self.counts = [0] * (self._index(HIGHEST_TRACKABLE) + 1)
+        self.count = 0
+        self.failures = 0
+        self.total = 0
+        self._min = None
+        self._max = 0
+
+    def _index(self, value):
+        if value < self._sub_buckets:
+            return value
+        shift = value.bit_length() - self._bits
+        return self._sub_buckets + (shift - 1) * self._half + (
+            (value >> shift) - self._half
+        )
+
+    def _highest_equivalent(self, index):
+        if index < self._sub_buckets:
+            return index
+        shift, sub = divmod(index - self._sub_buckets, self._half)
+        shift += 1
+        return ((sub + self._half) << shift) + (1 << shift) - 1
+
+    def record(self, ms, failed=False):
+        value = min(max(int(ms * 1000), 0), HIGHEST_TRACKABLE)
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        if failed:
+            self.failures += 1
+        self.total += value
+        if self._min is None or value < self._min:
+            self._min = value
+        if value > self._max:
+            self._max = value
+
+    def merge(self, other):
+        if other.digits != self.digits:
+            raise ValueError(
+                'Cannot merge a {}-digit histogram into a {}-digit one'.format(
+                    other.digits, self.digits
+                )
+            )
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.failures += other.failures
+        self.total += other.total
+        if other._min is not None:
+            if self._min is None or other._min < self._min:
+                self._min = other._min
+        self._max = max(self._max, other._max)
+
+    def subtract(self, other):
+        """
+        Takes out what an earlier copy of this histogram had recorded,
+        leaving what was recorded since. Min and max become those of the
+        remaining buckets, to within the histogram's precision.
+        """
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] -= count
+        self.count -= other.count
+        self.failures -= other.failures
+        self.total -= other.total
+        used = [index for index, count in enumerate(counts) if count]
+        if used:
+            self._min = min(self._highest_equivalent(used[0]), self._max)
+            self._max = min(self._highest_equivalent(used[-1]), self._max)
+        else:
+            self._min = None
+            self._max = 0
+
+    @property
+    def avg(self):
+        return self.total / 1000.0 / self.count if self.count else 0
+
+    @property
+    def min(self):
+        return (self._min or 0) / 1000.0
+
+    @property
+    def max(self):
+        return self._max / 1000.0
+
+    def percentile(self, percent):
+        """
+        The smallest recorded ms that at least `percent` of values are at
+        or under, to within the histogram's precision.
+        """
+        if not self.count:
+            return 0
+        if percent >= 1:
+            return self.max
+        wanted = max(int(self.count * percent + 0.5), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self._highest_equivalent(index), self._max) / 1000.0
+        return self.max
+
+    def buckets(self):
+        """
+        (highest equivalent ms, count) for every non-empty bucket.
+        """
+        for index, count in enumerate(self.counts):
+            if count:
+                yield self._highest_equivalent(index) / 1000.0, count
+
+    def encode(self):
+        payload = bytearray()
+        zeros = 0
+        for count in self.counts:
+            if count:
+                if zeros:
+                    write_varint(payload, zigzag(-zeros))
+                    zeros = 0
+                write_varint(payload, zigzag(count))
+            else:
+                zeros += 1
+        header = HEADER.pack(
+            VERSION, self.digits, self.count, self.failures, self.total,
+            self._min or 0, self._max
+        )
+        # Trailing zeros are left off; decode() gets them from the settings.
+        return base64.b64encode(
+            zlib.compress(header + bytes(payload))
+        ).decode('ascii')
+
+    @classmethod
+    def decode(cls, encoded):
+        data = zlib.decompress(base64.b64decode(encoded))
+        (version, digits, count, failures, total, low,
+         high) = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError('Unknown histogram version {}'.format(version))
+        histogram = cls(digits)
+        histogram.count = count
+        histogram.failures = failures
+        histogram.total = total
+        histogram._min = low if count else None
+        histogram._max = high
+
+        index = 0
+        pos = HEADER.size
+        while pos < len(data):
+            n, pos = read_varint(data, pos)
+            n = unzigzag(n)
+            if n < 0:
+                index -= n
+            else:
+                histogram.counts[index] = n
+                index += 1
+        return histogram
+
+    def serialize(self):
+        return self.encode()
+
+    @classmethod
+    def unserialize(cls, data):
+        return cls.decode(data)
@@ -0,0 +1,340 @@
+"""
+The IdP's health checks polled alongside the load, to tell what slowed down.
+
+When user-facing latency jumps, the question is whether the database or
+the job workers went first. Set HEALTH_POLL and, while the run goes, one
+process polls /api/health, /api/health/database and /api/health/workers
+every HEALTH_POLL seconds, one after the other on a connection of its
+own. It fires no locust events, so the polls stay out of the request
+stats. Each poll is recorded in the 'health' results table, grouped by
+path, both in total and by status ('error' if there was no response).
+It's a results table like any other, so TIMESERIES records it second by
+second next to the requests and flows (see timeseries.py).
+
+Each poll interval is also compared with the p95 of the requests this
+process made during it. A series degrades when it goes over
+HEALTH_FACTOR times its baseline (the median of its recent healthy
+intervals) and at least HEALTH_MIN_MS above it, or when a check fails.
+Whenever the requests' p95 degrades, every health check that degraded
+in the HEALTH_MAX_LAG seconds before is flagged as having led it, and by
+how long. When the run ends, each check's correlation with the requests'
+p95 is printed for lags of 0 to HEALTH_MAX_LAG seconds, along with the
+lag that correlates best, and then the flags.
+
+In a distributed run, the first worker polls and compares the checks
+with its own requests, a sample of the whole run's.
+
+Settings:
+* HEALTH_POLL: seconds between polls (e.g. 1); nothing is polled unless
+  it's set.
+* HEALTH_PATHS: the checks to poll, comma separated (default the three
+  above).
+* HEALTH_TIMEOUT: seconds a poll may take before it counts as an error
+  (default 10).
+* HEALTH_FACTOR: how many times its baseline a series has to get to
+  count as degraded (default 2).
+* HEALTH_MIN_MS: and how many ms above its baseline (default 50).
+* HEALTH_MAX_LAG: the longest a check may lead the requests by and
+  still be flagged, in seconds (default 30).
+
+Usage:
+HEALTH_POLL=1 TIMESERIES=run.ts make load_test type=locustfile
+"""
+import math
+import os
+import sys
+import time
+from collections import deque
+
+import gevent
+import locust
+from locust import runners
+import requests
+
+import results
+
+PATHS = ('/api/health', '/api/health/database', '/api/health/workers')
+# What the checks are compared with.
+REQUESTS = 'requests p95'
+# Healthy intervals a series' baseline is the median of, and how many it
+# needs before anything counts as degraded.
+BASELINE = 30
+WARMUP = 5
+
+health_stats = results.table(
+    'health', 'Health checks (ms)', ('Check', 'Status'), nested=True
+)
+
+
+class Series(object):
+    """
+    One series of interval values, and whether it's degraded.
+    """
+
+    def __init__(self, factor, min_ms):
+        self.factor = factor
+        self.min_ms = min_ms
+        self.healthy = deque(maxlen=BASELINE)
+        self.degraded = False
+
+    def baseline(self):
+        values = sorted(self.healthy)
+        return values[len(values) // 2] if values else None
+
+    def add(self, value, failed=False):
+        """
+        Adds one interval's value, and returns True if the series has
+        just degraded.
+        """
+        baseline = self.baseline()
+        degraded = failed or (
+            len(self.healthy) >= WARMUP
+            and value > baseline * self.factor
+            and value - baseline >= self.min_ms
+        )
+        onset = degraded and not self.degraded
+        self.degraded = degraded
+        if not degraded:
+            self.healthy.append(value)
+        return onset
+
+
+class Correlation(object):
+    """
+    Pearson correlation of x, lagged by 0 to max_lag intervals, with y,
+    from running sums, so memory doesn't grow with the run.
+    """
+
+    def __init__(self, max_lag):
+        self.recent = deque(maxlen=max_lag + 1)
+        # Per lag: n, sum x, sum y, sum x^2, sum y^2, sum xy.
+        self.sums = [[0.0] * 6 for _ in range(max_lag + 1)]
+
+    def add(self, x, y):
+        self.recent.appendleft(x)
+        for lag, earlier in enumerate(self.recent):
+            if earlier is None or y is None:
+                continue
+            sums = self.sums[lag]
+            sums[0] += 1
+            sums[1] += earlier
+            sums[2] += y
+            sums[3] += earlier * earlier
+            sums[4] += y * y
+            sums[5] += earlier * y
+
+    def coefficient(self, lag):
+        n, x, y, xx, yy, xy = self.sums[lag]
+        if n < 3:
+            return None
+        spread = (n * xx - x * x) * (n * yy - y * y)
+        if spread <= 0:
+            return None
+        return (n * xy - x * y) / math.sqrt(spread)
+
+    def best(self):
+        """
+        (lag, coefficient) with the strongest correlation, or None.
+        """
+        found = [
+            (lag, self.coefficient(lag)) for lag in range(len(self.sums))
+        ]
+        found = [(lag, r) for lag, r in found if r is not None]
+        return max(found, key=lambda item: item[1]) if found else None
+
+
+class Correlator(object):
+    """
+    Lines each interval's health checks up with the requests' p95, and
+    flags the checks that degrade before it.
+    """
+
+    def __init__(self, paths, interval, factor=2.0, min_ms=50.0,
+                 max_lag=30.0):
+        self.interval = interval
+        self.max_lag = max_lag
+        lags = int(max_lag / interval)
+        self.series = dict(
+            (name, Series(factor, min_ms)) for name in paths + (REQUESTS,)
+        )
+        self.correlations = dict(
+            (path, Correlation(lags)) for path in paths
+        )
+        # When each check last degraded.
+        self.onsets = {}
+        # (check, when it degraded, when the requests did), as found.
+        self.flags = []
+        self.requests = results.StatsTable(('Series', ''))
+        results.request_stats.taps.append(self.on_request)
+
+    def on_request(self, group, name, ms, failed):
+        self.requests.record(REQUESTS, results.TOTAL, ms, failed)
+
+    def add(self, at, polls):
+        """
+        Closes the interval ending at `at`, with {path: (ms, failed)}.
+        """
+        entry = self.requests.entries.get((REQUESTS, results.TOTAL))
+        p95 = entry.percentile(0.95) if entry is not None else None
+        self.requests.clear()
+        for path, (ms, failed) in polls.items():
+            if self.series[path].add(ms, failed):
+                self.onsets[path] = at
+            self.correlations[path].add(None if failed else ms, p95)
+        if p95 is not None and self.series[REQUESTS].add(p95):
+            for path, onset in sorted(self.onsets.items()):
+                if at - onset <= self.max_lag:
+                    self.flags.append((path, onset, at))
+
+    def summary(self):
+        """
+        Per check, its correlation at lag 0 and at the best lag.
+        """
+        rows = []
+        for path, correlation in sorted(self.correlations.items()):
+            best = correlation.best()
+            rows.append([
+                path, correlation.coefficient(0),
+                best[0] * self.interval if best else None,
+                best[1] if best else None,
+            ])
+        return rows
+
+
+class Poller(object):
+    """
+    Polls the checks every interval on a connection of its own.
+    """
+
+    def __init__(self, host, paths, interval, timeout=10, auth=None,
+                 correlator=None):
+        self.host = host.rstrip('/')
+        self.paths = paths
+        self.interval = interval
+        self.timeout = timeout
+        self.correlator = correlator
+        self.session = requests.Session()
+        self.session.mount(host, requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=1
+        ))
+        if auth and all(auth):
+            self.session.auth = auth
+
+    def run(self):
+        next_at = time.time()
+        while True:
+            polls = dict((path, self.poll(path)) for path in self.paths)
+            if self.correlator is not None:
+                self.correlator.add(time.time(), polls)
+            next_at += self.interval
+            # A slow round skips the polls it ran into, rather than
+            # hurrying to catch up.
+            while next_at < time.time():
+                next_at += self.interval
+            gevent.sleep(next_at - time.time())
+
+    def poll(self, path):
+        start = time.time()
+        try:
+            resp = self.session.get(self.host + path, timeout=self.timeout)
+            status = str(resp.status_code)
+        except requests.RequestException:
+            status = 'error'
+        ms = (time.time() - start) * 1000
+        failed = status != '200'
+        health_stats.record(path, results.TOTAL, ms, failed)
+        health_stats.record(path, status, ms, failed)
+        return ms, failed
+
+
+def print_report(summary, flags, out=sys.stdout):
+    def number(value, spec):
+        return '-' if value is None else spec.format(value)
+
+    out.write('Health checks against requests p95\n')
+    out.write(' {:<30} {:>10} {:>10} {:>12}\n'.format(
+        'Check', 'r at 0s', 'best lag', 'r at best'
+    ))
+    for path, r, lag, best in summary:
+        out.write(' {:<30} {:>10} {:>10} {:>12}\n'.format(
+            path, number(r, '{:.2f}'), number(lag, '{:g}s'),
+            number(best, '{:.2f}')
+        ))
+    for path, onset, at in flags:
+        when = time.strftime('%H:%M:%S', time.localtime(at))
+        if at == onset:
+            out.write(' {} degraded along with requests p95, at {}\n'.format(
+                path, when
+            ))
+        else:
+            out.write(
+                ' {} degraded {:.0f}s before requests p95, at {}\n'.format(
+                    path, at - onset, when
+                )
+            )
+    if not flags:
+        out.write(' No check degraded ahead of the requests.\n')
+    out.write('\n')
+
+
+_poller = None
+# What the polling worker last reported, on a master.
+_reported = {'summary': [], 'flags': []}
+
+
+def on_start_hatching():
+    global _poller
+    runner = runners.locust_runner
+    if (_poller is not None or not os.getenv('HEALTH_POLL')
+            or os.getenv('WORKER_INDEX', '0') != '0'):
+        return
+    interval = float(os.getenv('HEALTH_POLL'))
+    paths = tuple(
+        path for path in os.getenv('HEALTH_PATHS', ','.join(PATHS)).split(',')
+        if path
+    )
+    _poller = Poller(
+        runner.host or runner.locust_classes[0].host,
+        paths,
+        interval,
+        float(os.getenv('HEALTH_TIMEOUT', 10)),
+        (os.getenv('AUTH_USER'), os.getenv('AUTH_PASS')),
+        Correlator(
+            paths,
+            interval,
+            float(os.getenv('HEALTH_FACTOR', 2)),
+            float(os.getenv('HEALTH_MIN_MS', 50)),
+            float(os.getenv('HEALTH_MAX_LAG', 30)),
+        ),
+    )
+    _poller.greenlet = gevent.spawn(_poller.run)
+
+
+def on_report_to_master(client_id, data):
+    if _poller is not None:
+        data['health'] = {
+            'summary': _poller.correlator.summary(),
+            'flags': _poller.correlator.flags,
+        }
+
+
+def on_slave_report(client_id, data):
+    if 'health' in data:
+        _reported.update(data['health'])
+
+
+def on_quitting():
+    if _poller is not None:
+        _poller.greenlet.kill()
+    if isinstance(runners.locust_runner, runners.SlaveLocustRunner):
+        return
+    if _poller is not None:
+        print_report(_poller.correlator.summary(), _poller.correlator.flags)
+    elif _reported['summary']:
+        print_report(_reported['summary'], _reported['flags'])
+
+
+locust.events.locust_start_hatching += on_start_hatching
+locust.events.report_to_master += on_report_to_master
+locust.events.slave_report += on_slave_report
+locust.events.quitting += on_quitting
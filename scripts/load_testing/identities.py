@@ -0,0 +1,123 @@
+"""
+Made-up identities for signup() and verify(), generated ahead of time.
+
+Faker takes about a millisecond of CPU per identity, which used to sit
+on the request path of every signup. Instead, an Identity (an email,
+phone number and the personal details verification asks for) is drawn
+from a pool that a background producer keeps topped up while the event
+loop is otherwise idle (see precomputed.py). If a task ever finds the
+pool empty it makes one on the spot, and that shows up as an 'identity'
+miss in the 'precomputed' table.
+
+Within a run, and across the workers of a distributed run, no two
+identities share an email, phone number or SSN: phone numbers and SSNs
+are drawn without repeats from each worker's own shard of the space.
+
+Settings:
+* IDENTITY_POOL_SIZE: how many identities to keep ready (default 1000).
+* IDENTITY_SEED: makes the identities, and their order, the same on
+  every run with the same seed and WORKER_INDEX. The IdP remembers
+  emails and SSNs, so reset its database between seeded runs.
+"""
+import collections
+import os
+import random
+
+from faker import Factory
+
+import foney
+from precomputed import Precomputed
+
+# States whose IDs the vendors can check (FormStateIdValidator).
+SUPPORTED_JURISDICTIONS = (
+    'AR', 'AZ', 'CA', 'DC', 'DE', 'FL', 'IA', 'ID', 'IL', 'IN', 'KY', 'MD',
+    'ME', 'MI', 'MS', 'ND', 'NE', 'NM', 'PA', 'SD', 'TX', 'VA', 'WA', 'WI',
+)
+
+# The 9xx area is never issued.
+SSN_SPACE = 10 ** 8
+
+Identity = collections.namedtuple('Identity', (
+    'email', 'phone', 'first_name', 'last_name', 'address1', 'city',
+    'state', 'zipcode', 'dob', 'ssn', 'state_id_number',
+))
+
+
+class IdentityFactory(object):
+    """
+    Makes unique Identity tuples for one worker.
+    """
+
+    def __init__(self, seed=None, worker_index=0, worker_count=1):
+        if seed is not None:
+            seed = '{}/{}'.format(seed, worker_index)
+        self.rng = random.Random(seed)
+        self.fake = Factory.create()
+        if seed is not None:
+            # Faker's providers all share one module-level Random, so this
+            # seeds them all: only one factory per process can be seeded.
+            self.fake.seed(self.rng.getrandbits(64))
+        self.phones = foney.phone_numbers().shard(
+            worker_index, worker_count
+        ).unique(self.rng.getrandbits(64))
+        first = SSN_SPACE * worker_index // worker_count
+        last = SSN_SPACE * (worker_index + 1) // worker_count
+        self._ssn_first = first
+        self._ssns = foney.shuffled(last - first, self.rng.getrandbits(64))
+
+    @classmethod
+    def from_env(cls):
+        seed = os.getenv('IDENTITY_SEED')
+        return cls(
+            seed,
+            int(os.getenv('WORKER_INDEX', 0)),
+            int(os.getenv('WORKER_COUNT', 1)),
+        )
+
+    def ssn(self):
+        number = self._ssn_first + next(self._ssns)
+        return '9{:02d}-{:02d}-{:04d}'.format(
+            number // 10 ** 6, number // 10 ** 4 % 100, number % 10 ** 4
+        )
+
+    def __call__(self):
+        rng = self.rng
+        return Identity(
+            email='test+{:032x}@test.com'.format(rng.getrandbits(128)),
+            phone=next(self.phones),
+            first_name=self.fake.first_name(),
+            last_name=self.fake.last_name(),
+            address1=self.fake.street_address(),
+            city=self.fake.city(),
+            state=rng.choice(SUPPORTED_JURISDICTIONS),
+            zipcode=self.fake.zipcode(),
+            dob='{:02d}/{:02d}/{}'.format(
+                rng.randint(1, 12), rng.randint(1, 28), rng.randint(1930, 1999)
+            ),
+            ssn=self.ssn(),
+            state_id_number=str(rng.randrange(10 ** 8, 10 ** 9)),
+        )
+
+
+# Made on first use, so only processes that sign up pay for filling it.
+_pool = None
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        _pool = Precomputed(
+            'identity',
+            IdentityFactory.from_env(),
+            size=int(os.getenv('IDENTITY_POOL_SIZE', 1000)),
+            producers=1,
+            threaded=False,
+        )
+    return _pool
+
+
+def get():
+    """
+    The next identity from the pool.
+    """
+    return pool().get()
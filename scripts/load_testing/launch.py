@@ -0,0 +1,146 @@
+"""
+Runs a load test as one locust master and N worker processes on this box.
+
+A single locust process tops out at one core, so this starts a master
+plus a worker per remaining core (or --workers), optionally pinning each
+to its own CPU, and waits for the run to finish. Each worker is told its
+WORKER_INDEX and WORKER_COUNT, which the harness uses to give it its own
+slice of the seeded accounts (creds.py) and of the phone number space
+(foney.py). Any ARRIVAL_RATE/ARRIVAL_RATES is divided between them here,
+and each takes its share of the rates in an ARRIVAL_RATES_FILE as it
+reads it (arrivals.py).
+
+Everything talks over 127.0.0.1, so it runs fully offline. The master
+prints the combined stats, and the launcher exits non-zero if the master
+or any worker did.
+
+Usage:
+python launch.py -f locustfile.py -H http://localhost:3000 \
+    -c 300 -r 10 -t 180s [--workers 8] [--pin]
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+
+def free_port_pair():
+    """
+    Two consecutive free ports; the master binds port and port + 1.
+    """
+    while True:
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        try:
+            second = socket.socket()
+            second.bind(('127.0.0.1', port + 1))
+            second.close()
+            return port
+        except (IOError, OSError):
+            continue
+
+
+def pin_to(cpu):
+    def pin():
+        os.sched_setaffinity(0, {cpu})
+    return pin
+
+
+def worker_env(index, count):
+    env = dict(os.environ)
+    env['WORKER_INDEX'] = str(index)
+    env['WORKER_COUNT'] = str(count)
+    if env.get('ARRIVAL_RATE'):
+        env['ARRIVAL_RATE'] = str(float(env['ARRIVAL_RATE']) / count)
+    if env.get('ARRIVAL_RATES'):
+        # Same 'name=rate,...' format arrivals.parse_rates() reads. Not
+        # imported from there, since importing locust here would
+        # monkey-patch the launcher.
+        rates = []
+        for pair in env['ARRIVAL_RATES'].split(','):
+            if pair.strip():
+                name, rate = pair.split('=')
+                rates.append('{}={}'.format(name.strip(), float(rate) / count))
+        env['ARRIVAL_RATES'] = ','.join(rates)
+    return env
+
+
+def main():
+    cpus = sorted(os.sched_getaffinity(0))
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('-f', '--locustfile', required=True)
+    parser.add_argument('-H', '--host', required=True)
+    parser.add_argument('-c', '--clients', type=int, required=True)
+    parser.add_argument('-r', '--hatch-rate', type=float, required=True)
+    parser.add_argument('-t', '--run-time', required=True)
+    parser.add_argument('--workers', type=int, default=max(len(cpus) - 1, 1),
+                        help='worker processes (default: one per spare CPU)')
+    parser.add_argument('--pin', action='store_true',
+                        help='pin the master and each worker to its own CPU')
+    parser.add_argument('--locust', default='locust',
+                        help='the locust executable to run')
+    args = parser.parse_args()
+
+    port = free_port_pair()
+    common = [args.locust, '-f', args.locustfile, '-H', args.host]
+
+    master = subprocess.Popen(
+        common + [
+            '--master', '--no-web',
+            '--master-bind-host', '127.0.0.1',
+            '--master-bind-port', str(port),
+            '--expect-slaves', str(args.workers),
+            '-c', str(args.clients),
+            '-r', str(args.hatch_rate),
+            '-t', args.run_time,
+        ],
+        preexec_fn=pin_to(cpus[0]) if args.pin else None,
+    )
+    # Give the master a moment to bind before the workers connect.
+    time.sleep(1)
+
+    workers = []
+    for index in range(args.workers):
+        workers.append(subprocess.Popen(
+            common + [
+                '--slave',
+                '--master-host', '127.0.0.1',
+                '--master-port', str(port),
+            ],
+            env=worker_env(index, args.workers),
+            preexec_fn=(
+                pin_to(cpus[(index + 1) % len(cpus)]) if args.pin else None
+            ),
+        ))
+
+    def stop(signum, frame):
+        for process in [master] + workers:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    status = master.wait()
+    # Workers quit on their own when the master does; don't wait forever.
+    deadline = time.time() + 30
+    for worker in workers:
+        try:
+            worker_status = worker.wait(max(deadline - time.time(), 0.1))
+        except subprocess.TimeoutExpired:
+            worker.kill()
+            worker_status = worker.wait()
+        if worker_status not in (0, -signal.SIGINT) and not status:
+            status = worker_status or 1
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
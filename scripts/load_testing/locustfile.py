@@ -1,71 +1,43 @@
 import os
 import pdb
-from random import randint
 
-from faker import Factory
 import locust
-import pyquery
 
-import foney
+import arrivals
+import assets
+import creds
+from extract import resp_to_dom, resp_to_page
+import failures
+import fasthttp
+import health  # Polls the IdP's health checks when HEALTH_POLL is set.
+import identities
+import pacing
+import ramp  # Steps the load when RAMP is set.
+import replay
+import sessions
+import timeseries  # Records results over time when TIMESERIES is set.
+import transactions
+import verify
+import workload
 
 import datetime
 
-fake = Factory.create()
-phone_numbers = foney.phone_numbers()
-
 username, password = os.getenv('AUTH_USER'), os.getenv('AUTH_PASS')
 auth = (username, password) if username and password else ()
 
-# This should match however many users were created
-# for the DB by the rake task.
-NUM_USERS = 1000
-
-
-def random_cred():
-    """
-    Given the rake task:
-    rake dev:random_users NUM_USERS=1000 SCRYPT_COST='800$8$1$'
-
-    We should have 1000 existing users with credentials matching:
-    * email address testuser1@example.com through testuser1000@example.com
-    * the password "salty pickles"
-    * a phone number between +1 (415) 555-0001 and +1 (415) 555-1000.
-
-    This will generate a set of credentials to match one of those entries.
-    Note that YOU MUST run the rake task to put these users in the DB first.
-
-    """
-    return {
-        'email': 'testuser{}@example.com'.format(randint(1, NUM_USERS-1)),
-        'password': "salty pickles"
-    }
-
-
-def authenticity_token(dom, id=None):
-    """
-    Retrieves the CSRF auth token from the DOM for submission.
-    If you need to differentiate between multiple CSRF tokens on one page,
-    pass the optional ID of the parent form (with hash)
-    """
-    selector = 'input[name="authenticity_token"]:first'
-
-    if id:
-        selector = '{} {}'.format(id, selector)
-    return dom.find(selector).attr('value')
-
-
-def resp_to_dom(resp):
-    """
-    Little helper to check response status is 200
-    and return the DOM, cause we do that a lot.
-    """
-    resp.raise_for_status()
-    return pyquery.PyQuery(resp.content)
+# Each task leases its own seeded account; see creds.py.
+leases = creds.CredentialLeases.from_env()
+# Keeps sign-ins under the IdP's OTP send limit when OTP_PACING is set.
+pacing.setup(leases)
 
 
-def login(t, credentials):
+@transactions.flow('login')
+def login(t, credentials, allow_redirects=True):
     """
     Takes a locustTask object and signs you in.
+
+    Pass allow_redirects=False to stop at the redirect after 2FA, e.g.
+    when it leads back to a service provider we can't follow it to.
     """
     with t.client.get('/', catch_response=True) as resp:
         # If you're already logged in, it'll redirect to /account.
@@ -75,12 +47,12 @@ def login(t, credentials):
             print("You're already logged in. We're going to quit login().")
             return resp
 
-        dom = resp_to_dom(resp)
-        token = authenticity_token(dom)
+        page = resp_to_page(resp)
+        token = page.authenticity_token()
 
         if not token:
-            resp.failure(
-                "Not a sign-in page. Current URL is {}.".format(resp.url)
+            failures.report(
+                resp, "Not a sign-in page. Current URL is {}.".format(resp.url)
             )
 
     resp = t.client.post(
@@ -88,49 +60,32 @@ def login(t, credentials):
         data={
             'user[email]': credentials['email'],
             'user[password]': credentials['password'],
-            'authenticity_token': authenticity_token(dom),
+            'authenticity_token': token,
             'commit': 'Submit',
         }
     )
-    dom = resp_to_dom(resp)
-    code = dom.find("#code").attr('value')
+    pacing.sent(creds.phone(credentials['id']))
+    page = resp_to_page(resp)
+    code = page.code
 
     if not code:
-        # if we didn't see the code, then it's probably a failed login
-        # due to un-reset credentials.
-        # So let's try to rescue with the alternate pass.
-        repost_resp = t.client.post(
-            resp.url,
-            data={
-                'user[email]': credentials['email'],
-                'user[password]': 'thisisanewpass',
-                'authenticity_token': authenticity_token(dom),
-                'commit': 'Submit',
-            },
-            catch_response=True
+        failures.report(
+            resp,
+            """
+            No 2FA code found.
+            Make sure {} is in the DB.
+            """.format(credentials['email'])
         )
-        with repost_resp as resp:
-            dom = resp_to_dom(resp)
-            code = dom.find("#code").attr('value')
-
-            # If we still don't have code, we have a bigger problem.
-            if not code:
-                resp.failure(
-                    """
-                    No 2FA code found after two tries.
-                    Make sure {} is in the DB.
-                    """.format(credentials)
-                )
-                return
+        return
 
-    code_form = dom.find("form[action='/login/two_factor/sms']")
     resp = t.client.post(
-        code_form.attr('action'),
+        '/login/two_factor/sms',
         data={
             'code': code,
-            'authenticity_token': authenticity_token(dom),
+            'authenticity_token': page.authenticity_token(),
             'commit': 'Submit'
-        }
+        },
+        allow_redirects=allow_redirects
     )
     # We're not checking for post-login state here,
     # as it will vary depending on the SP.
@@ -138,16 +93,16 @@ def login(t, credentials):
     return resp
 
 
+@transactions.flow('logout')
 def logout(t, page="/"):
     """
     Takes a locustTask object and signs you out.
     Naively assumes the user is actually logged in already.
     """
     with t.client.get(page, catch_response=True) as resp:
-        dom = resp_to_dom(resp)
-        sign_out_link = dom.find('a[href="/api/saml/logout"]').attr('href')
+        sign_out_link = resp_to_page(resp).sign_out_link
         if not sign_out_link:
-            resp.failure("No signout link at {}.".format(resp.url))
+            failures.report(resp, "No signout link at {}.".format(resp.url))
             return
     # Authentication is now complete.
     # We've confirmed by the presence of the sign-out link.
@@ -156,47 +111,67 @@ def logout(t, page="/"):
     resp.raise_for_status()
 
 
+@transactions.flow('change_pass')
 def change_pass(t, password):
     """
     Takes a locustTask and naively expects an already logged in person,
     this navigates to the account (which they should already be on, post-login)
+
+    Returns True once the new password has been saved.
     """
     resp = t.client.get('/account')
-    dom = resp_to_dom(resp)
-    edit_link = dom.find('a[href="/manage/password"]')
+    page = resp_to_page(resp)
+    edit_link = page.link('/manage/password', exact=True)
 
-    try:
-        resp = t.client.get(edit_link[0].attrib['href'])
-    except Exception as error:
-        resp.failure(
+    if not edit_link:
+        # The page itself is kept with the failure; see failures.py.
+        failures.report(
+            resp,
             """
-            There was a problem finding the edit pass link: {}
+            There was a problem finding the edit pass link.
             You may be hitting an OTP cap with this user,
             or did not run the rake task to generate users.
             Since we can't change the password, we'll exit.
-            Here is the content we're seeing at {}: {}
-            """.format(error, resp.url, dom('.container').eq(0).text())
+            Currently at {}.
+            """.format(resp.url)
         )
         return
 
-    dom = resp_to_dom(resp)
+    resp = t.client.get(edit_link)
+    page = resp_to_page(resp)
     # To keep it simple for now we're skipping reauthn
     if '/manage/password' in resp.url:
         resp = t.client.post(
             resp.url,
             data={
                 'update_user_password_form[password]': password,
-                'authenticity_token': authenticity_token(dom),
+                'authenticity_token': page.authenticity_token(),
                 '_method': 'patch',
                 'commit': 'update'
             }
         )
         resp.raise_for_status()
+        return True
     else:
         # To-do: handle reauthn case
-        resp.failure("Wrong redirect. Currently at {}".format(resp.url))
+        failures.report(
+            resp, "Wrong redirect. Currently at {}".format(resp.url)
+        )
+
 
+def change_pass_and_back(t, credentials):
+    """
+    Changes a leased account's password and then changes it back,
+    keeping the lease's record of its current password in step.
+    """
+    if change_pass(t, "thisisanewpass"):
+        leases.set_password(credentials, "thisisanewpass")
+    # now change it back.
+    if change_pass(t, creds.DEFAULT_PASSWORD):
+        leases.set_password(credentials, creds.DEFAULT_PASSWORD)
 
+
+@transactions.flow('signup')
 def signup(t, signup_url=None):
     """
     Creates a new account, starting at the home page,
@@ -204,7 +179,8 @@ def signup(t, signup_url=None):
 
     We're checking for signup_url to pass name and group results
     """
-    new_email = 'test+{}@test.com'.format(fake.md5())
+    identity = pacing.identity(identities.get)
+    email = identity.email
     default_password = "salty pickles"
 
     if signup_url:
@@ -216,37 +192,37 @@ def signup(t, signup_url=None):
     else:
         t.client.get('/sign_up/start', auth=auth)
     resp = t.client.get('/sign_up/enter_email', auth=auth)
-    dom = resp_to_dom(resp)
+    page = resp_to_page(resp)
 
     email_resp = t.client.post(
         '/sign_up/enter_email',
         data={
-            'user[email]': new_email,
-            'authenticity_token': authenticity_token(dom),
+            'user[email]': email,
+            'authenticity_token': page.authenticity_token(),
             'commit': 'Submit',
         },
         auth=auth,
         catch_response=True
     )
     with email_resp as resp:
-        dom = resp_to_dom(resp)
+        link = resp_to_page(resp).confirmation_link
 
-        try:
-            link = dom.find("a[href*='confirmation_token']")[0].attrib['href']
-        except IndexError:
+        if not link:
             if '/account' in resp.url:
-                resp.failure(
+                failures.report(
+                    resp,
                     """
                     Account appears to already be signed up and logged in.
                     Current URL: {}.
                     """.format(resp.url)
                 )
             else:
-                resp.failure(
+                failures.report(
+                    resp,
                     """
                     Failed to get confirmation token.
                     Consult https://github.com/18F/identity-idp#load-testing
-                    and check your application config. Current URL:
+                    and check your application config. Current URL: {}
                     """.format(resp.url)
                 )
             return
@@ -257,16 +233,15 @@ def signup(t, signup_url=None):
         auth=auth,
         name='/sign_up/email/confirm?confirmation_token='
     )
-    dom = resp_to_dom(resp)
-    token = dom.find('[name="confirmation_token"]:first').attr('value')
+    page = resp_to_page(resp)
 
     # Got to password page and submit
     resp = t.client.post(
         '/sign_up/create_password',
         data={
             'password_form[password]': default_password,
-            'authenticity_token': authenticity_token(dom),
-            'confirmation_token': token,
+            'authenticity_token': page.authenticity_token(),
+            'confirmation_token': page.confirmation_token,
             'commit': 'Submit',
         },
         auth=auth
@@ -276,8 +251,7 @@ def signup(t, signup_url=None):
     # Now we have to get this page, then extract the correct auth token
     # so we can then turn around and post the confirmation token back.
     resp = t.client.get(resp.url)
-    dom = resp_to_dom(resp)
-    auth_token = authenticity_token(dom, '#new_user_phone_form')
+    auth_token = resp_to_page(resp).authenticity_token('#new_user_phone_form')
 
     # Now post with the correct tokens
     phone_post = t.client.post(
@@ -285,7 +259,7 @@ def signup(t, signup_url=None):
         data={
             '_method': 'patch',
             'user_phone_form[international_code]': 'US',
-            'user_phone_form[phone]': phone_numbers[randint(1, 1000)],
+            'user_phone_form[phone]': identity.phone,
             'user_phone_form[otp_delivery_preference]': 'sms',
             'authenticity_token': auth_token,
             'commit': 'Send security code',
@@ -293,14 +267,18 @@ def signup(t, signup_url=None):
         auth=auth,
         catch_response=True
     )
+    pacing.sent(identity.phone)
 
     with phone_post as resp:
-        dom = resp_to_dom(resp)
-        try:
-            otp_code = dom.find('input[name="code"]')[0].attrib['value']
-        except Exception as error:
-            resp.failure(
-                "There was a problem with the OTP code: {}.".format(error))
+        page = resp_to_page(resp)
+        otp_code = page.code
+        if not otp_code:
+            failures.report(
+                resp,
+                "There was a problem with the OTP code at {}.".format(
+                    resp.url
+                )
+            )
             return
 
     # visit security code page and submit pre-filled OTP
@@ -308,20 +286,19 @@ def signup(t, signup_url=None):
         '/login/two_factor/sms',
         data={
             'code': otp_code,
-            'authenticity_token': authenticity_token(dom),
+            'authenticity_token': page.authenticity_token(),
             'commit': 'Submit',
         },
         auth=auth
     )
-    dom = resp_to_dom(resp)
-    key = dom.find('.my4.border-box.separator-text').text()
+    page = resp_to_page(resp)
 
     # Clicking "Continue" on key page triggers a modal, to which we post:
     resp = t.client.post(
         '/sign_up/personal_key',
         data={
-            'authenticity_token': authenticity_token(dom, '#confirm-key'),
-            'personal_key': key,
+            'authenticity_token': page.authenticity_token('#confirm-key'),
+            'personal_key': page.personal_key,
             'commit': 'Continue'
         },
         auth=auth
@@ -329,16 +306,47 @@ def signup(t, signup_url=None):
     # We should now be fully signed in and will return
     # credentials + final page in case we with to log in again.
     return {
-        'email': new_email,
+        'email': email,
         'password': default_password,
+        'identity': identity,
         'final_resp': resp
     }
 
 
-class UserBehavior(locust.TaskSet):
+# Signed-in sessions for idp_signed_in_pages, which only runs when
+# SIGNED_IN_WEIGHT is set; see sessions.py.
+session_pool = sessions.SessionPool.from_env(leases, login)
+SIGNED_IN_WEIGHT = int(os.getenv('SIGNED_IN_WEIGHT', 0))
+# Identity verification; see verify.py.
+VERIFY_WEIGHT = int(os.getenv('VERIFY_WEIGHT', 0))
+VERIFY_ACCOUNTS = os.getenv('VERIFY_ACCOUNTS', 'signup')
+
+
+class UserBehavior(arrivals.OpenLoopTaskSet):
 
     def on_start(self):
-        pass
+        if UserBehavior.idp_signed_in_pages in self.tasks:
+            session_pool.warm_up(self)
+
+    @locust.task(SIGNED_IN_WEIGHT)
+    def idp_signed_in_pages(self):
+        """
+        Visit the account pages as a user who is already signed in,
+        borrowing a session from the pool rather than logging in.
+
+        Set SIGNED_IN_WEIGHT (e.g. 50, like idp_login_logout) to run it.
+        """
+        with session_pool.borrow(self) as session:
+            resp = self.client.get('/account')
+            if '/account' not in resp.url:
+                # Signed out behind our back; sign in again next time.
+                session.invalidate()
+                return
+            edit_link = resp_to_page(resp).link(
+                '/manage/password', exact=True
+            )
+            if edit_link:
+                resp_to_page(self.client.get(edit_link))
 
     @locust.task(1)
     def idp_change_pass(self):
@@ -348,21 +356,19 @@ class UserBehavior(locust.TaskSet):
         This is given a very low weight, since we do not expect
         it to be a common pattern in the real world.
         """
-        credentials = random_cred()
-        login(self, credentials)
-        change_pass(self, "thisisanewpass")
-        # now change it back.
-        change_pass(self, credentials['password'])
-        logout(self)
+        with leases.lease() as credentials:
+            login(self, credentials)
+            change_pass_and_back(self, credentials)
+            logout(self)
 
     @locust.task(50)
     def idp_login_logout(self):
         """
         Login and logout from IDP. Very simple, but very common.
         """
-        credentials = random_cred()
-        login(self, credentials)
-        logout(self)
+        with leases.lease() as credentials:
+            login(self, credentials)
+            logout(self)
 
     @locust.task(10)
     def idp_create_account(self):
@@ -374,6 +380,27 @@ class UserBehavior(locust.TaskSet):
         new_account = signup(self)
         logout(self, new_account['final_resp'].url)
 
+    @locust.task(VERIFY_WEIGHT)
+    def idp_verify(self):
+        """
+        Verify a user's identity against the mock vendors, then logout.
+
+        Set VERIFY_WEIGHT (e.g. 5) to run it. Each run signs up a new
+        account unless VERIFY_ACCOUNTS=seeded, which leases an account
+        from `rake dev:random_users` instead; those can each only be
+        verified once per seeding.
+        """
+        if VERIFY_ACCOUNTS == 'seeded':
+            with leases.lease() as credentials:
+                if login(self, credentials):
+                    verify.verify(self, credentials)
+                    logout(self)
+            return
+        credentials = signup(self)
+        if credentials:
+            verify.verify(self, credentials)
+            logout(self)
+
     @locust.task(2)
     def sp_rails_change_pass(self):
         """
@@ -405,12 +432,10 @@ class UserBehavior(locust.TaskSet):
         )
         # For now, we're taking advantage of login() going to host + /sign_in
         """
-        credentials = random_cred()
-        login(self, credentials)
-        change_pass(self, "thisisanewpass")
-        # now change it back.
-        change_pass(self, credentials['password'])
-        logout(self)
+        with leases.lease() as credentials:
+            login(self, credentials)
+            change_pass_and_back(self, credentials)
+            logout(self)
 
     #@locust.task(10)
     def usajobs_change_pass(self):
@@ -425,7 +450,8 @@ class UserBehavior(locust.TaskSet):
             ).eq(0)
 
             if not signin_link:
-                resp.failure(
+                failures.report(
+                    resp,
                     "We could not find a signin link at {}".format(resp.url))
 
         transition_resp = self.client.get(
@@ -434,21 +460,21 @@ class UserBehavior(locust.TaskSet):
         )
         with transition_resp as resp:
             if resp.status_code is not 200:
-                resp.failure(
-                    "Bad {} response at {} with headers {}. Response:".format(
-                        resp.status_code, resp.url, resp.headers, resp.content
-                    )
+                failures.report(
+                    resp,
+                    "Bad {} response at {}.".format(resp.status_code, resp.url)
                 )
             # we should have been redirected to
             # https://login.test.usajobs.gov/Access/Transition.
             # Let's do a quick check.
             if "login.test.usajobs.gov/Access/Transition" not in resp.url:
-                resp.failure(
+                failures.report(
+                    resp,
                     """"
                     We do not appear to have been redirected to
                     https://login.test.usajobs.gov/Access/Transition.
-                    Our current URL is {}, with content {}.
-                    """.format(resp.url, resp.content)
+                    Our current URL is {}.
+                    """.format(resp.url)
                 )
                 return
         # Now that we've confirmed we're at the right URL
@@ -463,18 +489,18 @@ class UserBehavior(locust.TaskSet):
             # Check to make sure we redirected to our target host,
             # with a request_id in resp.url
             if resp.url is not os.getenv('TARGET_HOST'):
-                resp.failure(
+                failures.report(
+                    resp,
                     """"
                     We do not appear to have been redirected to the IDP host.
                     Instead, we are at {}.
                     """.format(resp.url)
                 )
                 return
-        credentials = random_cred()
-        login(self, credentials)
-        change_pass(self, "thisisanewpass")
-        change_pass(self, credentials['password'])
-        logout(self)
+        with leases.lease() as credentials:
+            login(self, credentials)
+            change_pass_and_back(self, credentials)
+            logout(self)
 
     #@locust.task(70)
     def usajobs_login_logout(self):
@@ -491,7 +517,8 @@ class UserBehavior(locust.TaskSet):
             ).eq(0)
 
             if not signin_link:
-                resp.failure(
+                failures.report(
+                    resp,
                     "We could not find a signin link at {}".format(resp.url)
                 )
 
@@ -501,21 +528,21 @@ class UserBehavior(locust.TaskSet):
         )
         with sign_in_resp as resp:
             if resp.status_code is not 200:
-                resp.failure(
-                    "Bad {} response at {} with headers {}. Response:".format(
-                        resp.status_code, resp.url, resp.headers, resp.content
-                    )
+                failures.report(
+                    resp,
+                    "Bad {} response at {}.".format(resp.status_code, resp.url)
                 )
             # we should have been redirected to
             # https://login.test.usajobs.gov/Access/Transition.
             # Let's do a quick check.
             if "login.test.usajobs.gov/Access/Transition" not in resp.url:
-                resp.failure(
+                failures.report(
+                    resp,
                     """"
                     We do not appear to have been redirected to
                     https://login.test.usajobs.gov/Access/Transition.
-                    Our current URL is {}, with content {}.
-                    """.format(resp.url, resp.content)
+                    Our current URL is {}.
+                    """.format(resp.url)
                 )
                 return
         # Now that we've confirmed we're at the right URL
@@ -530,16 +557,17 @@ class UserBehavior(locust.TaskSet):
             # Check to make sure we redirected to our target host,
             # with a request_id in resp.url
             if resp.url is not os.getenv('TARGET_HOST'):
-                resp.failure(
+                failures.report(
+                    resp,
                     """"
                     We do not appear to have been redirected to the IDP host.
                     Instead, we are at {}.
                     """.format(resp.url)
                 )
                 return
-        credentials = random_cred()
-        login(self, credentials)
-        logout(self)
+        with leases.lease() as credentials:
+            login(self, credentials)
+            logout(self)
 
     #@locust.task(25)
     def usajobs_create_account(self):
@@ -565,10 +593,9 @@ class UserBehavior(locust.TaskSet):
         )
         with dash_response as resp:
             if resp.status_code is not 200:
-                resp.failure(
-                    "Bad {} response at {} with the headers {}: {}".format(
-                        resp.status_code, resp.url, resp.headers, resp.content
-                    )
+                failures.report(
+                    resp,
+                    "Bad {} response at {}.".format(resp.status_code, resp.url)
                 )
                 resp.raise_for_status()
         # A quick post is required to setup for the SP handshake.
@@ -583,10 +610,9 @@ class UserBehavior(locust.TaskSet):
         )
         with handshake_post as resp:
             if resp.status_code is not 200:
-                resp.failure(
-                    "Bad {} response at {} with the headers {}".format(
-                        resp.status_code, resp.url, resp.headers
-                    )
+                failures.report(
+                    resp,
+                    "Bad {} response at {}.".format(resp.status_code, resp.url)
                 )
                 resp.raise_for_status()
             signup(self, resp.url)
@@ -598,12 +624,38 @@ class UserBehavior(locust.TaskSet):
             logout(self)
 
 
-class WebsiteUser(locust.HttpLocust):
-    task_set = UserBehavior
+# WORKLOAD_PROFILE replaces the @task weights above, and the think time
+# below, with ones measured from production logs; see workload.py.
+if os.getenv('WORKLOAD_PROFILE'):
+    workload.apply(UserBehavior, workload.load(os.getenv('WORKLOAD_PROFILE')))
+
+
+# HTTP_ENGINE=fast runs the same flows on the non-blocking client in
+# fasthttp.py, for runs with many thousands of users per process.
+if os.getenv('HTTP_ENGINE') == 'fast':
+    BaseLocust = fasthttp.FastHttpLocust
+else:
+    BaseLocust = locust.HttpLocust
+
+
+class WebsiteUser(BaseLocust):
+    # REPLAY runs recorded journeys instead of the tasks; see replay.py.
+    task_set = replay.replay_tasks(leases) if os.getenv('REPLAY') \
+        else UserBehavior
     min_wait = 50
     max_wait = 100
     host = os.getenv('TARGET_HOST') or 'http://localhost:3000'
 
+    def __init__(self):
+        super(WebsiteUser, self).__init__()
+        if not isinstance(self.client, fasthttp.FastHttpSession):
+            # FastHttpSession reports its redirect hops itself.
+            transactions.instrument(self.client)
+        if os.getenv('ASSETS'):
+            assets.fetch_with(self.client)
+        if os.getenv('RECORD'):
+            replay.record(self.client)
+
 
 if __name__ == '__main__':
     WebsiteUser().run()
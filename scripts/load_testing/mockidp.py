@@ -0,0 +1,608 @@
+"""
+A stand-in IdP, for measuring the load test harness itself offline.
+
+Against the real Rails app we can't tell whether a throughput ceiling is
+the IdP's or the load generator's. This serves the recorded pages in
+fixtures/ and the redirects between them, just enough for login(),
+logout(), change_pass(), signup(), verify() and the OIDC and SAML tasks
+to run, with a session cookie and nothing else behind it, so it can serve many
+times what one locust process can send. Point the harness at it to measure its
+own requests per second per core and parse overhead with no network
+involved.
+
+Responses can be slowed down and made to fail on purpose:
+
+* --latency MS and --jitter MS: every response takes MS plus a uniformly
+  random 0-jitter ms.
+* --route-latency PATH=MS: a different latency for one path; repeatable.
+* --error-rate FRACTION: that fraction of responses are a 500.
+
+The pages' stylesheets, scripts and images are served too, with made-up
+bodies of about the real size, for assets.py. Fingerprinted ones are
+cacheable for a year and the rest must be revalidated; either way a
+matching If-None-Match gets a 304.
+
+Usage:
+python mockidp.py [--port 3000] [--latency 0] [--jitter 0] \
+    [--error-rate 0] [--route-latency /login/two_factor/sms=200]
+locust -f locustfile.py -H http://127.0.0.1:3000 --no-web -c 100 -r 100
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import base64  # noqa: E402
+import hashlib  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import random  # noqa: E402
+import re  # noqa: E402
+import socket  # noqa: E402
+import sys  # noqa: E402
+import uuid  # noqa: E402
+import zlib  # noqa: E402
+from http.cookies import SimpleCookie  # noqa: E402
+from html import escape  # noqa: E402
+from urllib.parse import parse_qs, urlencode  # noqa: E402
+from xml.etree import ElementTree  # noqa: E402
+
+import gevent  # noqa: E402
+from gevent.pywsgi import WSGIHandler, WSGIServer  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+SESSION_COOKIE = '_upaya_session'
+
+# The host baked into links on the recorded pages.
+RECORDED_HOST = b'http://localhost:3000'
+
+SAML_PROTOCOL = '{urn:oasis:names:tc:SAML:2.0:protocol}'
+
+SAML_RESPONSE = (
+    '<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol"'
+    ' xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"'
+    ' ID="_{id}" Version="2.0" InResponseTo="{in_response_to}">'
+    '<saml:Issuer>{idp}/api/saml</saml:Issuer>'
+    '<samlp:Status><samlp:StatusCode'
+    ' Value="urn:oasis:names:tc:SAML:2.0:status:Success"/></samlp:Status>'
+    '<saml:Assertion ID="_{assertion_id}" Version="2.0">'
+    '<saml:Issuer>{idp}/api/saml</saml:Issuer>'
+    '<saml:Subject><saml:NameID>{name_id}</saml:NameID></saml:Subject>'
+    '<saml:AuthnStatement SessionIndex="_{session_index}"/>'
+    '<saml:AttributeStatement><saml:Attribute Name="email">'
+    '<saml:AttributeValue>testuser@example.com</saml:AttributeValue>'
+    '</saml:Attribute></saml:AttributeStatement>'
+    '</saml:Assertion></samlp:Response>'
+)
+
+SAML_LOGOUT_RESPONSE = (
+    '<samlp:LogoutResponse xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol"'
+    ' xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"'
+    ' ID="_{id}" Version="2.0" InResponseTo="{in_response_to}">'
+    '<saml:Issuer>{idp}/api/saml</saml:Issuer>'
+    '<samlp:Status><samlp:StatusCode'
+    ' Value="urn:oasis:names:tc:SAML:2.0:status:Success"/></samlp:Status>'
+    '</samlp:LogoutResponse>'
+)
+
+# Static files the pages link to, and the fonts the stylesheet loads.
+ASSET = re.compile(r'^/(?:(?:assets|packs)/.+|[\w-]+)\.(\w+)$')
+FINGERPRINT = re.compile(r'-[0-9a-f]{32,}\.\w+$')
+ASSET_TYPES = {
+    'css': ('text/css', 40000),
+    'js': ('application/javascript', 120000),
+    'png': ('image/png', 4000),
+    'svg': ('image/svg+xml', 2000),
+    'ico': ('image/x-icon', 1000),
+    'woff2': ('font/woff2', 20000),
+}
+FONTS = (
+    '/assets/fonts/source-sans-pro-regular-'
+    '0b4b8a1f1fd9c4a2b8c0e9fa7b6e3c1a8f2d4e6b.woff2',
+    '/assets/fonts/merriweather-bold-'
+    '5e1d8c3b7a9f2e4d6c8b0a1f3e5d7c9b2a4f6e8d.woff2',
+)
+
+# The /verify/* pages have no recordings; these carry just the fields
+# verify.py reads.
+FORM_PAGE = (
+    '<!DOCTYPE html><html><head>{head}</head><body>'
+    '<form action="{action}" method="post">'
+    '<input type="hidden" name="authenticity_token" value="mock-token">'
+    '{inputs}<input type="submit" name="commit" value="Continue">'
+    '</form></body></html>'
+)
+
+POST_BINDING = (
+    '<!DOCTYPE html><html><body>'
+    '<form action="{action}" method="POST" id="saml-post-binding">'
+    '<input type="hidden" name="SAMLResponse" value="{message}">'
+    '{relay_state}'
+    '<input type="submit" name="commit" value="Submit">'
+    '</form></body></html>'
+)
+
+
+def load_fixtures():
+    pages = {}
+    for filename in os.listdir(FIXTURES):
+        if filename.endswith('.html'):
+            with open(os.path.join(FIXTURES, filename), 'rb') as f:
+                pages[filename[:-len('.html')]] = f.read()
+    return pages
+
+
+class MockIdP(object):
+    """
+    The WSGI app. Sessions live in memory for as long as it runs.
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0,
+                 route_latency=None, rng=random):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.route_latency = route_latency or {}
+        self.rng = rng
+        self.pages = load_fixtures()
+        self.sessions = {}
+        # OIDC authorization codes and access tokens that are still good.
+        self.codes = {}
+        self.access_tokens = {}
+        # SSNs on active profiles, for the duplicate check.
+        self.ssns = set()
+        self.served = 0
+        self.routes = {
+            ('GET', '/'): self.sign_in,
+            ('POST', '/'): self.create_session,
+            ('GET', '/login/two_factor/sms'): self.two_factor,
+            ('POST', '/login/two_factor/sms'): self.verify_otp,
+            ('GET', '/account'): self.account,
+            ('GET', '/manage/password'): self.manage_password,
+            ('PATCH', '/manage/password'): self.update_password,
+            ('GET', '/api/saml/auth'): self.saml_auth,
+            ('GET', '/api/saml/logout'): self.logout,
+            ('POST', '/api/saml/logout'): self.logout,
+            ('DELETE', '/api/saml/logout'): self.logout,
+            ('GET', '/sign_up/start'): self.page('sign_up_enter_email'),
+            ('GET', '/sign_up/enter_email'): self.page('sign_up_enter_email'),
+            ('POST', '/sign_up/enter_email'): self.register,
+            ('GET', '/sign_up/verify_email'): self.verify_email,
+            ('GET', '/sign_up/email/confirm'):
+                self.page('sign_up_enter_password'),
+            ('POST', '/sign_up/create_password'): self.create_password,
+            ('GET', '/phone_setup'): self.page('phone_setup'),
+            ('PATCH', '/phone_setup'): self.set_phone,
+            ('GET', '/sign_up/personal_key'):
+                self.page('sign_up_personal_key'),
+            ('POST', '/sign_up/personal_key'): self.redirect('/account'),
+            ('GET', '/openid_connect/authorize'): self.authorize,
+            ('POST', '/api/openid_connect/token'): self.token,
+            ('GET', '/api/openid_connect/userinfo'): self.userinfo,
+            ('GET', '/verify'): self.verify_page(None),
+            ('GET', '/verify/session'): self.verify_session,
+            ('PUT', '/verify/session'): self.submit_profile,
+            ('GET', '/verify/session/result'):
+                self.vendor_result('/verify/address'),
+            ('GET', '/verify/session/dupe'): self.verify_page(None),
+            ('GET', '/verify/address'): self.verify_page('/verify/address'),
+            ('POST', '/verify/address'): self.redirect('/verify/phone'),
+            ('GET', '/verify/phone'): self.verify_page(
+                '/verify/phone', idv_phone_form__phone='+1 415-555-0199'
+            ),
+            ('PUT', '/verify/phone'): self.submit_phone,
+            ('GET', '/verify/phone/result'):
+                self.vendor_result('/verify/review'),
+            ('GET', '/verify/review'): self.verify_page(
+                '/verify/review', user__password=''
+            ),
+            ('PUT', '/verify/review'): self.activate_profile,
+            ('GET', '/verify/confirmations'):
+                self.verify_page('/verify/confirmations'),
+            ('POST', '/verify/confirmations'): self.redirect('/account'),
+            ('GET', '/verify/activated'): self.verify_page(None),
+            ('GET', '/api/health'): self.health,
+            ('GET', '/api/health/database'): self.health,
+            ('GET', '/api/health/workers'): self.health,
+        }
+
+    def __call__(self, environ, start_response):
+        self.served += 1
+        path = environ.get('PATH_INFO') or '/'
+        delay = self.route_latency.get(path, self.latency)
+        if self.jitter:
+            delay += self.rng.uniform(0, self.jitter)
+        if delay:
+            gevent.sleep(delay / 1000.0)
+
+        if self.error_rate and self.rng.random() < self.error_rate:
+            start_response('500 Internal Server Error', [
+                ('Content-Type', 'text/plain'),
+            ])
+            return [b'Injected error']
+
+        method = environ['REQUEST_METHOD']
+        form = {}
+        if method == 'POST':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            form = parse_qs(environ['wsgi.input'].read(length).decode())
+            # Rails' hidden _method field, for the PATCH forms.
+            method = form.get('_method', [method])[0].upper()
+
+        if method == 'GET' and ASSET.match(path):
+            return self.asset(environ, start_response, path)
+
+        handler = self.routes.get((method, path))
+        if handler is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not found']
+
+        session_id = self._session_id(environ)
+        session = self.sessions.get(session_id)
+        headers = []
+        if session is None:
+            session_id = uuid.uuid4().hex
+            session = self.sessions[session_id] = {}
+            headers.append(('Set-Cookie', '{}={}; path=/; HttpOnly'.format(
+                SESSION_COOKIE, session_id
+            )))
+
+        environ['mockidp.form'] = form
+        status, more_headers, body = handler(environ, session)
+        if session.get('deleted'):
+            del self.sessions[session_id]
+            headers.append(('Set-Cookie', '{}=; path=/; max-age=0'.format(
+                SESSION_COOKIE
+            )))
+        start_response(status, headers + more_headers + [
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    def asset(self, environ, start_response, path):
+        content_type, size = ASSET_TYPES.get(
+            ASSET.match(path).group(1), ('application/octet-stream', 1000)
+        )
+        etag = '"{}"'.format(hashlib.md5(path.encode()).hexdigest())
+        headers = [('ETag', etag), ('Cache-Control', (
+            'public, max-age=31536000' if FINGERPRINT.search(path)
+            else 'max-age=0, must-revalidate'
+        ))]
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            start_response('304 Not Modified', headers)
+            return [b'']
+        body = b''
+        if content_type == 'text/css':
+            body = ''.join(
+                '@font-face{{src:url({})}}'.format(font) for font in FONTS
+            ).encode()
+        body += b'x' * (size - len(body))
+        start_response('200 OK', headers + [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+    def _session_id(self, environ):
+        cookie = environ.get('HTTP_COOKIE')
+        if not cookie:
+            return None
+        morsel = SimpleCookie(cookie).get(SESSION_COOKIE)
+        return morsel.value if morsel else None
+
+    def _page(self, name, environ):
+        body = self.pages[name]
+        if RECORDED_HOST in body:
+            host = self._host(environ)
+            body = body.replace(RECORDED_HOST, host.encode())
+        return '200 OK', [('Content-Type', 'text/html; charset=utf-8')], body
+
+    def _redirect(self, location):
+        return '302 Found', [('Location', location)], b''
+
+    def page(self, name):
+        return lambda environ, session: self._page(name, environ)
+
+    def redirect(self, location):
+        return lambda environ, session: self._redirect(location)
+
+    def sign_in(self, environ, session):
+        if session.get('signed_in'):
+            return self._redirect('/account')
+        return self._page('sign_in', environ)
+
+    def create_session(self, environ, session):
+        session['pending'] = 'login'
+        return self._redirect('/login/two_factor/sms')
+
+    def two_factor(self, environ, session):
+        if not session.get('pending'):
+            return self._redirect('/')
+        return self._page('login_two_factor_sms', environ)
+
+    def verify_otp(self, environ, session):
+        pending = session.pop('pending', None)
+        if not pending:
+            return self._redirect('/')
+        session['signed_in'] = True
+        if pending == 'signup':
+            return self._redirect('/sign_up/personal_key')
+        if 'return_to' in session:
+            return self._redirect(session.pop('return_to'))
+        return self._redirect('/account')
+
+    def account(self, environ, session):
+        if not session.get('signed_in'):
+            return self._redirect('/')
+        return self._page('account', environ)
+
+    def manage_password(self, environ, session):
+        if not session.get('signed_in'):
+            return self._redirect('/')
+        return self._page('manage_password', environ)
+
+    def update_password(self, environ, session):
+        return self._redirect('/account')
+
+    def logout(self, environ, session):
+        session['deleted'] = True
+        params = parse_qs(environ.get('QUERY_STRING', ''))
+        if 'SAMLRequest' in params:
+            request = self._saml_request(params)
+            if request is None:
+                return '400 Bad Request', [], b'Unsigned SAMLRequest'
+            return self._post_binding(environ, SAML_LOGOUT_RESPONSE.format(
+                id=uuid.uuid4().hex,
+                in_response_to=request.get('ID'),
+                idp=self._host(environ),
+            ))
+        return self._redirect('/')
+
+    def register(self, environ, session):
+        return self._redirect('/sign_up/verify_email')
+
+    def verify_email(self, environ, session):
+        return self._page('sign_up_verify_email', environ)
+
+    def create_password(self, environ, session):
+        return self._redirect('/phone_setup')
+
+    def set_phone(self, environ, session):
+        session['pending'] = 'signup'
+        return self._redirect('/login/two_factor/sms')
+
+    def _return_after_sign_in(self, environ, session):
+        session['return_to'] = '{}?{}'.format(
+            environ['PATH_INFO'], environ.get('QUERY_STRING', '')
+        )
+        return self._redirect('/')
+
+    def authorize(self, environ, session):
+        params = parse_qs(environ.get('QUERY_STRING', ''))
+        if not session.get('signed_in'):
+            return self._return_after_sign_in(environ, session)
+        code = uuid.uuid4().hex
+        self.codes[code] = params.get('code_challenge', [None])[0]
+        return self._redirect('{}?{}'.format(
+            params['redirect_uri'][0],
+            urlencode({'code': code, 'state': params['state'][0]})
+        ))
+
+    def token(self, environ, session):
+        form = environ['mockidp.form']
+        code = form.get('code', [None])[0]
+        if code not in self.codes:
+            return self._json('400 Bad Request', {'error': 'Invalid code'})
+        challenge = self.codes.pop(code)
+        if challenge:
+            verifier = form.get('code_verifier', [''])[0].encode()
+            expected = base64.urlsafe_b64encode(
+                hashlib.sha256(verifier).digest()
+            ).rstrip(b'=').decode()
+            if expected != challenge:
+                return self._json('400 Bad Request', {
+                    'error': 'Invalid code_verifier'
+                })
+        elif not form.get('client_assertion'):
+            return self._json('400 Bad Request', {
+                'error': 'Missing client_assertion'
+            })
+        access_token = uuid.uuid4().hex
+        self.access_tokens[access_token] = True
+        return self._json('200 OK', {
+            'access_token': access_token,
+            'token_type': 'Bearer',
+            'expires_in': 900,
+            'id_token': 'mock',
+        })
+
+    def userinfo(self, environ, session):
+        access_token = environ.get('HTTP_AUTHORIZATION', '')[len('Bearer '):]
+        if access_token not in self.access_tokens:
+            return self._json('401 Unauthorized', {
+                'error': 'Invalid access token'
+            })
+        return self._json('200 OK', {
+            'sub': access_token,
+            'iss': self._host(environ),
+            'email': 'testuser@example.com',
+            'email_verified': True,
+        })
+
+    def _host(self, environ):
+        return 'http://' + environ.get('HTTP_HOST', 'localhost')
+
+    def _saml_request(self, params):
+        """
+        The root element of a redirect-binding SAMLRequest, or None if it
+        isn't signed. The signature itself isn't checked.
+        """
+        if 'Signature' not in params or 'SigAlg' not in params:
+            return None
+        xml = zlib.decompress(
+            base64.b64decode(params['SAMLRequest'][0]), -15
+        )
+        return ElementTree.fromstring(xml)
+
+    def _post_binding(self, environ, xml, relay_state=None):
+        relay = ''
+        if relay_state:
+            relay = (
+                '<input type="hidden" name="RelayState" value="{}">'.format(
+                    escape(relay_state)
+                )
+            )
+        body = POST_BINDING.format(
+            action=self._host(environ) + '/test/saml/decode_assertion',
+            message=base64.b64encode(xml.encode()).decode(),
+            relay_state=relay,
+        )
+        return '200 OK', [('Content-Type', 'text/html; charset=utf-8')], (
+            body.encode()
+        )
+
+    def saml_auth(self, environ, session):
+        params = parse_qs(environ.get('QUERY_STRING', ''))
+        request = self._saml_request(params)
+        if request is None or request.tag != SAML_PROTOCOL + 'AuthnRequest':
+            return '400 Bad Request', [], b'Unsigned or not an AuthnRequest'
+        if not session.get('signed_in'):
+            return self._return_after_sign_in(environ, session)
+        return self._post_binding(environ, SAML_RESPONSE.format(
+            id=uuid.uuid4().hex,
+            assertion_id=uuid.uuid4().hex,
+            session_index=uuid.uuid4().hex,
+            in_response_to=request.get('ID'),
+            name_id=session.setdefault('name_id', str(uuid.uuid4())),
+            idp=self._host(environ),
+        ), params.get('RelayState', [None])[0])
+
+    def _form_page(self, action, fields=None, refresh=None):
+        head = ''
+        if refresh is not None:
+            head = '<meta http-equiv="refresh" content="{}">'.format(refresh)
+        inputs = ''.join(
+            '<input name="{}" value="{}">'.format(escape(k), escape(v))
+            for k, v in sorted((fields or {}).items())
+        )
+        return '200 OK', [('Content-Type', 'text/html; charset=utf-8')], (
+            FORM_PAGE.format(head=head, action=action or '', inputs=inputs)
+            .encode()
+        )
+
+    def verify_page(self, action, **fields):
+        # Field names with brackets can't be keywords: a__b is a[b].
+        fields = dict(
+            (re.sub(r'__(\w+)', r'[\1]', k), v) for k, v in fields.items()
+        )
+
+        def handler(environ, session):
+            if not session.get('signed_in'):
+                return self._redirect('/')
+            return self._form_page(action, fields)
+        return handler
+
+    def verify_session(self, environ, session):
+        if not session.get('signed_in'):
+            return self._redirect('/')
+        if session.get('verified'):
+            return self._redirect('/verify/activated')
+        return self._form_page('/verify/session')
+
+    def submit_profile(self, environ, session):
+        ssn = environ['mockidp.form'].get('profile[ssn]', [''])[0]
+        if ssn in self.ssns:
+            return self._redirect('/verify/session/dupe')
+        session['idv'] = {'ssn': ssn}
+        session['vendor_pending'] = True
+        return self._redirect('/verify/session/result')
+
+    def submit_phone(self, environ, session):
+        session['vendor_pending'] = True
+        return self._redirect('/verify/phone/result')
+
+    def vendor_result(self, next_step):
+        def handler(environ, session):
+            # The first look at a result finds the vendor job still
+            # running, like the IdP's refresh page.
+            if session.pop('vendor_pending', False):
+                return self._form_page(None, refresh=0)
+            return self._redirect(next_step)
+        return handler
+
+    def activate_profile(self, environ, session):
+        self.ssns.add(session.get('idv', {}).get('ssn'))
+        session['verified'] = True
+        return self._redirect('/verify/confirmations')
+
+    def _json(self, status, data):
+        return status, [('Content-Type', 'application/json')], json.dumps(
+            data
+        ).encode()
+
+    def health(self, environ, session):
+        return self._json('200 OK', {'healthy': True, 'statuses': {}})
+
+
+class NoDelayHandler(WSGIHandler):
+    """
+    pywsgi writes headers and body separately, and with Nagle on that
+    costs a delayed ACK, about 40ms, on every keep-alive request.
+    """
+
+    def handle(self):
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return WSGIHandler.handle(self)
+
+
+def serve(app, host='127.0.0.1', port=3000):
+    """
+    Starts serving app in the background and returns the server.
+    """
+    server = WSGIServer(
+        (host, port), app, log=None, handler_class=NoDelayHandler
+    )
+    server.start()
+    return server
+
+
+def route_latency(spec):
+    path, _, ms = spec.partition('=')
+    return path, float(ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='ms added to every response')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='up to this many more random ms per response')
+    parser.add_argument('--route-latency', type=route_latency,
+                        action='append', default=[], metavar='PATH=MS',
+                        help='latency for one path instead of --latency')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of responses that are a 500')
+    args = parser.parse_args()
+
+    app = MockIdP(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        route_latency=dict(args.route_latency),
+    )
+    server = serve(app, args.host, args.port)
+    sys.stderr.write('Mock IdP on http://{}:{}\n'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.stderr.write('Served {} requests.\n'.format(app.served))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""
+OpenID Connect sign-ins, as a stand-in relying party.
+
+Each task runs authorize -> login -> token -> userinfo the way a partner
+does: the browser side through /openid_connect/authorize and sign-in,
+stopping at the redirect back to the relying party, then the server
+side posting the code to /api/openid_connect/token and fetching
+/api/openid_connect/userinfo with the access token. Every leg is a flow
+of its own (see transactions.py) as well as a step of the whole
+oidc_sign_in transaction.
+
+Clients authenticate with private_key_jwt when OIDC_PRIVATE_KEY names
+the client's PEM private key, and with PKCE otherwise, as a native app
+would. Either way the signing and hashing happens ahead of time: a few
+producer greenlets keep a buffer of fresh client assertions and PKCE
+pairs topped up (see precomputed.py), so client-side crypto never sits
+between one request and the next.
+
+Settings:
+* OIDC_CLIENT_ID and OIDC_REDIRECT_URI: a client registered in
+  config/service_providers.yml; default to the development PKCE client.
+* OIDC_PRIVATE_KEY: path to the client's private key, for
+  private_key_jwt, e.g. OIDC_CLIENT_ID=urn:gov:gsa:openidconnect:sp:sinatra
+  with the sinatra sample SP's key.
+* OIDC_SCOPE and OIDC_ACR_VALUES: default to 'openid email' and LOA1.
+
+Usage:
+make load_test type=oidc
+"""
+import base64
+import hashlib
+import os
+import time
+import uuid
+from urllib.parse import parse_qs, urlencode, urljoin, urlsplit
+
+import jwt
+from jwt.algorithms import RSAAlgorithm
+import locust
+from locust.exception import ResponseError
+
+import arrivals
+import locustfile
+from precomputed import Precomputed
+import transactions
+
+CLIENT_ID = os.getenv(
+    'OIDC_CLIENT_ID', 'urn:gov:gsa:openidconnect:development'
+)
+REDIRECT_URI = os.getenv(
+    'OIDC_REDIRECT_URI', 'gov.gsa.openidconnect.development://result'
+)
+PRIVATE_KEY = os.getenv('OIDC_PRIVATE_KEY')
+SCOPE = os.getenv('OIDC_SCOPE', 'openid email')
+ACR_VALUES = os.getenv(
+    'OIDC_ACR_VALUES', 'http://idmanagement.gov/ns/assurance/loa/1'
+)
+
+CLIENT_ASSERTION_TYPE = (
+    'urn:ietf:params:oauth:client-assertion-type:jwt-bearer'
+)
+
+# How long a client assertion is valid for, and how old one can get in
+# the buffer before it's thrown away unused.
+ASSERTION_LIFETIME = 300
+ASSERTION_MAX_AGE = 120
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+def random_value():
+    """
+    A state or nonce: the IdP wants at least 32 characters.
+    """
+    return uuid.uuid4().hex
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def pkce_pair():
+    """
+    A (code_verifier, S256 code_challenge) pair.
+    """
+    verifier = b64url(os.urandom(32))
+    challenge = b64url(hashlib.sha256(verifier.encode('ascii')).digest())
+    return verifier, challenge
+
+
+class ClientAssertions(object):
+    """
+    Makes private_key_jwt client assertions for one client and token URL.
+    """
+
+    def __init__(self, client_id, token_url, key_path):
+        self.client_id = client_id
+        self.token_url = token_url
+        # Parsed once: from PEM, the key is loaded and checked again on
+        # every encode, which costs a hundred times the signature.
+        with open(key_path, 'rb') as f:
+            self.key = RSAAlgorithm(RSAAlgorithm.SHA256).prepare_key(f.read())
+
+    def __call__(self):
+        now = int(time.time())
+        token = jwt.encode({
+            'iss': self.client_id,
+            'sub': self.client_id,
+            'aud': self.token_url,
+            'jti': random_value(),
+            'iat': now,
+            'exp': now + ASSERTION_LIFETIME,
+        }, self.key, algorithm='RS256')
+        # PyJWT 1.x returns bytes, 2.x str.
+        return token.decode('ascii') if isinstance(token, bytes) else token
+
+
+# Made on first use, once the target host is known.
+_pkce = None
+_assertions = None
+
+
+def pkce_buffer():
+    global _pkce
+    if _pkce is None:
+        _pkce = Precomputed('pkce', pkce_pair)
+    return _pkce
+
+
+def assertion_buffer(host):
+    global _assertions
+    if _assertions is None:
+        _assertions = Precomputed(
+            'client_assertion',
+            ClientAssertions(
+                CLIENT_ID, host.rstrip('/') + '/api/openid_connect/token',
+                PRIVATE_KEY
+            ),
+            max_age=ASSERTION_MAX_AGE,
+        )
+    return _assertions
+
+
+def is_redirect(resp):
+    return resp.status_code in REDIRECT_CODES and 'Location' in resp.headers
+
+
+def follow_to_relying_party(t, resp):
+    """
+    Follows redirects (and the first-time sharing consent page) from
+    resp until one points at REDIRECT_URI, and returns that URL.
+    """
+    for _ in range(10):
+        if is_redirect(resp):
+            location = urljoin(resp.url, resp.headers['Location'])
+            if location.startswith(REDIRECT_URI):
+                return location
+            # The authorize URLs carry a fresh state each time, so name
+            # the request by its path alone.
+            resp = t.client.get(
+                location, name=urlsplit(location).path or '/',
+                allow_redirects=False
+            )
+        elif '/sign_up/completed' in resp.url:
+            page = locustfile.resp_to_page(resp)
+            resp = t.client.post(
+                '/sign_up/completed',
+                data={
+                    'authenticity_token': page.authenticity_token(),
+                    'commit': 'Continue',
+                },
+                allow_redirects=False
+            )
+        else:
+            return None
+    return None
+
+
+@transactions.flow('oidc authorize')
+def authorize(t, state, nonce, code_challenge=None):
+    params = {
+        'client_id': CLIENT_ID,
+        'response_type': 'code',
+        'acr_values': ACR_VALUES,
+        'scope': SCOPE,
+        'redirect_uri': REDIRECT_URI,
+        'state': state,
+        'nonce': nonce,
+        'prompt': 'select_account',
+    }
+    if code_challenge:
+        params['code_challenge'] = code_challenge
+        params['code_challenge_method'] = 'S256'
+    return t.client.get(
+        '/openid_connect/authorize?' + urlencode(params),
+        name='/openid_connect/authorize',
+        allow_redirects=False
+    )
+
+
+@transactions.flow('oidc handoff')
+def handoff(t, resp, state):
+    """
+    The redirect back to the relying party, and the code it carries.
+    """
+    location = follow_to_relying_party(t, resp)
+    if location is None:
+        raise ResponseError(
+            'Never redirected back to {}; ended up at {}'.format(
+                REDIRECT_URI, resp.url
+            )
+        )
+    query = parse_qs(urlsplit(location).query)
+    if query.get('state') != [state]:
+        raise ResponseError(
+            'State mismatch in {}'.format(location)
+        )
+    return query['code'][0]
+
+
+@transactions.flow('oidc token')
+def token(t, code, code_verifier=None):
+    data = {
+        'grant_type': 'authorization_code',
+        'code': code,
+    }
+    if code_verifier:
+        data['code_verifier'] = code_verifier
+    else:
+        data['client_assertion_type'] = CLIENT_ASSERTION_TYPE
+        data['client_assertion'] = assertion_buffer(t.client.base_url).get()
+    resp = t.client.post(
+        '/api/openid_connect/token', data=data,
+        name='/api/openid_connect/token'
+    )
+    resp.raise_for_status()
+    return resp.json()['access_token']
+
+
+@transactions.flow('oidc userinfo')
+def userinfo(t, access_token):
+    resp = t.client.get(
+        '/api/openid_connect/userinfo',
+        headers={'Authorization': 'Bearer ' + access_token},
+        name='/api/openid_connect/userinfo'
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+
+class OIDCBehavior(arrivals.OpenLoopTaskSet):
+
+    @locust.task(1)
+    def oidc_sign_in(self):
+        """
+        A full relying party sign-in, then sign out of the IdP.
+        """
+        state, nonce = random_value(), random_value()
+        code_verifier = code_challenge = None
+        if not PRIVATE_KEY:
+            code_verifier, code_challenge = pkce_buffer().get()
+
+        with locustfile.leases.lease() as credentials:
+            resp = authorize(self, state, nonce, code_challenge)
+            if not (is_redirect(resp) and resp.headers['Location'].startswith(
+                REDIRECT_URI
+            )):
+                # Sent to sign in first, as expected when signed out.
+                resp = locustfile.login(
+                    self, credentials, allow_redirects=False
+                )
+                if resp is None:
+                    # login() already reported why.
+                    return
+            code = handoff(self, resp, state)
+            access_token = token(self, code, code_verifier)
+            userinfo(self, access_token)
+            locustfile.logout(self)
+
+
+class OIDCUser(locustfile.BaseLocust):
+    task_set = OIDCBehavior
+    min_wait = 50
+    max_wait = 100
+    host = os.getenv('TARGET_HOST') or 'http://localhost:3000'
+
+    def __init__(self):
+        super(OIDCUser, self).__init__()
+        if not isinstance(self.client, locustfile.fasthttp.FastHttpSession):
+            transactions.instrument(self.client)
@@ -0,0 +1,256 @@
+"""
+OTP sends paced to stay under the IdP's limit, so runs don't lock out
+their own users.
+
+The IdP counts SMS sends per phone number, and once a number has had
+otp_delivery_blocklist_maxretry of them with no gap as long as
+otp_delivery_blocklist_findtime minutes, the next sign-in locks the user
+out (see app/services/otp_rate_limiter.rb). Every sign-in sends one, and
+the seeded accounts share about a thousand numbers, so a fast enough run
+ends up measuring the lockout page instead of the 2FA path.
+
+Set OTP_PACING and each phone number gets a bucket of maxretry sends,
+less OTP_HEADROOM. Unlike a steady token bucket it only fills up again
+after findtime without a send, because that's when the IdP's count
+resets. Tasks leasing an account pass over those whose bucket is empty
+(rerouted), and wait for the first to fill if all of them are (delayed).
+A signup whose made-up number has no sends left draws another identity.
+Waits are recorded in the 'pacing' table and as an 'otp pacing' step of
+the journey, outside the login and signup flows, so those only time the
+2FA path itself.
+
+Buckets are per process. That's right when every process leases its own
+slice of the accounts (WORKER_INDEX and WORKER_COUNT, see creds.py), but
+not when several processes share one without them.
+
+Settings:
+* OTP_PACING: pace OTP sends.
+* OTP_MAXRETRY, OTP_FINDTIME: the limits, as the IdP has them (sends,
+  and minutes). By default they're read from OTP_CONFIG (the IdP's
+  config/application.yml, else config/application.yml.example), in its
+  OTP_CONFIG_ENV section (default 'development').
+* OTP_HEADROOM: sends to leave unused per bucket (default 1).
+
+Usage:
+OTP_PACING=1 OTP_CONFIG_ENV=production make load_test type=locustfile
+"""
+import os
+import re
+import time
+
+import gevent
+
+import creds
+import results
+import transactions
+
+CONFIG = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'config',
+    'application.yml'
+)
+SECTION = re.compile(r'^(\w+):\s*$')
+SETTING = re.compile(r'^\s+(\w+):\s*[\'"]?([^\'"#\s]*)')
+# Past findtime, to be sure the IdP sees the same gap we do.
+MARGIN = 1.0
+# Sends between sweeps of buckets that have filled up again.
+SWEEP_EVERY = 1000
+
+pacing_stats = results.table(
+    'pacing', 'OTP pacing (ms waited)', ('Outcome', 'Journey'), nested=True
+)
+
+
+def read_limits(path=None, env='development'):
+    """
+    (maxretry, findtime in minutes) from the env section of the IdP's
+    application.yml, or its .example.
+    """
+    if path is None:
+        path = CONFIG if os.path.exists(CONFIG) else CONFIG + '.example'
+    settings = {}
+    section = None
+    with open(path) as f:
+        for line in f:
+            match = SECTION.match(line)
+            if match:
+                section = match.group(1)
+                continue
+            match = SETTING.match(line)
+            if match and section == env:
+                settings[match.group(1)] = match.group(2)
+    try:
+        return (
+            int(settings['otp_delivery_blocklist_maxretry']),
+            float(settings['otp_delivery_blocklist_findtime']),
+        )
+    except KeyError as e:
+        raise ValueError('No {} in the {} section of {}'.format(
+            e.args[0], env, path
+        ))
+
+
+class Bucket(object):
+    """
+    One phone number's sends, counted the way the IdP counts them.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.last_sent = None
+
+    def expired(self, findtime, now):
+        return self.last_sent is None or (
+            now - self.last_sent > findtime + MARGIN
+        )
+
+
+class Pacer(object):
+    """
+    Buckets by phone number, for at most capacity sends per findtime
+    seconds of quiet.
+    """
+
+    def __init__(self, maxretry, findtime, headroom=1):
+        self.capacity = maxretry - headroom
+        if self.capacity < 1:
+            raise ValueError(
+                'OTP_HEADROOM {} leaves no sends of the {} allowed'.format(
+                    headroom, maxretry
+                )
+            )
+        self.findtime = findtime
+        self.buckets = {}
+        self.sends = 0
+
+    def ready_in(self, phone, now=None):
+        """
+        Seconds until phone can be sent another OTP; 0 if it can now.
+        """
+        now = time.time() if now is None else now
+        bucket = self.buckets.get(phone)
+        if bucket is None or bucket.expired(self.findtime, now):
+            return 0
+        if bucket.count < self.capacity:
+            return 0
+        return bucket.last_sent + self.findtime + MARGIN - now
+
+    def sent(self, phone, now=None):
+        now = time.time() if now is None else now
+        bucket = self.buckets.get(phone)
+        if bucket is None:
+            bucket = self.buckets[phone] = Bucket()
+        if bucket.expired(self.findtime, now):
+            bucket.count = 0
+        bucket.count += 1
+        bucket.last_sent = now
+        self.sends += 1
+        if self.sends % SWEEP_EVERY == 0:
+            self.sweep(now)
+
+    def sweep(self, now):
+        """
+        Forgets the buckets that are as good as new, so made-up numbers
+        don't pile up.
+        """
+        for phone in [
+            phone for phone, bucket in self.buckets.items()
+            if bucket.expired(self.findtime, now)
+        ]:
+            del self.buckets[phone]
+
+
+def record(outcome, ms):
+    journey = transactions.journey()
+    pacing_stats.record(outcome, results.TOTAL, ms)
+    if journey is not None:
+        pacing_stats.record(outcome, journey.name, ms)
+    if outcome != 'ready':
+        transactions.step('otp pacing', ms)
+
+
+def pace(leases, pacer):
+    """
+    Has leases pass over accounts whose phone can't be sent an OTP yet,
+    and wait when that's all of them.
+    """
+    acquire = leases.acquire
+
+    def paced_acquire(timeout=30):
+        start = time.time()
+        delayed = False
+        while True:
+            soonest = []
+
+            def usable(user_id):
+                wait = pacer.ready_in(creds.phone(user_id))
+                if wait > 0:
+                    soonest.append(wait)
+                return wait <= 0
+            try:
+                # One look at every account, without waiting.
+                credentials = acquire(0, usable)
+                break
+            except creds.NoCredentialsAvailable:
+                if not soonest:
+                    # Every account is leased, paced or not: wait for a
+                    # free one as usual.
+                    credentials = acquire(timeout, usable)
+                    break
+            delayed = True
+            gevent.sleep(min(soonest))
+        ms = (time.time() - start) * 1000
+        if delayed:
+            record('delayed', ms)
+        elif soonest:
+            record('rerouted', ms)
+        else:
+            record('ready', ms)
+        return credentials
+    leases.acquire = paced_acquire
+
+
+def identity(make):
+    """
+    A made-up identity from make() whose phone can be sent an OTP now.
+    """
+    start = time.time()
+    rerouted = False
+    found = make()
+    if _pacer is not None:
+        while _pacer.ready_in(found.phone) > 0:
+            rerouted = True
+            found = make()
+        record('rerouted' if rerouted else 'ready',
+               (time.time() - start) * 1000)
+    return found
+
+
+def sent(phone):
+    """
+    Counts an OTP sent to phone, e.g. by signing in or adding a phone.
+    """
+    if _pacer is not None:
+        _pacer.sent(phone)
+
+
+_pacer = None
+
+
+def setup(leases):
+    """
+    Paces leases' accounts if OTP_PACING is set.
+    """
+    global _pacer
+    if not os.getenv('OTP_PACING'):
+        return
+    if os.getenv('OTP_MAXRETRY') and os.getenv('OTP_FINDTIME'):
+        maxretry = int(os.getenv('OTP_MAXRETRY'))
+        findtime = float(os.getenv('OTP_FINDTIME'))
+    else:
+        maxretry, findtime = read_limits(
+            os.getenv('OTP_CONFIG'), os.getenv('OTP_CONFIG_ENV', 'development')
+        )
+    _pacer = Pacer(
+        maxretry, findtime * 60, int(os.getenv('OTP_HEADROOM', 1))
+    )
+    pace(leases, _pacer)
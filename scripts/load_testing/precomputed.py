@@ -0,0 +1,90 @@
+"""
+Buffers of client-side work made ahead of time.
+
+A relying party signs a client assertion or an AuthnRequest before every
+sign-in, and every signup needs a made-up identity. Done inline, that
+work sits between one request and the next and caps how fast one
+process can drive the IdP, so it would show up in our capacity numbers
+as the IdP's cost. A Precomputed buffer is kept topped up by background
+greenlets, and a task only pops a ready value off it.
+
+How often a task found a buffer empty, and had to make a value on the
+spot, is in the 'precomputed' stats table (see results.py).
+"""
+import collections
+import time
+
+import gevent
+
+import results
+
+precomputed_stats = results.table(
+    'precomputed', 'Precomputed values (ms to get)',
+    ('Buffer', 'Result'), nested=True
+)
+
+
+class Precomputed(object):
+    """
+    A buffer of values made ahead of time by `make`, `batch` at a time,
+    by `producers` background greenlets.
+
+    By default they run `make` on gevent's thread pool, which suits
+    crypto that releases the GIL. Pure-Python work would only hold the
+    GIL on a thread, so with threaded=False the producers run it
+    themselves, one batch at a time, whenever the event loop has
+    nothing else to do.
+
+    Values older than max_age seconds are dropped rather than used. If
+    the buffer is empty, get() makes one on the spot and counts a miss.
+    """
+
+    def __init__(self, name, make, size=200, producers=2, batch=1,
+                 max_age=None, threaded=True):
+        self.name = name
+        self.make = make
+        self.size = size
+        self.batch = batch
+        self.max_age = max_age
+        self.threaded = threaded
+        self._buffer = collections.deque()
+        self._producers = [
+            gevent.spawn(self._produce) for _ in range(producers)
+        ]
+
+    def get(self):
+        start = time.time()
+        while self._buffer:
+            made_at, value = self._buffer.popleft()
+            if self.max_age is None or start - made_at <= self.max_age:
+                self._record('hit', start)
+                return value
+        value = self.make()
+        self._record('miss', start)
+        return value
+
+    def _record(self, result, start):
+        ms = (time.time() - start) * 1000
+        precomputed_stats.record(self.name, results.TOTAL, ms)
+        precomputed_stats.record(self.name, result, ms)
+
+    def stop(self):
+        gevent.killall(self._producers)
+
+    def _make_batch(self):
+        return [self.make() for _ in range(self.batch)]
+
+    def _produce(self):
+        pool = gevent.get_hub().threadpool
+        while True:
+            if len(self._buffer) < self.size:
+                if self.threaded:
+                    # Blocks this greenlet only; OpenSSL releases the GIL.
+                    values = pool.apply(self._make_batch)
+                else:
+                    gevent.idle()
+                    values = self._make_batch()
+                made_at = time.time()
+                self._buffer.extend((made_at, value) for value in values)
+            else:
+                gevent.sleep(0.05)
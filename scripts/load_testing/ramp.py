@@ -0,0 +1,378 @@
+"""
+A stepped ramp that finds the load where the IdP stops keeping up.
+
+Set RAMP to run one instead of a fixed -c. The load goes up a step at a
+time. Each step is held until throughput and p95 settle, and the ramp
+stops once a step misses an SLO or added load stops adding throughput.
+When the run ends, every step's flows per second, latency and error
+rate are printed per journey, with the last step that held up marked as
+the knee: the maximum sustainable load.
+
+Settings:
+* RAMP: the steps, as 'start:stop:step' (e.g. '10:200:10') or a list
+  ('10,20,50,100').
+* RAMP_UNIT: 'users' (default) steps locust's user count, as -c would.
+  'rate' steps the total arrival rate in flows per second instead, split
+  across tasks by their weights and written to ARRIVAL_RATES_FILE, which
+  must be set (see arrivals.py); give it enough users (-c) to keep up.
+* RAMP_WINDOW: seconds per measurement window (default 15). A step has
+  settled once two windows in a row agree to within RAMP_TOLERANCE
+  (default 0.1) on throughput and p95, or after RAMP_MAX_HOLD seconds
+  (default 300) regardless.
+* RAMP_P95_MS, RAMP_P99_MS: latency SLOs every journey must meet (none
+  by default).
+* RAMP_MAX_ERRORS: the largest share of flows that may fail (default
+  0.01).
+* RAMP_MIN_GAIN: the smallest share of a step's added load that has to
+  show up as added throughput (default 0.25).
+* RAMP_REPORT: also write the report as JSON to this path.
+
+Journeys are the running tasks, each timed as a flow (see
+transactions.py). Give the run a -t (RUN_TIME) long enough for the
+whole ramp; it ends itself once it has found the knee.
+
+Usage:
+RAMP=10:300:10 RAMP_P95_MS=3000 RUN_TIME=2h make load_test
+"""
+import json
+import os
+import sys
+import time
+
+import gevent
+import locust
+from locust import runners
+
+import arrivals
+import results
+import transactions
+
+UNITS = ('users', 'rate')
+
+
+def parse_steps(spec):
+    """
+    '10:50:20' -> [10.0, 30.0, 50.0]; '10,20' -> [10.0, 20.0]
+    """
+    if ':' in spec:
+        start, stop, step = (float(part) for part in spec.split(':'))
+        count = int((stop - start) / step + 1e-9) + 1
+        return [start + step * i for i in range(count)]
+    return [float(part) for part in spec.split(',') if part.strip()]
+
+
+def journey_weights(runner):
+    """
+    {task name: weight} across the running locust classes.
+    """
+    weights = {}
+    for locust_class in runner.locust_classes:
+        tasks = arrivals.task_weights(locust_class.task_set.tasks)
+        for name, weight in tasks.items():
+            weights[name] = weights.get(name, 0) + weight
+    return weights
+
+
+def snapshot(names):
+    """
+    Copies of the named flows' totals as they stand.
+    """
+    copies = {}
+    for name in names:
+        entry = transactions.flow_stats.entries.get((name, results.TOTAL))
+        if entry is not None:
+            copies[name] = type(entry).unserialize(entry.serialize())
+    return copies
+
+
+def difference(after, before):
+    """
+    What each flow recorded between two snapshots.
+    """
+    recorded = {}
+    for name, entry in after.items():
+        entry = type(entry).unserialize(entry.serialize())
+        if name in before:
+            entry.subtract(before[name])
+        recorded[name] = entry
+    return recorded
+
+
+class Measurement(object):
+    """
+    Flows per journey over `seconds`, at one level of load.
+    """
+
+    def __init__(self, level, seconds, journeys):
+        self.level = level
+        self.seconds = seconds
+        self.journeys = journeys
+        self.total = None
+        for distribution in journeys.values():
+            if self.total is None:
+                self.total = type(distribution)()
+            self.total.merge(distribution)
+
+    def combine(self, other):
+        journeys = {}
+        for measurement in (self, other):
+            for name, distribution in measurement.journeys.items():
+                if name not in journeys:
+                    journeys[name] = type(distribution)()
+                journeys[name].merge(distribution)
+        return Measurement(self.level, self.seconds + other.seconds, journeys)
+
+    def rate(self, distribution=None):
+        distribution = self.total if distribution is None else distribution
+        if distribution is None or not self.seconds:
+            return 0.0
+        return distribution.count / self.seconds
+
+    def p95(self):
+        return self.total.percentile(0.95) if self.total else 0
+
+    def summary(self, distribution):
+        return {
+            'flows_per_second': round(self.rate(distribution), 3),
+            'p95_ms': distribution.percentile(0.95),
+            'p99_ms': distribution.percentile(0.99),
+            'errors': round(
+                distribution.failures / float(distribution.count), 4
+            ) if distribution.count else 0,
+        }
+
+
+def close(a, b, tolerance):
+    return abs(a - b) <= tolerance * max(abs(a), abs(b), 1e-9)
+
+
+class Ramp(object):
+    """
+    Steps the load and measures each step until one misses the SLOs.
+    """
+
+    def __init__(self, steps, unit='users', window=15, tolerance=0.1,
+                 max_hold=300, p95=None, p99=None, max_errors=0.01,
+                 min_gain=0.25, report_path=None):
+        if unit not in UNITS:
+            raise ValueError(
+                'Unknown RAMP_UNIT {!r}, expected one of {}'.format(
+                    unit, ', '.join(UNITS)
+                )
+            )
+        self.steps = steps
+        self.unit = unit
+        self.window = window
+        self.tolerance = tolerance
+        self.max_hold = max_hold
+        self.p95 = p95
+        self.p99 = p99
+        self.max_errors = max_errors
+        self.min_gain = min_gain
+        self.report_path = report_path
+        # (Measurement, reasons it failed) per step, in order.
+        self.measured = []
+        self.knee = None
+
+    @classmethod
+    def from_env(cls):
+        def number(name, default=None):
+            value = os.getenv(name)
+            return float(value) if value else default
+        if os.getenv('RAMP_UNIT') == 'rate' and not os.getenv(
+            'ARRIVAL_RATES_FILE'
+        ):
+            raise ValueError('RAMP_UNIT=rate needs ARRIVAL_RATES_FILE set')
+        return cls(
+            parse_steps(os.getenv('RAMP')),
+            unit=os.getenv('RAMP_UNIT', 'users'),
+            window=number('RAMP_WINDOW', 15),
+            tolerance=number('RAMP_TOLERANCE', 0.1),
+            max_hold=number('RAMP_MAX_HOLD', 300),
+            p95=number('RAMP_P95_MS'),
+            p99=number('RAMP_P99_MS'),
+            max_errors=number('RAMP_MAX_ERRORS', 0.01),
+            min_gain=number('RAMP_MIN_GAIN', 0.25),
+            report_path=os.getenv('RAMP_REPORT'),
+        )
+
+    def run(self, runner):
+        # Let the initial hatch finish before taking over the user count.
+        while runner.state != runners.STATE_RUNNING:
+            gevent.sleep(0.5)
+        weights = journey_weights(runner)
+        for level in self.steps:
+            self.set_load(runner, level, weights)
+            measurement = self.hold(level, list(weights))
+            reasons = self.check(measurement)
+            self.measured.append((measurement, reasons))
+            if reasons:
+                break
+            self.knee = measurement
+        # Ends the run the way -t does; older local runners can only stop.
+        getattr(runner, 'quit', runner.stop)()
+
+    def set_load(self, runner, level, weights):
+        if self.unit == 'users':
+            runner.start_hatching(int(level), runner.hatch_rate)
+            return
+        # Every process re-reads the file and runs its share of it (see
+        # arrivals.py); launch.py runs them all on this box.
+        total = float(sum(weights.values()))
+        rates = dict(
+            (name, level * weight / total)
+            for name, weight in weights.items()
+        )
+        path = os.environ['ARRIVAL_RATES_FILE']
+        with open(path + '.tmp', 'w') as f:
+            json.dump(rates, f)
+        os.rename(path + '.tmp', path)
+
+    def hold(self, level, names):
+        """
+        Measures windows at this level until two agree, and returns the
+        two of them together.
+        """
+        started = time.time()
+        before = snapshot(names)
+        previous = None
+        while True:
+            window_start = time.time()
+            gevent.sleep(self.window)
+            after = snapshot(names)
+            # A master's numbers lag by up to a worker report interval,
+            # so windows should be several of those long.
+            current = Measurement(
+                level, time.time() - window_start, difference(after, before)
+            )
+            before = after
+            if previous is not None and (
+                close(current.rate(), previous.rate(), self.tolerance)
+                and close(current.p95(), previous.p95(), self.tolerance)
+                or time.time() - started >= self.max_hold
+            ):
+                return previous.combine(current)
+            previous = current
+
+    def check(self, measurement):
+        """
+        Why this step can't be sustained, if it can't.
+        """
+        reasons = []
+        if measurement.total is None or not measurement.total.count:
+            return ['no flows finished']
+        for name, distribution in sorted(measurement.journeys.items()):
+            if not distribution.count:
+                continue
+            summary = measurement.summary(distribution)
+            if self.p95 and summary['p95_ms'] > self.p95:
+                reasons.append('{} p95 {:.0f} ms > {:.0f}'.format(
+                    name, summary['p95_ms'], self.p95
+                ))
+            if self.p99 and summary['p99_ms'] > self.p99:
+                reasons.append('{} p99 {:.0f} ms > {:.0f}'.format(
+                    name, summary['p99_ms'], self.p99
+                ))
+            if summary['errors'] > self.max_errors:
+                reasons.append('{} errors {:.1%} > {:.1%}'.format(
+                    name, summary['errors'], self.max_errors
+                ))
+        if self.knee is not None and measurement.level > self.knee.level:
+            added_load = measurement.level / self.knee.level - 1
+            added = measurement.rate() / (self.knee.rate() or 1e-9) - 1
+            if added < self.min_gain * added_load:
+                reasons.append(
+                    'throughput up {:.0%} for {:.0%} more load'.format(
+                        added, added_load
+                    )
+                )
+        return reasons
+
+    def report(self):
+        steps = []
+        for measurement, reasons in self.measured:
+            steps.append({
+                'level': measurement.level,
+                'seconds': round(measurement.seconds, 1),
+                'knee': measurement is self.knee,
+                'failed': reasons,
+                'total': measurement.summary(measurement.total)
+                if measurement.total else None,
+                'journeys': dict(
+                    (name, measurement.summary(distribution))
+                    for name, distribution in measurement.journeys.items()
+                    if distribution.count
+                ),
+            })
+        return {
+            'unit': self.unit,
+            'knee': self.knee.level if self.knee else None,
+            'max_flows_per_second': dict(
+                (name, round(self.knee.rate(distribution), 3))
+                for name, distribution in self.knee.journeys.items()
+            ) if self.knee else {},
+            'steps': steps,
+        }
+
+    def print_report(self, out=sys.stdout):
+        report = self.report()
+        out.write('Stepped ramp ({}; knee at {})\n'.format(
+            self.unit,
+            '{:g}'.format(report['knee']) if report['knee'] is not None
+            else 'none'
+        ))
+        out.write(' {:<12} {:<30} {:>10} {:>10} {:>10} {:>8}\n'.format(
+            self.unit.capitalize(), 'Journey', 'flows/s', 'p95', 'p99',
+            'errors'
+        ))
+        row = ' {:<12} {:<30} {:>10.2f} {:>10.1f} {:>10.1f} {:>8.2%}\n'
+        for step in report['steps']:
+            level = '{:g}'.format(step['level'])
+            if step['knee']:
+                level += ' knee'
+            elif step['failed']:
+                level += ' over'
+            if step['total']:
+                out.write(row.format(level, '(total)', *(
+                    step['total'][k] for k in
+                    ('flows_per_second', 'p95_ms', 'p99_ms', 'errors')
+                )))
+            for name, summary in sorted(step['journeys'].items()):
+                out.write(row.format('', name, *(
+                    summary[k] for k in
+                    ('flows_per_second', 'p95_ms', 'p99_ms', 'errors')
+                )))
+            for reason in step['failed']:
+                out.write(' {:<12} {}\n'.format('', reason))
+        out.write('\n')
+        if report['knee'] is None:
+            out.write('No step was sustainable.\n\n')
+        elif not self.measured[-1][1]:
+            out.write('Every step held up; the knee is past the last one.\n\n')
+        if self.report_path:
+            with open(self.report_path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+                f.write('\n')
+
+
+_ramp = None
+
+
+def on_start_hatching(*args, **kwargs):
+    global _ramp
+    runner = runners.locust_runner
+    if (_ramp is not None or not os.getenv('RAMP')
+            or isinstance(runner, runners.SlaveLocustRunner)):
+        return
+    _ramp = Ramp.from_env()
+    gevent.spawn(_ramp.run, runner)
+
+
+def on_quitting():
+    if _ramp is not None and _ramp.measured:
+        _ramp.print_report()
+
+
+locust.events.locust_start_hatching += on_start_hatching
+locust.events.master_start_hatching += on_start_hatching
+locust.events.quitting += on_quitting
@@ -0,0 +1,442 @@
+"""
+Recorded journeys, replayed without scraping code of their own.
+
+Set RECORD and every journey (one run of a task, see transactions.py)
+that finishes without failing is appended to a trace file as one line
+of JSON: when it started, and for each request its method, path, form
+fields, the status it got and how long after the previous response it
+went out. Fields whose value came from the page before and looks generated
+(CSRF tokens, the OTP code, confirmation_token, the personal key) are
+marked dynamic with where they came from, as are the seeded account's email and
+password (wherever the password is posted again) and any made-up email
+or phone number. So are paths that came from the page before: a link on
+it, or a form posting back to it. A new password for the account is
+posted as recorded, and once the change goes through, the account's
+lease is told of it, as change_pass_and_back does.
+
+Set REPLAY to run the journeys in a trace instead of the tasks. Each
+one starts when it did in the recording, and waits between steps as
+long as it did, both sped up by REPLAY_SPEED. Dynamic fields are filled
+in from each response, and each journey leases its own account and
+takes its own identity. A step that can't find its value on the page,
+or gets a different status than was recorded, fails the journey. The
+trace is read a journey at a time as users pick them up, so it can be
+any size; give the run enough users (-c) for the journeys that overlap.
+
+Settings:
+* RECORD: the file to append journeys to. Workers of a distributed run
+  each write their own, with their WORKER_INDEX appended.
+* REPLAY: the trace to replay. Workers of a distributed run each take
+  every WORKER_COUNTth journey of it.
+* REPLAY_SPEED: how many times faster than recorded (default 1); 0 runs
+  each user's journeys back to back, without waits.
+* REPLAY_LOOP: start the trace over when it runs out, rather than stop.
+
+Usage:
+RECORD=journeys.jsonl make load_test type=locustfile
+REPLAY=journeys.jsonl REPLAY_SPEED=10 NUM_CLIENTS=500 \
+    make load_test type=locustfile
+"""
+import json
+import os
+import re
+import time
+from urllib.parse import urljoin
+
+import gevent
+import locust
+from locust.exception import StopLocust
+
+import creds
+from extract import Page
+import failures
+import identities
+import pacing
+from timeseries import worker_path
+import transactions
+
+ACCOUNT_EMAIL = re.compile(r'^testuser\d+@example\.com$')
+EMAIL = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+# Buttons and radio buttons ('Submit', 'patch', 'sms') are on the page
+# too, but don't change from one visit to the next.
+GENERATED = re.compile(r'\d|^\S{16,}$')
+# The field change_pass posts the account's new password in.
+NEW_PASSWORD_FIELD = 'update_user_password_form[password]'
+NEW_PASSWORD = 'account.new_password'
+
+
+def fields_of(data):
+    if data is None or isinstance(data, (str, bytes)):
+        return []
+    if isinstance(data, dict):
+        data = data.items()
+    return [[name, value] for name, value in data]
+
+
+def source_of(name, value, page, account_password):
+    """
+    Where a field's value came from, if it isn't a constant.
+    """
+    if not isinstance(value, str) or not value:
+        return None
+    if account_password and name == NEW_PASSWORD_FIELD:
+        return NEW_PASSWORD
+    if page is not None and page.personal_key == value:
+        return 'personal_key'
+    if page is not None and GENERATED.search(value):
+        if name == 'authenticity_token' and value != page.tokens.get(None):
+            for form_id, token in page.tokens.items():
+                if form_id and token == value:
+                    return 'token:' + form_id
+        if page.inputs.get(name) == value:
+            return 'input'
+    if ACCOUNT_EMAIL.match(value):
+        return 'account.email'
+    if account_password and 'password' in name and value == account_password:
+        return 'account.password'
+    if EMAIL.match(value):
+        return 'identity.email'
+    if name.endswith('[phone]'):
+        return 'identity.phone'
+    return None
+
+
+class Recording(object):
+    """
+    The steps of one journey so far.
+    """
+
+    def __init__(self, started):
+        self.started = started
+        self.steps = []
+        self.last_url = None
+        self.last_content = None
+        self.last_at = None
+        # The password the account the journey signed in as has now,
+        # once it has posted one.
+        self.account_password = None
+
+    def add(self, base_url, method, url, kwargs, resp, sent_at):
+        absolute = urljoin(base_url + '/', url)
+        page = None
+        if self.last_content:
+            page = Page(self.last_content, self.last_url)
+        step = {
+            'wait': round((sent_at - self.last_at) * 1000)
+            if self.last_at else 0,
+            'method': method,
+            'path': self.relative(base_url, absolute),
+        }
+        if absolute == self.last_url:
+            step['from'] = 'url'
+        elif page is not None and url in page.links:
+            # Only the path is kept to find the link again by.
+            step['path'] = self.relative(base_url, absolute).split('?')[0]
+            step['from'] = 'link'
+        fields = fields_of(kwargs.get('data'))
+        emails = [v for _, v in fields
+                  if isinstance(v, str) and ACCOUNT_EMAIL.match(v)]
+        if emails:
+            self.account_password = next(
+                (v for n, v in fields if 'password' in n), None
+            )
+        for field in fields:
+            source = source_of(field[0], field[1], page,
+                               self.account_password)
+            if source:
+                field.append(source)
+        for field in fields:
+            if field[2:] == [NEW_PASSWORD]:
+                self.account_password = field[1]
+        if fields:
+            step['fields'] = fields
+        if kwargs.get('name'):
+            step['name'] = kwargs['name']
+        if kwargs.get('allow_redirects') is False:
+            step['allow_redirects'] = False
+        if kwargs.get('auth'):
+            step['auth'] = True
+        step['status'] = resp.status_code
+        self.steps.append(step)
+        self.last_url = resp.url
+        self.last_content = resp.content
+        self.last_at = time.time()
+
+    @staticmethod
+    def relative(base_url, url):
+        if url.startswith(base_url + '/'):
+            return url[len(base_url):]
+        return url
+
+
+class Recorder(object):
+    """
+    Appends each finished journey to path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.time()
+        self.file = None
+
+    def wrap(self, client):
+        """
+        Records every request client makes inside a journey.
+        """
+        request = client.request
+        base_url = client.base_url.rstrip('/')
+
+        def recorded_request(method, url, **kwargs):
+            sent_at = time.time()
+            resp = request(method, url, **kwargs)
+            transaction = transactions.journey()
+            if transaction is not None:
+                if not hasattr(transaction, 'recording'):
+                    transaction.recording = Recording(transaction.start)
+                transaction.recording.add(
+                    base_url, method, url, kwargs, resp, sent_at
+                )
+            return resp
+        client.request = recorded_request
+
+    def on_finished(self, transaction):
+        recording = getattr(transaction, 'recording', None)
+        if recording is None or transaction.failed:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(json.dumps({
+            'journey': transaction.name,
+            'start': round(recording.started - self.started, 3),
+            'steps': recording.steps,
+        }, separators=(',', ':')) + '\n')
+        self.file.flush()
+
+
+class TraceReader(object):
+    """
+    Journeys from a trace, read as they are asked for.
+    """
+
+    def __init__(self, path, worker_index=0, worker_count=1, loop=False):
+        self.path = path
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.loop = loop
+        self.file = open(path)
+        self.line = 0
+        # Added to start times on each pass through a looped trace.
+        self.offset = 0.0
+        self.last_start = 0.0
+
+    def next(self):
+        """
+        The next journey for this worker, or None once there are none.
+        """
+        while True:
+            text = self.file.readline()
+            if not text:
+                if not self.loop or not self.line:
+                    return None
+                self.file.seek(0)
+                self.line = 0
+                self.offset = self.last_start + 1
+                continue
+            self.line += 1
+            if (self.line - 1) % self.worker_count != self.worker_index:
+                continue
+            if not text.strip():
+                continue
+            journey = json.loads(text)
+            journey['start'] += self.offset
+            self.last_start = journey['start']
+            return journey
+
+
+class StepFailed(Exception):
+    """
+    A replayed step couldn't go ahead as recorded.
+    """
+
+
+class ReplayTaskSet(locust.TaskSet):
+    """
+    Runs the journeys in the REPLAY trace, one per task run.
+    """
+
+    leases = None
+    speed = float(os.getenv('REPLAY_SPEED', 1))
+    auth = (os.getenv('AUTH_USER'), os.getenv('AUTH_PASS'))
+    _reader = None
+    _started = None
+
+    @classmethod
+    def reader(cls):
+        if cls._reader is None:
+            cls._reader = TraceReader(
+                os.getenv('REPLAY'),
+                int(os.getenv('WORKER_INDEX', 0)),
+                int(os.getenv('WORKER_COUNT', 1)),
+                bool(os.getenv('REPLAY_LOOP')),
+            )
+            cls._started = time.time()
+        return cls._reader
+
+    @locust.task
+    def replay(self):
+        journey = self.reader().next()
+        if journey is None:
+            raise StopLocust('The trace has no more journeys.')
+        intended = None
+        if self.speed:
+            intended = self._started + journey['start'] / self.speed
+            delay = intended - time.time()
+            if delay > 0:
+                gevent.sleep(delay)
+        with transactions.Transaction(journey['journey'], start=intended):
+            if intended is not None:
+                transactions.step(
+                    'schedule lag', (time.time() - intended) * 1000
+                )
+            self.run_journey(journey)
+
+    def wait(self):
+        # The trace is the only pacing.
+        pass
+
+    def run_journey(self, journey):
+        steps = journey['steps']
+        sources = set(
+            field[2] for step in steps for field in step.get('fields', ())
+            if len(field) > 2
+        )
+        values = {}
+        if any(s.startswith('identity.') for s in sources):
+            identity = pacing.identity(identities.get)
+            values['identity.email'] = identity.email
+            values['identity.phone'] = identity.phone
+        account = None
+        if any(s.startswith('account.') for s in sources):
+            account = self.leases.acquire()
+            values['account.email'] = account['email']
+            values['account.password'] = account['password']
+            values['account.phone'] = creds.phone(account['id'])
+        try:
+            resp = None
+            for step in steps:
+                if step['wait'] and self.speed:
+                    gevent.sleep(step['wait'] / 1000.0 / self.speed)
+                resp = self.run_step(step, resp, values)
+                if resp is None:
+                    return
+                for field in step.get('fields', ()):
+                    if field[2:] == [NEW_PASSWORD]:
+                        self.leases.set_password(account, field[1])
+                        values['account.password'] = field[1]
+        finally:
+            if account is not None:
+                self.leases.release(account)
+
+    def run_step(self, step, last, values):
+        """
+        Sends one step, filled in from the last response. Returns the
+        response, or None after reporting why the journey can't go on.
+        """
+        page = None
+        if last is not None and (step.get('from') == 'link' or any(
+            len(field) > 2 and field[2] not in values
+            and field[2] != NEW_PASSWORD
+            for field in step.get('fields', ())
+        )):
+            start = time.time()
+            page = Page(last.content, last.url)
+            transactions.step('client parse', (time.time() - start) * 1000)
+        try:
+            url = self.url(step, last, page)
+            data = [
+                (field[0], self.value(field, page, values))
+                for field in step.get('fields', ())
+            ]
+        except StepFailed as e:
+            if last is None:
+                raise
+            failures.report(last, str(e))
+            return None
+
+        kwargs = {'catch_response': True}
+        for key in ('name', 'allow_redirects'):
+            if key in step:
+                kwargs[key] = step[key]
+        if step.get('auth') and all(self.auth):
+            kwargs['auth'] = self.auth
+        if data:
+            kwargs['data'] = data
+        with self.client.request(step['method'], url, **kwargs) as resp:
+            # Signing in, or adding a phone, sends the phone an OTP.
+            for field in step.get('fields', ()):
+                if len(field) > 2 and field[2] == 'account.email':
+                    pacing.sent(values['account.phone'])
+                elif len(field) > 2 and field[2] == 'identity.phone':
+                    pacing.sent(values['identity.phone'])
+            if resp.status_code != step['status']:
+                failures.report(
+                    resp, 'Replay got {} rather than {} at {}.'.format(
+                        resp.status_code, step['status'], resp.url
+                    )
+                )
+                return None
+            resp.success()
+        return resp
+
+    def url(self, step, last, page):
+        source = step.get('from')
+        if source == 'url' and last is not None:
+            return last.url
+        if source == 'link' and page is not None:
+            link = page.link(step['path'])
+            if link is None:
+                raise StepFailed('No link to {} at {}.'.format(
+                    step['path'], last.url
+                ))
+            return urljoin(last.url, link)
+        return step['path']
+
+    def value(self, field, page, values):
+        if len(field) < 3:
+            return field[1]
+        source = field[2]
+        if source in values:
+            return values[source]
+        if source == NEW_PASSWORD:
+            return field[1]
+        value = None
+        if page is not None:
+            if source == 'input':
+                value = page.inputs.get(field[0])
+            elif source == 'personal_key':
+                value = page.personal_key
+            elif source.startswith('token:'):
+                value = page.authenticity_token(source[len('token:'):])
+        if value is None:
+            raise StepFailed('No {} for {} at {}.'.format(
+                source, field[0], page.url if page is not None else None
+            ))
+        return value
+
+
+def replay_tasks(leases):
+    """
+    ReplayTaskSet, leasing accounts from leases.
+    """
+    return type('ReplayTaskSet', (ReplayTaskSet,), {'leases': leases})
+
+
+_recorder = None
+
+
+def record(client):
+    global _recorder
+    if _recorder is None:
+        _recorder = Recorder(worker_path(os.getenv('RECORD')))
+        transactions.finished.append(_recorder.on_finished)
+    _recorder.wrap(client)
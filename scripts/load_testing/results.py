@@ -0,0 +1,367 @@
+"""
+The harness' own stats tables, on a pluggable latency backend.
+
+Every table maps a (group, name) key, e.g. ('POST', '/login/two_factor/sms')
+or ('signup', 'POST /sign_up/create_password'), to a latency distribution.
+STATS_BACKEND picks what those distributions are:
+
+* 'hdr' (default): hdr.Histogram, fixed memory per entry, microsecond
+  resolution, lossless merges, so p99.9 is trustworthy.
+* 'locust': counts of times rounded the way locust's own stats do.
+
+The 'requests' table records every request locust reports. Other
+modules add their own tables with table(). Distributed workers send their
+tables to the master with each stats report, and when the run ends every
+table is printed. STATS_CSV=prefix also writes <prefix>_<table>.csv, and
+STATS_ARCHIVE=path writes all of them, serialized, to one JSON file that
+read_archive() can load again to compare runs.
+"""
+import csv
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import locust
+from locust import runners
+
+import hdr
+
+PERCENTILES = (0.5, 0.66, 0.75, 0.8, 0.9, 0.95, 0.98, 0.99, 0.999, 1.0)
+
+# The name a group's own total is recorded under, in nested tables.
+TOTAL = ''
+
+
+class LocustDistribution(object):
+    """
+    Counts of response times in ms, rounded the way locust rounds them.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.times = {}
+
+    def record(self, ms, failed=False):
+        ms = int(ms)
+        self.count += 1
+        if failed:
+            self.failures += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = max(self.max, ms)
+
+        if ms < 100:
+            rounded = ms
+        elif ms < 1000:
+            rounded = int(round(ms, -1))
+        else:
+            rounded = int(round(ms, -2))
+        self.times[rounded] = self.times.get(rounded, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.failures += other.failures
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(
+                self.min, other.min
+            )
+        self.max = max(self.max, other.max)
+        for ms, count in other.times.items():
+            self.times[ms] = self.times.get(ms, 0) + count
+
+    def subtract(self, other):
+        """
+        Takes out what an earlier copy of this distribution had
+        recorded, leaving what was recorded since.
+        """
+        self.count -= other.count
+        self.failures -= other.failures
+        self.total -= other.total
+        for ms, count in other.times.items():
+            left = self.times.get(ms, 0) - count
+            if left > 0:
+                self.times[ms] = left
+            else:
+                self.times.pop(ms, None)
+        self.min = min(self.times) if self.times else None
+        self.max = max(self.times) if self.times else 0
+
+    @property
+    def avg(self):
+        return self.total / float(self.count) if self.count else 0
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        position = self.count - int(self.count * percent)
+        for ms in sorted(self.times, reverse=True):
+            position -= self.times[ms]
+            if position < 0:
+                return ms
+        return self.min
+
+    def buckets(self):
+        for ms in sorted(self.times):
+            yield ms, self.times[ms]
+
+    def serialize(self):
+        return {
+            'count': self.count,
+            'failures': self.failures,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'times': list(self.times.items()),
+        }
+
+    @classmethod
+    def unserialize(cls, data):
+        distribution = cls()
+        distribution.count = data['count']
+        distribution.failures = data['failures']
+        distribution.total = data['total']
+        distribution.min = data['min']
+        distribution.max = data['max']
+        distribution.times = dict((int(k), v) for k, v in data['times'])
+        return distribution
+
+
+BACKENDS = {
+    'hdr': hdr.Histogram,
+    'locust': LocustDistribution,
+}
+
+
+class StatsTable(object):
+    """
+    Distributions keyed by (group, name), in the order first seen.
+
+    In a nested table each group has a TOTAL entry of its own, and the
+    rest of its entries are printed indented underneath it.
+    """
+
+    def __init__(self, labels, nested=False, backend=None):
+        self.labels = labels
+        self.nested = nested
+        self.backend = backend or os.getenv('STATS_BACKEND', 'hdr')
+        if self.backend not in BACKENDS:
+            raise ValueError(
+                'Unknown STATS_BACKEND {!r}, expected one of {}'.format(
+                    self.backend, ', '.join(sorted(BACKENDS))
+                )
+            )
+        self.entries = OrderedDict()
+        # Called as tap(group, name, ms, failed) on every record(), e.g.
+        # by timeseries.py.
+        self.taps = []
+
+    def get(self, group, name=TOTAL):
+        key = (group, name)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = BACKENDS[self.backend]()
+        return entry
+
+    def record(self, group, name, ms, failed=False):
+        self.get(group, name).record(ms, failed)
+        for tap in self.taps:
+            tap(group, name, ms, failed)
+
+    def serialize(self):
+        return {
+            'backend': self.backend,
+            'entries': [
+                [group, name, distribution.serialize()]
+                for (group, name), distribution in self.entries.items()
+            ],
+        }
+
+    def merge(self, data):
+        if data['backend'] != self.backend:
+            raise ValueError('Cannot merge {} stats into {} stats'.format(
+                data['backend'], self.backend
+            ))
+        backend = BACKENDS[self.backend]
+        for group, name, distribution in data['entries']:
+            self.get(group, name).merge(backend.unserialize(distribution))
+
+    @classmethod
+    def unserialize(cls, labels, data, nested=False):
+        table = cls(labels, nested, data['backend'])
+        table.merge(data)
+        return table
+
+    def clear(self):
+        self.entries.clear()
+
+    def keys(self):
+        """
+        Keys grouped by group; in nested tables each group's TOTAL first.
+        """
+        groups = OrderedDict()
+        for group, name in self.entries:
+            groups.setdefault(group, []).append(name)
+        for group, names in groups.items():
+            if self.nested:
+                names = sorted(names, key=lambda n: n != TOTAL)
+            for name in names:
+                yield group, name
+
+    def header(self):
+        return list(self.labels) + [
+            '# reqs', '# fails', 'Avg', 'Min', 'Max'
+        ] + ['{:g}%'.format(p * 100) for p in PERCENTILES]
+
+    def rows(self):
+        for group, name in self.keys():
+            distribution = self.entries[(group, name)]
+            yield [
+                group,
+                name,
+                distribution.count,
+                distribution.failures,
+                distribution.avg,
+                distribution.min or 0,
+                distribution.max,
+            ] + [distribution.percentile(p) for p in PERCENTILES]
+
+    def print_table(self, title, out=sys.stdout):
+        out.write('{}\n'.format(title))
+        out.write((' {:<22} {:<44}' + ' {:>8}' * 15 + '\n').format(
+            *self.header()
+        ))
+        row_format = ' {:<22} {:<44} {:>8} {:>8}' + ' {:>8.1f}' * 13 + '\n'
+        for row in self.rows():
+            if self.nested:
+                if row[1] == TOTAL:
+                    row[1] = '(total)'
+                else:
+                    row[0] = ''
+            out.write(row_format.format(*row))
+        out.write('\n')
+
+    def write_csv(self, path):
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.header())
+            for row in self.rows():
+                writer.writerow(row[:4] + [round(v, 3) for v in row[4:]])
+
+
+# name -> (title, StatsTable), in the order they were added.
+tables = OrderedDict()
+
+
+def table(name, title, labels, nested=False):
+    """
+    The named table, created the first time it's asked for.
+    """
+    if name not in tables:
+        tables[name] = (title, StatsTable(labels, nested))
+    return tables[name][1]
+
+
+request_stats = table('requests', 'Request latency (ms)', ('Method', 'Name'))
+
+started = time.time()
+
+
+def saved(name):
+    """
+    A table and what it takes to rebuild it, as plain JSON-able data.
+    """
+    title, t = tables[name]
+    return {
+        'title': title,
+        'labels': list(t.labels),
+        'nested': t.nested,
+        'stats': t.serialize(),
+    }
+
+
+def merge_saved(name, data):
+    """
+    Merges saved() data into the named table, creating it if need be.
+    """
+    table(name, data['title'], data['labels'], data['nested']).merge(
+        data['stats']
+    )
+
+
+def write_archive(path):
+    """
+    Writes every table, losslessly serialized, to a JSON file.
+    """
+    archive = {
+        'version': 1,
+        'started': started,
+        'ended': time.time(),
+        'tables': OrderedDict((name, saved(name)) for name in tables),
+    }
+    with open(path, 'w') as f:
+        json.dump(archive, f)
+
+
+def read_archive(path):
+    """
+    An archived run as {'tables': {name: (title, StatsTable)}, ...}
+    with the archive's other fields alongside.
+    """
+    with open(path) as f:
+        archive = json.load(f)
+    loaded = OrderedDict()
+    for name, data in archive['tables'].items():
+        loaded[name] = (data['title'], StatsTable.unserialize(
+            data['labels'], data['stats'], data['nested']
+        ))
+    archive['tables'] = loaded
+    return archive
+
+
+def on_request_success(request_type, name, response_time, response_length):
+    request_stats.record(request_type, name, response_time)
+
+
+def on_request_failure(request_type, name, response_time, exception):
+    request_stats.record(request_type, name, response_time, failed=True)
+
+
+def on_report_to_master(client_id, data):
+    data['tables'] = dict(
+        (name, saved(name)) for name, (_, t) in tables.items() if t.entries
+    )
+    for _, t in tables.values():
+        t.clear()
+
+
+def on_slave_report(client_id, data):
+    for name, saved_table in data.get('tables', {}).items():
+        merge_saved(name, saved_table)
+
+
+def on_quitting():
+    if isinstance(runners.locust_runner, runners.SlaveLocustRunner):
+        return
+    for name, (title, t) in tables.items():
+        if t.entries:
+            t.print_table(title)
+    prefix = os.getenv('STATS_CSV')
+    if prefix:
+        for name, (_, t) in tables.items():
+            t.write_csv('{}_{}.csv'.format(prefix, name))
+    if os.getenv('STATS_ARCHIVE'):
+        write_archive(os.getenv('STATS_ARCHIVE'))
+
+
+locust.events.request_success += on_request_success
+locust.events.request_failure += on_request_failure
+locust.events.report_to_master += on_report_to_master
+locust.events.slave_report += on_slave_report
+locust.events.quitting += on_quitting
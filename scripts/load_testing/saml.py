@@ -0,0 +1,411 @@
+"""
+SP-initiated SAML sign-ins and single logout, as a stand-in SP.
+
+sp_rails_change_pass in locustfile.py can't get through the sample SP's
+form, so it signs in at the IdP directly and /api/saml/auth never sees a
+real AuthnRequest. Here the harness is the SP: each task sends a signed
+AuthnRequest to /api/saml/auth with the HTTP-Redirect binding, signs in,
+reads the SAMLResponse off the IdP's auto-posting form, then sends a
+signed LogoutRequest to /api/saml/logout and checks the LogoutResponse.
+That way the IdP's cost of building, signing and encrypting assertions
+shows up in the numbers.
+
+* AuthnRequests are filled in from a template made once per run and
+  signed ahead of time, in batches, in the background (see
+  precomputed.py), so the SP's own signing never sits between requests.
+  LogoutRequests carry the NameID the IdP just sent, so they are signed
+  when needed, on gevent's thread pool.
+* SAMLResponses are read with a streaming parser that keeps only the
+  status, NameID, SessionIndex and attributes, and decrypts an
+  EncryptedAssertion with the SP's key. Its time is a 'saml parse' step.
+* Each leg (authn request, handoff, logout) is a flow of its own.
+
+Settings:
+* SAML_ISSUER: an SP registered in config/service_providers.yml; defaults
+  to the development rp1 SP, whose key is checked in.
+* SAML_PRIVATE_KEY: path to that SP's PEM private key.
+* SAML_AUTHN_CONTEXT: defaults to LOA1.
+
+Usage:
+make load_test type=saml
+"""
+import base64
+import io
+import os
+import time
+import uuid
+import zlib
+from urllib.parse import quote_plus
+from xml.etree import ElementTree
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import gevent
+import locust
+from locust.exception import ResponseError
+
+import arrivals
+from extract import resp_to_page
+import locustfile
+from precomputed import Precomputed
+import transactions
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ISSUER = os.getenv(
+    'SAML_ISSUER', 'https://rp1.serviceprovider.com/auth/saml/metadata'
+)
+PRIVATE_KEY = os.getenv('SAML_PRIVATE_KEY') or os.path.join(
+    HERE, '..', '..', 'keys', 'saml_test_sp.key'
+)
+AUTHN_CONTEXT = os.getenv(
+    'SAML_AUTHN_CONTEXT', 'http://idmanagement.gov/ns/assurance/loa/1'
+)
+
+SIG_ALG = 'http://www.w3.org/2001/04/xmldsig-more#rsa-sha256'
+SUCCESS = 'urn:oasis:names:tc:SAML:2.0:status:Success'
+
+# How old a signed AuthnRequest can get in the buffer before it's
+# thrown away unused.
+REQUEST_MAX_AGE = 120
+
+AUTHN_REQUEST = (
+    '<samlp:AuthnRequest'
+    ' xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol"'
+    ' xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"'
+    ' ID="{{id}}" Version="2.0" IssueInstant="{{instant}}"'
+    ' Destination="{destination}">'
+    '<saml:Issuer>{issuer}</saml:Issuer>'
+    '<samlp:NameIDPolicy AllowCreate="true"'
+    ' Format="urn:oasis:names:tc:SAML:2.0:nameid-format:persistent"/>'
+    '<samlp:RequestedAuthnContext Comparison="exact">'
+    '<saml:AuthnContextClassRef>{authn_context}</saml:AuthnContextClassRef>'
+    '</samlp:RequestedAuthnContext>'
+    '</samlp:AuthnRequest>'
+)
+
+LOGOUT_REQUEST = (
+    '<samlp:LogoutRequest'
+    ' xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol"'
+    ' xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"'
+    ' ID="{id}" Version="2.0" IssueInstant="{instant}"'
+    ' Destination="{destination}">'
+    '<saml:Issuer>{issuer}</saml:Issuer>'
+    '<saml:NameID'
+    ' Format="urn:oasis:names:tc:SAML:2.0:nameid-format:persistent">'
+    '{name_id}</saml:NameID>'
+    '<samlp:SessionIndex>{session_index}</samlp:SessionIndex>'
+    '</samlp:LogoutRequest>'
+)
+
+
+def message_id():
+    # IDs are xsd:ID, so they can't start with a digit.
+    return '_' + uuid.uuid4().hex
+
+
+def instant():
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+
+def escape(value):
+    return (value.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('"', '&quot;'))
+
+
+def load_key(path):
+    with open(path, 'rb') as f:
+        return serialization.load_pem_private_key(
+            f.read(), password=None, backend=default_backend()
+        )
+
+
+class RedirectBinding(object):
+    """
+    Encodes and signs SAML messages for the HTTP-Redirect binding.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def query(self, xml, relay_state=None, param='SAMLRequest'):
+        """
+        The signed query string carrying xml (a str).
+        """
+        deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                   zlib.DEFLATED, -15)
+        encoded = base64.b64encode(
+            deflate.compress(xml.encode('utf-8')) + deflate.flush()
+        )
+        # The signature covers the query exactly as sent, in this order.
+        query = '{}={}'.format(param, quote_plus(encoded))
+        if relay_state:
+            query += '&RelayState=' + quote_plus(relay_state)
+        query += '&SigAlg=' + quote_plus(SIG_ALG)
+        signature = self.key.sign(
+            query.encode('ascii'), padding.PKCS1v15(), hashes.SHA256()
+        )
+        return query + '&Signature=' + quote_plus(base64.b64encode(signature))
+
+
+class AuthnRequests(object):
+    """
+    Makes signed AuthnRequests for one SP and IdP, as
+    (query string, RelayState, request ID).
+    """
+
+    def __init__(self, binding, issuer, destination, authn_context):
+        self.binding = binding
+        self.template = AUTHN_REQUEST.format(
+            destination=escape(destination),
+            issuer=escape(issuer),
+            authn_context=escape(authn_context),
+        )
+
+    def __call__(self):
+        request_id = message_id()
+        relay_state = uuid.uuid4().hex
+        xml = self.template.format(id=request_id, instant=instant())
+        return self.binding.query(xml, relay_state), relay_state, request_id
+
+
+class SAMLMessage(object):
+    """
+    What the SP needs from a Response or LogoutResponse.
+    """
+
+    def __init__(self):
+        self.kind = None
+        self.in_response_to = None
+        self.status = None
+        self.issuer = None
+        self.name_id = None
+        self.session_index = None
+        self.attributes = {}
+        self.encrypted = None
+
+    @property
+    def success(self):
+        return self.status == SUCCESS
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def scan(source, message):
+    """
+    Reads the fields of SAMLMessage out of source (a file of XML) with
+    iterparse, clearing each element once it has been read so that only
+    the open ones are ever held in memory.
+    """
+    open_tags = []
+    attribute = None
+    for event, element in ElementTree.iterparse(source, ('start', 'end')):
+        tag = local_name(element.tag)
+        if event == 'start':
+            open_tags.append(tag)
+            if len(open_tags) == 1 and message.kind is None:
+                message.kind = tag
+                message.in_response_to = element.get('InResponseTo')
+            elif tag == 'StatusCode' and message.status is None:
+                message.status = element.get('Value')
+            elif tag == 'AuthnStatement':
+                message.session_index = element.get('SessionIndex')
+            elif tag == 'Attribute':
+                attribute = element.get('Name')
+                message.attributes.setdefault(attribute, [])
+            elif tag == 'EncryptedAssertion':
+                message.encrypted = {}
+            elif tag == 'EncryptionMethod' and message.encrypted is not None:
+                which = 'key' if 'EncryptedKey' in open_tags else 'data'
+                message.encrypted[which + '_method'] = element.get('Algorithm')
+            continue
+
+        open_tags.pop()
+        if tag == 'Issuer' and message.issuer is None:
+            message.issuer = (element.text or '').strip()
+        elif tag == 'NameID':
+            message.name_id = (element.text or '').strip()
+        elif tag == 'AttributeValue' and attribute is not None:
+            message.attributes[attribute].append((element.text or '').strip())
+        elif tag == 'CipherValue' and message.encrypted is not None:
+            which = 'key' if 'EncryptedKey' in open_tags else 'data'
+            message.encrypted[which] = ''.join((element.text or '').split())
+        elif tag == 'Attribute':
+            attribute = None
+        element.clear()
+    return message
+
+
+def decrypt(encrypted, key):
+    """
+    The plaintext of an xmlenc EncryptedAssertion, given the SP's key.
+    """
+    if encrypted.get('key_method', '').endswith('rsa-1_5'):
+        key_padding = padding.PKCS1v15()
+    else:
+        key_padding = padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA1()),
+            algorithm=hashes.SHA1(),
+            label=None,
+        )
+    secret = key.decrypt(base64.b64decode(encrypted['key']), key_padding)
+    data = base64.b64decode(encrypted['data'])
+    if encrypted.get('data_method', '').endswith('gcm'):
+        decryptor = Cipher(
+            algorithms.AES(secret), modes.GCM(data[:12], data[-16:]),
+            backend=default_backend()
+        ).decryptor()
+        return decryptor.update(data[12:-16]) + decryptor.finalize()
+    decryptor = Cipher(
+        algorithms.AES(secret), modes.CBC(data[:16]), backend=default_backend()
+    ).decryptor()
+    plain = decryptor.update(data[16:]) + decryptor.finalize()
+    # xmlenc padding: the last byte says how many bytes to drop.
+    return plain[:-plain[-1]]
+
+
+def parse(encoded, key=None):
+    """
+    A SAMLMessage from the base64 SAMLResponse of a POST-binding form.
+    """
+    message = scan(io.BytesIO(base64.b64decode(encoded)), SAMLMessage())
+    if message.encrypted and key is not None:
+        scan(io.BytesIO(decrypt(message.encrypted, key)), message)
+    return message
+
+
+# Made on first use, once the target host is known.
+_binding = None
+_authn_requests = None
+
+
+def binding():
+    global _binding
+    if _binding is None:
+        _binding = RedirectBinding(load_key(PRIVATE_KEY))
+    return _binding
+
+
+def authn_request_buffer(host):
+    global _authn_requests
+    if _authn_requests is None:
+        _authn_requests = Precomputed(
+            'authn_request',
+            AuthnRequests(
+                binding(), ISSUER, host.rstrip('/') + '/api/saml/auth',
+                AUTHN_CONTEXT
+            ),
+            batch=20,
+            max_age=REQUEST_MAX_AGE,
+        )
+    return _authn_requests
+
+
+def read_post_binding(t, resp, relay_state=None):
+    """
+    Parses the SAMLResponse off the IdP's auto-posting form.
+    """
+    page = resp_to_page(resp)
+    encoded = page.inputs.get('SAMLResponse')
+    if not encoded:
+        raise ResponseError('No SAMLResponse at {}'.format(resp.url))
+    if relay_state and page.inputs.get('RelayState') != relay_state:
+        raise ResponseError('RelayState mismatch at {}'.format(resp.url))
+    start = time.time()
+    message = parse(encoded, binding().key)
+    transactions.step('saml parse', (time.time() - start) * 1000)
+    if not message.success:
+        raise ResponseError('{} status {} at {}'.format(
+            message.kind, message.status, resp.url
+        ))
+    return message
+
+
+@transactions.flow('saml authn request')
+def authn_request(t, query):
+    return t.client.get('/api/saml/auth?' + query, name='/api/saml/auth')
+
+
+@transactions.flow('saml handoff')
+def handoff(t, resp, request_id, relay_state):
+    """
+    The assertion the IdP posts back to the SP after sign-in, past the
+    first-time sharing consent page if there is one.
+    """
+    if '/sign_up/completed' in resp.url:
+        page = resp_to_page(resp)
+        resp = t.client.post(
+            '/sign_up/completed',
+            data={
+                'authenticity_token': page.authenticity_token(),
+                'commit': 'Continue',
+            }
+        )
+    message = read_post_binding(t, resp, relay_state)
+    if message.in_response_to != request_id:
+        raise ResponseError('Response to {}, not {}'.format(
+            message.in_response_to, request_id
+        ))
+    if not message.name_id:
+        raise ResponseError('No NameID in the assertion')
+    return message
+
+
+@transactions.flow('saml logout')
+def single_logout(t, assertion):
+    """
+    SP-initiated single logout of the session in assertion.
+    """
+    request_id = message_id()
+    xml = LOGOUT_REQUEST.format(
+        id=request_id,
+        instant=instant(),
+        destination=escape(t.client.base_url.rstrip('/') + '/api/saml/logout'),
+        issuer=escape(ISSUER),
+        name_id=escape(assertion.name_id),
+        session_index=escape(assertion.session_index or ''),
+    )
+    query = gevent.get_hub().threadpool.apply(binding().query, (xml,))
+    resp = t.client.get('/api/saml/logout?' + query, name='/api/saml/logout')
+    message = read_post_binding(t, resp)
+    if message.in_response_to != request_id:
+        raise ResponseError('Logout response to {}, not {}'.format(
+            message.in_response_to, request_id
+        ))
+    return message
+
+
+class SAMLBehavior(arrivals.OpenLoopTaskSet):
+
+    @locust.task(1)
+    def saml_sign_in(self):
+        """
+        An SP-initiated sign-in, then SP-initiated single logout.
+        """
+        query, relay_state, request_id = authn_request_buffer(
+            self.client.base_url
+        ).get()
+        with locustfile.leases.lease() as credentials:
+            authn_request(self, query)
+            resp = locustfile.login(self, credentials)
+            if resp is None:
+                # login() already reported why.
+                return
+            assertion = handoff(self, resp, request_id, relay_state)
+            single_logout(self, assertion)
+
+
+class SAMLUser(locustfile.BaseLocust):
+    task_set = SAMLBehavior
+    min_wait = 50
+    max_wait = 100
+    host = os.getenv('TARGET_HOST') or 'http://localhost:3000'
+
+    def __init__(self):
+        super(SAMLUser, self).__init__()
+        if not isinstance(self.client, locustfile.fasthttp.FastHttpSession):
+            transactions.instrument(self.client)
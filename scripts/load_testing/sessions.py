@@ -0,0 +1,199 @@
+"""
+A pool of signed-in sessions, for load on pages behind sign-in.
+
+Signing in costs a scrypt password check and an SMS 2FA round trip, so
+tasks that log in from scratch every time can never put realistic load
+on /account or /manage/password without the sign-in path swamping
+everything else. Instead, borrow() hands a task one of a pool of
+sessions that already signed in:
+
+    with session_pool.borrow(self) as session:
+        resp = self.client.get('/account')
+        if '/account' not in resp.url:
+            session.invalidate()
+
+For the length of the with block the task's client uses the pooled
+session's cookies, then gets its own back. Each pooled session holds a
+lease on its account (see creds.py) for as long as it lives. A session
+that the IdP would have timed out by now, or that a task invalidated,
+is signed in again the next time it is borrowed.
+
+Until SESSION_POOL_SIZE sessions exist, borrowing signs a new one in;
+after that, borrowers wait for a free one. warm_up() signs them in ahead
+of time, from on_start, so the first borrows don't pay for it. A warm-up
+that fails is reported as a locust error and left for a borrow to sign
+in again, rather than raised: locust ends a user for good over anything
+on_start raises. SESSION_TIMEOUT is the IdP's session_timeout_in_minutes.
+
+Every borrow is recorded in a 'sessions' table (see results.py) as a hit
+or a miss, with how long the borrower waited, sign-in included.
+"""
+import contextlib
+import os
+import sys
+import time
+import traceback
+
+import gevent.queue
+import locust
+
+import results
+import transactions
+
+sessions_stats = results.table(
+    'sessions', 'Session pool borrows (ms waited)', ('Result', 'Reason'),
+    nested=True
+)
+
+
+class SessionLoginFailed(Exception):
+    pass
+
+
+class PooledSession(object):
+    """
+    One signed-in account: its lease and its cookies.
+    """
+
+    def __init__(self, credentials, cookies):
+        self.credentials = credentials
+        self.cookies = cookies
+        self.signed_in_at = None
+        self.last_used = None
+        self.invalid = True
+
+    def invalidate(self):
+        """
+        Marks the session as signed out, e.g. after being sent back to
+        the sign-in page, so it signs in again before its next use.
+        """
+        self.invalid = True
+
+
+class SessionPool(object):
+    """
+    Up to `size` signed-in sessions, shared by every user in a process.
+
+    `login(t, credentials)` signs in on t.client and returns something
+    truthy on success, like locustfile.login().
+    """
+
+    def __init__(self, leases, login, size=100, timeout=15 * 60):
+        self.leases = leases
+        self.login = login
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self._idle = gevent.queue.Queue()
+
+    @classmethod
+    def from_env(cls, leases, login):
+        return cls(
+            leases,
+            login,
+            size=int(os.getenv('SESSION_POOL_SIZE', 100)),
+            timeout=float(os.getenv('SESSION_TIMEOUT', 15)) * 60,
+        )
+
+    def expired(self, session, now=None):
+        # Devise times sessions out after `timeout` without a request.
+        # Leave a minute's margin so a session never dies mid-task.
+        now = time.time() if now is None else now
+        return now - session.last_used > self.timeout - 60
+
+    def warm_up(self, t):
+        """
+        Signs in one more session for the pool, if it isn't full yet.
+        Errors are reported, not raised.
+        """
+        if self.created >= self.size:
+            return
+        session = None
+        try:
+            session = self._create(t)
+            self._sign_in(t, session)
+        except transactions.STOPPED:
+            raise
+        except Exception as error:
+            # The way locust reports an error in a task.
+            locust.events.locust_error.fire(
+                locust_instance=t, exception=error, tb=sys.exc_info()[2]
+            )
+            sys.stderr.write('\n' + traceback.format_exc())
+        finally:
+            if session is not None:
+                self._idle.put(session)
+
+    @contextlib.contextmanager
+    def borrow(self, t):
+        start = time.time()
+        session = None
+        reason = None
+        try:
+            session = self._idle.get_nowait()
+        except gevent.queue.Empty:
+            if self.created < self.size:
+                session = self._create(t)
+                reason = 'new'
+            else:
+                session = self._idle.get()
+
+        try:
+            if reason is None:
+                if session.invalid:
+                    reason = 'invalidated'
+                elif self.expired(session):
+                    reason = 'expired'
+            if reason is not None:
+                try:
+                    self._sign_in(t, session)
+                except Exception:
+                    ms = (time.time() - start) * 1000
+                    sessions_stats.record('miss', results.TOTAL, ms, True)
+                    sessions_stats.record('miss', reason, ms, True)
+                    raise
+            ms = (time.time() - start) * 1000
+            if reason is None:
+                sessions_stats.record('hit', results.TOTAL, ms)
+            else:
+                sessions_stats.record('miss', results.TOTAL, ms)
+                sessions_stats.record('miss', reason, ms)
+
+            own_cookies = t.client.cookies
+            t.client.cookies = session.cookies
+            try:
+                yield session
+            finally:
+                t.client.cookies = own_cookies
+                session.last_used = time.time()
+        finally:
+            self._idle.put(session)
+
+    def _create(self, t):
+        # Count it before signing in, so concurrent borrowers can't
+        # overfill the pool while this one waits on the IdP.
+        self.created += 1
+        try:
+            credentials = self.leases.acquire()
+        except Exception:
+            self.created -= 1
+            raise
+        return PooledSession(credentials, type(t.client.cookies)())
+
+    def _sign_in(self, t, session):
+        # Start from an empty cookie jar, as a new browser would.
+        session.cookies = type(t.client.cookies)()
+        own_cookies = t.client.cookies
+        t.client.cookies = session.cookies
+        try:
+            signed_in = self.login(t, session.credentials)
+        finally:
+            t.client.cookies = own_cookies
+        session.last_used = time.time()
+        if not signed_in:
+            session.invalid = True
+            raise SessionLoginFailed(
+                'Could not sign in {}'.format(session.credentials['email'])
+            )
+        session.signed_in_at = session.last_used
+        session.invalid = False
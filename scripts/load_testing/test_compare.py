@@ -0,0 +1,203 @@
+"""
+Tests for compare's statistics, verdicts and SLO gate.
+
+Usage:
+python -m unittest discover -s scripts/load_testing
+"""
+import random
+import unittest
+
+import compare
+import results
+
+
+def run(latencies, seconds=60, failure_rate=0.0, seed=0):
+    """
+    An archive as results.read_archive returns it, with a 'requests'
+    table of {(group, name): mean latency in ms}.
+    """
+    rng = random.Random(seed)
+    table = results.StatsTable(('Method', 'Name'))
+    for (group, name), mean in latencies.items():
+        for _ in range(2000):
+            table.record(
+                group, name, rng.lognormvariate(0, 0.5) * mean,
+                rng.random() < failure_rate
+            )
+    return {
+        'started': 1000.0,
+        'ended': 1000.0 + seconds,
+        'tables': {'requests': ('Requests (ms)', table)},
+    }
+
+
+class StatisticsTest(unittest.TestCase):
+
+    def test_statistic(self):
+        values, counts = [1, 2, 3, 10], [5, 3, 1, 1]
+        self.assertEqual(compare.statistic(values, counts, 0.5), 1)
+        self.assertEqual(compare.statistic(values, counts, 0.8), 2)
+        self.assertEqual(compare.statistic(values, counts, 0.95), 10)
+        self.assertAlmostEqual(compare.statistic(values, counts, None), 2.4)
+        self.assertEqual(compare.statistic([], [], 0.5), 0.0)
+
+    def test_z_value(self):
+        self.assertAlmostEqual(compare.z_value(0.95), 1.95996, places=4)
+        self.assertAlmostEqual(compare.z_value(0.99), 2.57583, places=4)
+
+    def test_poisson_mean(self):
+        rng = random.Random(0)
+        for mean in (0.5, 4, 100):
+            draws = [compare.poisson(rng, mean) for _ in range(20000)]
+            self.assertAlmostEqual(
+                sum(draws) / float(len(draws)), mean, delta=mean * 0.05
+            )
+
+    def test_kolmogorov(self):
+        self.assertEqual(compare.kolmogorov(0.1), 1.0)
+        # Critical values of the Kolmogorov distribution.
+        self.assertAlmostEqual(compare.kolmogorov(1.358), 0.05, places=3)
+        self.assertAlmostEqual(compare.kolmogorov(1.628), 0.01, places=3)
+
+    def test_ks_test(self):
+        same = ([1, 2, 3, 4], [10, 20, 20, 10])
+        self.assertEqual(compare.ks_test(same, same), (0.0, 1.0))
+        shifted = ([2, 3, 4, 5], [10, 20, 20, 10])
+        d, p = compare.ks_test(same, shifted)
+        # At 2: half of base is in, a sixth of shifted.
+        self.assertAlmostEqual(d, 1 / 3.0)
+        self.assertLess(compare.ks_test(
+            ([1, 2], [500, 500]), ([1, 2], [400, 600])
+        )[1], 0.01)
+
+    def test_bootstrap_interval(self):
+        base = ([10, 20, 30, 40], [400, 300, 200, 100])
+        slower = ([11, 22, 33, 44], [400, 300, 200, 100])
+        change, low, high = compare.bootstrap(
+            base, base, None, 500, 0.95, random.Random(0)
+        )
+        self.assertEqual(change, 0)
+        self.assertLess(low, 0)
+        self.assertGreater(high, 0)
+        change, low, high = compare.bootstrap(
+            base, slower, None, 500, 0.95, random.Random(0)
+        )
+        self.assertAlmostEqual(change, 0.1)
+        self.assertTrue(0 < low < change < high)
+
+    def test_rate_change(self):
+        change, low, high = compare.rate_change(1000, 10, 500, 10, 1.96)
+        self.assertAlmostEqual(change, -0.5)
+        self.assertTrue(low < change < high < 0)
+        self.assertIsNone(compare.rate_change(0, 10, 500, 10, 1.96))
+
+    def test_proportion_z(self):
+        self.assertEqual(compare.proportion_z(0, 100, 0, 100), 0.0)
+        self.assertGreater(compare.proportion_z(10, 1000, 50, 1000), 3)
+
+
+class CompareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.latencies = {
+            ('GET', '/account'): 50, ('POST', '/'): 200,
+        }
+        self.base = run(self.latencies)
+
+    def compare(self, candidate, **kwargs):
+        return compare.compare(self.base, candidate, resamples=200, **kwargs)
+
+    def verdicts(self, candidate, **kwargs):
+        return dict(
+            (c.key, c.verdict) for c in self.compare(candidate, **kwargs)
+        )
+
+    def test_same_load_is_noise(self):
+        found = self.verdicts(run(self.latencies, seed=1))
+        self.assertEqual(found, {
+            'requests:GET /account': 'noise', 'requests:POST /': 'noise',
+        })
+
+    def test_slower_regresses(self):
+        slower = dict(self.latencies)
+        slower[('POST', '/')] = 260
+        comparisons = self.compare(run(slower, seed=1))
+        post = [c for c in comparisons if c.key == 'requests:POST /'][0]
+        self.assertEqual(post.verdict, 'regressed')
+        self.assertEqual(post.reasons, ['latency'])
+        self.assertGreater(post.latency[1], 0)
+
+    def test_faster_improves(self):
+        faster = dict(self.latencies)
+        faster[('GET', '/account')] = 35
+        self.assertEqual(
+            self.verdicts(run(faster, seed=1))['requests:GET /account'],
+            'improved'
+        )
+
+    def test_lower_throughput_regresses(self):
+        comparisons = self.compare(
+            run(self.latencies, seconds=90, seed=1)
+        )
+        for c in comparisons:
+            self.assertEqual(c.verdict, 'regressed')
+            self.assertEqual(c.reasons, ['throughput'])
+
+    def test_more_errors_regress(self):
+        comparisons = self.compare(
+            run(self.latencies, failure_rate=0.02, seed=1)
+        )
+        for c in comparisons:
+            self.assertEqual(c.verdict, 'regressed')
+            self.assertEqual(c.reasons, ['errors'])
+
+    def test_missing_and_too_few(self):
+        candidate = run({('GET', '/account'): 50}, seed=1)
+        found = self.verdicts(candidate, min_count=5000)
+        self.assertEqual(found, {
+            'requests:GET /account': 'too few',
+            'requests:POST /': 'missing',
+        })
+
+    def test_entry_names(self):
+        self.assertEqual(
+            compare.entry_name('flows', 'login', results.TOTAL), 'flows:login'
+        )
+        self.assertEqual(
+            compare.entry_name('flows', 'login', 'POST /'),
+            'flows:login POST /'
+        )
+
+
+class GateTest(unittest.TestCase):
+
+    def comparison(self, key, verdict):
+        found = compare.Comparison(key, None, None)
+        found.verdict = verdict
+        return found
+
+    def test_gate(self):
+        comparisons = [
+            self.comparison('flows:login', 'noise'),
+            self.comparison('flows:login POST /', 'regressed'),
+            self.comparison('flows:signup', 'missing'),
+            self.comparison('requests:GET /', 'improved'),
+        ]
+        self.assertEqual(compare.gate(comparisons, []), (0, []))
+        self.assertEqual(compare.gate(comparisons, ['flows:login'])[0], 0)
+        self.assertEqual(compare.gate(comparisons, ['requests:*'])[0], 0)
+
+        status, failed = compare.gate(comparisons, ['flows:login*'])
+        self.assertEqual(status, 1)
+        self.assertEqual(failed[0][1], [comparisons[1]])
+        self.assertEqual(compare.gate(comparisons, ['flows:signup'])[0], 1)
+
+        status, failed = compare.gate(
+            comparisons, ['flows:login*', 'flows:nothing']
+        )
+        self.assertEqual(status, 2)
+        self.assertEqual(failed[1], ('flows:nothing', []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Tests for creds' account leases and the passwords kept in their slots.
+
+Usage:
+python -m unittest discover -s scripts/load_testing
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import creds
+
+
+class WorkerSliceTest(unittest.TestCase):
+
+    def test_slices_cover_every_account_once(self):
+        for count in (1, 3, 7, 1000):
+            ids = []
+            for index in range(count):
+                first, size = creds.worker_slice(1000, index, count)
+                ids.extend(range(first, first + size))
+            self.assertEqual(ids, list(range(1000)))
+
+    def test_out_of_range(self):
+        with self.assertRaises(ValueError):
+            creds.worker_slice(1000, 2, 2)
+
+
+class CredentialLeasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'leases')
+        self.leases = creds.CredentialLeases(10, 3, self.path)
+
+    def tearDown(self):
+        os.close(self.leases._fd)
+        shutil.rmtree(self.dir)
+
+    def test_leases_each_account_once(self):
+        held = [self.leases.acquire(0) for _ in range(3)]
+        self.assertEqual(sorted(c['id'] for c in held), [10, 11, 12])
+        for credentials in held:
+            self.assertEqual(
+                credentials['email'],
+                'testuser{}@example.com'.format(credentials['id'])
+            )
+            self.assertEqual(credentials['password'], creds.DEFAULT_PASSWORD)
+        with self.assertRaises(creds.NoCredentialsAvailable):
+            self.leases.acquire(0)
+
+        self.leases.release(held[1])
+        self.assertEqual(self.leases.acquire(0)['id'], held[1]['id'])
+
+    def test_usable_passes_accounts_over(self):
+        for _ in range(5):
+            with self.leases.lease() as credentials:
+                pass
+        credentials = self.leases.acquire(0, usable=lambda id: id == 12)
+        self.assertEqual(credentials['id'], 12)
+        with self.assertRaises(creds.NoCredentialsAvailable):
+            self.leases.acquire(0, usable=lambda id: id == 12)
+
+    def test_passwords_are_kept_in_slots(self):
+        with self.leases.lease() as credentials:
+            self.leases.set_password(credentials, 'pässword')
+            self.assertEqual(credentials['password'], 'pässword')
+            user_id = credentials['id']
+
+        with open(self.path, 'rb') as f:
+            f.seek(user_id * creds.SLOT_SIZE)
+            slot = f.read(creds.SLOT_SIZE)
+        self.assertEqual(slot, 'pässword'.encode('utf-8').ljust(
+            creds.SLOT_SIZE, b'\0'
+        ))
+        self.assertEqual(
+            self.leases._read_password(user_id), 'pässword'
+        )
+        # Only that account's slot was written.
+        for other in (10, 11, 12):
+            if other != user_id:
+                self.assertEqual(
+                    self.leases._read_password(other), creds.DEFAULT_PASSWORD
+                )
+
+    def test_set_password_checks(self):
+        with self.leases.lease() as credentials:
+            with self.assertRaises(ValueError):
+                self.leases.set_password(
+                    credentials, 'x' * creds.SLOT_SIZE
+                )
+        with self.assertRaises(ValueError):
+            self.leases.set_password(credentials, 'too late')
+
+    def test_exclusive_across_processes(self):
+        held = self.leases.acquire(0)
+
+        def lease_in_child(results):
+            leases = creds.CredentialLeases(10, 3, self.path)
+            results.put(sorted(
+                leases.acquire(0)['id'] for _ in range(2)
+            ))
+            try:
+                leases.acquire(0)
+                results.put('leased a held account')
+            except creds.NoCredentialsAvailable:
+                results.put('exhausted')
+
+        results = multiprocessing.get_context('fork').Queue()
+        child = multiprocessing.get_context('fork').Process(
+            target=lease_in_child, args=(results,)
+        )
+        child.start()
+        child.join()
+        ids = results.get(timeout=5)
+        self.assertNotIn(held['id'], ids)
+        self.assertEqual(results.get(timeout=5), 'exhausted')
+
+        # The child's leases went with it.
+        self.assertEqual(len([self.leases.acquire(0) for _ in range(2)]), 2)
+
+
+class PhoneTest(unittest.TestCase):
+
+    def test_matches_rake_task(self):
+        self.assertEqual(creds.phone(7), '+1 (415) 555-0007')
+        self.assertEqual(creds.phone(999), '+1 (415) 555-0999')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+"""
+Tests for extract's single-pass scan, against pyquery on the recorded
+pages in fixtures/.
+
+Usage:
+python -m unittest discover -s scripts/load_testing
+"""
+import os
+import unittest
+
+import pyquery
+
+import extract
+from extract import Page, authenticity_token
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name + '.html'), 'rb') as f:
+        return f.read()
+
+
+class FixturesTest(unittest.TestCase):
+    """
+    Each page the flows scrape, read both ways.
+    """
+
+    def read(self, name):
+        content = fixture(name)
+        return Page(content), pyquery.PyQuery(content)
+
+    def test_tokens(self):
+        for name in sorted(os.listdir(FIXTURES)):
+            page, dom = self.read(name[:-len('.html')])
+            self.assertEqual(
+                page.authenticity_token(), authenticity_token(dom), name
+            )
+
+    def test_two_factor_code(self):
+        page, dom = self.read('login_two_factor_sms')
+        self.assertTrue(page.code)
+        self.assertEqual(page.code, dom.find('#code').attr('value'))
+
+    def test_account_links(self):
+        page, dom = self.read('account')
+        self.assertEqual(
+            page.link('/manage/password', exact=True),
+            dom.find('a[href="/manage/password"]').attr('href')
+        )
+        self.assertEqual(
+            page.sign_out_link,
+            dom.find('a[href="/api/saml/logout"]').attr('href')
+        )
+
+    def test_confirmation_link(self):
+        page, dom = self.read('sign_up_verify_email')
+        self.assertEqual(
+            page.confirmation_link,
+            dom.find("a[href*='confirmation_token']")[0].attrib['href']
+        )
+
+    def test_confirmation_token(self):
+        page, dom = self.read('sign_up_enter_password')
+        self.assertEqual(
+            page.confirmation_token,
+            dom.find('[name="confirmation_token"]:first').attr('value')
+        )
+
+    def test_form_tokens(self):
+        page, dom = self.read('phone_setup')
+        self.assertEqual(
+            page.authenticity_token('#new_user_phone_form'),
+            authenticity_token(dom, '#new_user_phone_form')
+        )
+        self.assertEqual(
+            page.authenticity_token('new_user_phone_form'),
+            page.authenticity_token('#new_user_phone_form')
+        )
+
+    def test_personal_key(self):
+        page, dom = self.read('sign_up_personal_key')
+        self.assertTrue(page.personal_key)
+        # pyquery joins the words with newlines or spaces, by version.
+        self.assertEqual(
+            page.personal_key.split(),
+            dom.find('.my4.border-box.separator-text').text().split()
+        )
+        self.assertEqual(
+            page.authenticity_token('#confirm-key'),
+            authenticity_token(dom, '#confirm-key')
+        )
+
+
+class ScanTest(unittest.TestCase):
+
+    def test_attribute_quoting(self):
+        page = Page(
+            b'<form id="f" action="/x">'
+            b"<input type='hidden' name='authenticity_token' value='a&amp;b'>"
+            b'<input name="empty" value="">'
+            b'<input name="empty" value="second">'
+            b'</form>'
+            b'<input name="authenticity_token" value="outside">'
+        )
+        self.assertEqual(page.authenticity_token(), 'a&b')
+        self.assertEqual(page.authenticity_token('f'), 'a&b')
+        self.assertEqual(page.inputs['empty'], '')
+        self.assertEqual(page.forms, ['/x'])
+
+    def test_missing_fields(self):
+        page = Page(b'<html><body><p>Nothing here</p></body></html>')
+        self.assertIsNone(page.authenticity_token())
+        self.assertIsNone(page.code)
+        self.assertIsNone(page.confirmation_link)
+        self.assertIsNone(page.personal_key)
+        self.assertEqual(page.assets, [])
+
+    def test_assets(self):
+        page = Page(
+            b'<link rel="stylesheet" href="/assets/app.css">'
+            b'<link rel="icon" href="/favicon.ico">'
+            b'<link rel="apple-touch-icon" href="/touch.png">'
+            b'<link rel="preload" as="font" href="/f.woff2">'
+            b'<link rel="canonical" href="/">'
+            b'<script src="/packs/app.js"></script><script>inline()</script>'
+            b'<img src="/logo.svg"><img alt="none">'
+        )
+        self.assertEqual(page.assets, [
+            ('css', '/assets/app.css'),
+            ('image', '/favicon.ico'),
+            ('font', '/f.woff2'),
+            ('js', '/packs/app.js'),
+            ('image', '/logo.svg'),
+        ])
+
+    def test_resp_to_page_scans_once(self):
+        class Response(object):
+            content = fixture('sign_in')
+            url = 'http://localhost:3000/'
+
+            def raise_for_status(self):
+                pass
+        resp = Response()
+        page = extract.resp_to_page(resp)
+        self.assertIs(extract.resp_to_page(resp), page)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""
+Tests for failures' signatures and the pages sampled for each.
+
+Usage:
+python -m unittest discover -s scripts/load_testing
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import failures
+
+PAGE = (
+    b'<html><div class="alert alert-error" role="alert">'
+    b'Invalid <b>email</b> or password</div></html>'
+)
+
+
+class Response(object):
+
+    def __init__(self, url, status_code=200, content=b''):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+
+
+class SignatureTest(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(
+            failures.normalize(
+                'Wrong redirect. Currently at '
+                'https://idp.example.com/account?id=7&x=y'
+            ),
+            'Wrong redirect. Currently at /account?...'
+        )
+        self.assertEqual(
+            failures.normalize(
+                'No  account for testuser42@example.com\n'
+                '(request 9a3f5e2c-1b2d-4e5f-8a9b-0c1d2e3f4a5b, 3 tries)'
+            ),
+            'No account for <email> (request <id>, N tries)'
+        )
+
+    def test_same_failure_same_signature(self):
+        found = set(
+            failures.signature('POST', '/', failures.Failure(
+                'Not signed in at '
+                'https://idp.example.com/?request_id={}'.format(n),
+                Response('https://idp.example.com/', 200, PAGE)
+            ))
+            for n in range(5)
+        )
+        self.assertEqual(found, set([failures.Signature(
+            'POST', '/', 200,
+            'Not signed in at /?... [Invalid email or password]'
+        )]))
+
+    def test_other_exceptions(self):
+        sig = failures.signature('GET', '/api', ValueError('bad 12'))
+        self.assertEqual(sig, failures.Signature(
+            'GET', '/api', 0, 'ValueError: bad N'
+        ))
+
+    def test_long_text_is_cut(self):
+        sig = failures.signature('GET', '/', failures.Failure('x ' * 200))
+        self.assertEqual(len(sig.text), failures.MAX_TEXT)
+        self.assertTrue(sig.text.endswith('...'))
+
+
+class FailureLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        random.seed(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def failure(self, n, status=500):
+        return failures.Failure(
+            'Failed for user {}'.format(n),
+            Response('https://idp.example.com/', status, PAGE)
+        )
+
+    def test_reservoir_keeps_samples_pages(self):
+        log = failures.FailureLog(self.dir, samples=3)
+        for n in range(200):
+            sig = log.record('POST', '/', self.failure(n))
+        self.assertEqual(log.counts, {sig: 200})
+        path = log.path(sig)
+        self.assertEqual(
+            sorted(os.listdir(path)),
+            ['0.html', '1.html', '2.html', 'signature.txt']
+        )
+        kept = set()
+        for name in ('0.html', '1.html', '2.html'):
+            with open(os.path.join(path, name), 'rb') as f:
+                first = f.readline().decode('utf-8')
+                self.assertTrue(first.startswith('<!-- POST https://'))
+                kept.add(first.rsplit('user ', 1)[1].split()[0])
+                self.assertEqual(f.read(), PAGE)
+        # The first pages kept have been replaced by later ones.
+        self.assertNotEqual(kept, set(['0', '1', '2']))
+
+    def test_no_samples(self):
+        log = failures.FailureLog(self.dir, samples=0)
+        log.record('POST', '/', self.failure(1))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_signatures_past_the_cap_are_other(self):
+        log = failures.FailureLog(self.dir, samples=0, max_signatures=2)
+        for status in (500, 502, 503, 504, 504):
+            log.record('POST', '/', self.failure(1, status))
+        self.assertEqual(len(log.seen), 4)
+        others = [sig for sig in log.counts if sig.text == failures.OTHER]
+        self.assertEqual(
+            sorted((sig.status, log.counts[sig]) for sig in others),
+            [(503, 1), (504, 2)]
+        )
+
+    def test_merge(self):
+        worker = failures.FailureLog(self.dir, samples=0)
+        for n in range(3):
+            worker.record('POST', '/', self.failure(n))
+        master = failures.FailureLog(self.dir, samples=0)
+        master.merge(worker.serialize())
+        master.merge(worker.serialize())
+        self.assertEqual(list(master.counts.values()), [6])
+
+
+if __name__ == '__main__':
+    unittest.main()
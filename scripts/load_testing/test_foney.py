@@ -0,0 +1,96 @@
+"""
+Tests for foney's lazy phone number space.
+
+Usage:
+python -m unittest discover -s scripts/load_testing
+"""
+import unittest
+
+import foney
+
+
+class ShuffledTest(unittest.TestCase):
+
+    def test_visits_every_position_once(self):
+        for size in (0, 1, 2, 3, 10, 97, 1000):
+            order = list(foney.shuffled(size, seed=size))
+            self.assertEqual(sorted(order), list(range(size)))
+
+    def test_same_seed_same_order(self):
+        self.assertEqual(
+            list(foney.shuffled(500, seed=7)),
+            list(foney.shuffled(500, seed=7))
+        )
+
+
+class PhoneNumberSpaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.space = foney.PhoneNumberSpace(
+            npas=(206, 415), cos=(555, 556, 557), subscribers=range(1, 11)
+        )
+
+    def test_matches_eager_list(self):
+        eager = [
+            '{}{}{:04d}'.format(npa, co, sub)
+            for npa in (206, 415) for co in (555, 556, 557)
+            for sub in range(1, 11)
+        ]
+        self.assertEqual(len(self.space), len(eager))
+        self.assertEqual(list(self.space), eager)
+        self.assertEqual(self.space[7], eager[7])
+        self.assertEqual(self.space[-1], eager[-1])
+        self.assertEqual(list(self.space[5:25:3]), eager[5:25:3])
+
+    def test_index_and_contains(self):
+        for i, number in enumerate(self.space):
+            self.assertEqual(self.space.index(number), i)
+            self.assertIn(number, self.space)
+        self.assertNotIn('2065550011', self.space)
+        self.assertNotIn('9995550001', self.space)
+        self.assertNotIn('206555001', self.space)
+        self.assertNotIn('2065550001', self.space[1:])
+
+    def test_unique_draws_whole_space_without_repeats(self):
+        drawn = list(self.space.unique(seed=3))
+        self.assertEqual(len(drawn), len(self.space))
+        self.assertEqual(sorted(drawn), sorted(self.space))
+
+    def test_shards_are_disjoint_and_cover_space(self):
+        for count in (1, 2, 7, len(self.space)):
+            shards = [self.space.shard(i, count) for i in range(count)]
+            numbers = [number for shard in shards for number in shard]
+            self.assertEqual(numbers, list(self.space))
+            self.assertTrue(
+                max(map(len, shards)) - min(map(len, shards)) <= 1
+            )
+
+    def test_unique_stays_in_its_shard(self):
+        shard = self.space.shard(1, 3)
+        drawn = list(shard.unique(seed=0))
+        self.assertEqual(sorted(drawn), sorted(shard))
+        for other in (self.space.shard(0, 3), self.space.shard(2, 3)):
+            self.assertFalse(set(drawn) & set(other))
+
+    def test_shard_out_of_range(self):
+        with self.assertRaises(ValueError):
+            self.space.shard(3, 3)
+
+    def test_default_space_is_lazy(self):
+        space = foney.PhoneNumberSpace()
+        self.assertEqual(
+            len(space),
+            len(foney.area_codes()) * len(foney.prefixes()) * 999
+        )
+        number = space[len(space) // 2]
+        self.assertEqual(space.index(number), len(space) // 2)
+
+    def test_phone_numbers_keeps_old_order(self):
+        numbers = foney.phone_numbers()
+        self.assertEqual(numbers[0], '2062000001')
+        self.assertEqual(numbers[998], '2062000999')
+        self.assertEqual(numbers[999], '2062010001')
+
+
+if __name__ == '__main__':
+    unittest.main()
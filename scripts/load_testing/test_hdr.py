@@ -0,0 +1,145 @@
+"""
+Tests for hdr's histograms: precision, merging and encoding.
+
+Usage:
+python -m unittest discover -s scripts/load_testing
+"""
+import base64
+import random
+import unittest
+import zlib
+
+import hdr
+
+
+def exact_percentile(values, percent):
+    values = sorted(values)
+    return values[max(int(len(values) * percent + 0.5), 1) - 1]
+
+
+class HistogramTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        # Microsecond-precise ms, from well under a ms to minutes.
+        self.values = [
+            round(rng.lognormvariate(3, 2), 3) for _ in range(20000)
+        ]
+
+    def filled(self, values, digits=2):
+        histogram = hdr.Histogram(digits)
+        for ms in values:
+            histogram.record(ms)
+        return histogram
+
+    def test_buckets_round_trip(self):
+        histogram = hdr.Histogram(2)
+        for index in range(len(histogram.counts)):
+            highest = histogram._highest_equivalent(index)
+            self.assertEqual(histogram._index(highest), index)
+            self.assertEqual(histogram._index(highest + 1), index + 1)
+
+    def test_percentiles_within_precision(self):
+        for digits in (1, 2, 3):
+            histogram = self.filled(self.values, digits)
+            for percent in (0.01, 0.5, 0.9, 0.95, 0.99, 0.999):
+                exact = exact_percentile(self.values, percent)
+                found = histogram.percentile(percent)
+                self.assertGreaterEqual(found, exact)
+                self.assertLessEqual(
+                    found, exact * (1 + 10 ** -digits) + 0.001
+                )
+
+    def test_summary_stats(self):
+        histogram = self.filled(self.values)
+        self.assertEqual(histogram.count, len(self.values))
+        self.assertAlmostEqual(
+            histogram.avg, sum(self.values) / len(self.values), places=3
+        )
+        self.assertEqual(histogram.min, min(self.values))
+        self.assertEqual(histogram.max, max(self.values))
+        self.assertEqual(histogram.percentile(1), max(self.values))
+        self.assertEqual(
+            sum(count for _, count in histogram.buckets()), len(self.values)
+        )
+
+    def test_out_of_range_values_are_clamped(self):
+        histogram = hdr.Histogram()
+        histogram.record(-5)
+        histogram.record(10 * 3600 * 1000)
+        self.assertEqual(histogram.min, 0)
+        self.assertEqual(histogram.max, hdr.HIGHEST_TRACKABLE / 1000.0)
+
+    def test_merge_loses_nothing(self):
+        half = len(self.values) // 2
+        merged = self.filled(self.values[:half])
+        merged.merge(self.filled(self.values[half:]))
+        whole = self.filled(self.values)
+        self.assertEqual(merged.counts, whole.counts)
+        self.assertEqual(
+            (merged.count, merged.total, merged.min, merged.max),
+            (whole.count, whole.total, whole.min, whole.max)
+        )
+
+    def test_merge_needs_same_digits(self):
+        with self.assertRaises(ValueError):
+            hdr.Histogram(2).merge(hdr.Histogram(3))
+
+    def test_subtract_leaves_what_came_since(self):
+        half = len(self.values) // 2
+        histogram = self.filled(self.values)
+        histogram.subtract(self.filled(self.values[:half]))
+        since = self.filled(self.values[half:])
+        self.assertEqual(histogram.counts, since.counts)
+        self.assertEqual(histogram.count, since.count)
+        self.assertEqual(histogram.percentile(0.5), since.percentile(0.5))
+
+    def test_encode_round_trip(self):
+        histogram = self.filled(self.values, 3)
+        histogram.record(12, failed=True)
+        decoded = hdr.Histogram.decode(histogram.encode())
+        self.assertEqual(decoded.digits, 3)
+        self.assertEqual(decoded.counts, histogram.counts)
+        self.assertEqual(
+            (decoded.count, decoded.failures, decoded.total, decoded.min,
+             decoded.max),
+            (histogram.count, 1, histogram.total, histogram.min,
+             histogram.max)
+        )
+        self.assertEqual(
+            hdr.Histogram.unserialize(histogram.serialize()).counts,
+            histogram.counts
+        )
+
+    def test_encode_empty(self):
+        decoded = hdr.Histogram.decode(hdr.Histogram().encode())
+        self.assertEqual(decoded.count, 0)
+        self.assertEqual(decoded.min, 0)
+        self.assertEqual(decoded.percentile(0.99), 0)
+
+    def test_encoding_is_compact(self):
+        histogram = self.filled(self.values)
+        self.assertLess(len(histogram.encode()), 4096)
+
+    def test_unknown_version(self):
+        data = bytearray(zlib.decompress(
+            base64.b64decode(hdr.Histogram().encode())
+        ))
+        data[0] = hdr.VERSION + 1
+        with self.assertRaises(ValueError):
+            hdr.Histogram.decode(base64.b64encode(zlib.compress(bytes(data))))
+
+
+class VarintTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for n in (0, 1, -1, 63, -64, 127, 128, 2 ** 40, -(2 ** 40)):
+            out = bytearray()
+            hdr.write_varint(out, hdr.zigzag(n))
+            value, pos = hdr.read_varint(bytes(out), 0)
+            self.assertEqual(hdr.unzigzag(value), n)
+            self.assertEqual(pos, len(out))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Tests for pacing's buckets of OTP sends, with the time passed in.
+
+Usage:
+python -m unittest discover -s scripts/load_testing
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import creds
+import pacing
+
+PHONE = '+1 (415) 555-0007'
+
+
+class PacerTest(unittest.TestCase):
+
+    def setUp(self):
+        # The IdP's defaults: 10 sends, then 5 minutes of quiet.
+        self.pacer = pacing.Pacer(10, 300, headroom=2)
+
+    def send(self, count, now):
+        for _ in range(count):
+            self.assertEqual(self.pacer.ready_in(PHONE, now), 0)
+            self.pacer.sent(PHONE, now)
+
+    def test_capacity_leaves_headroom(self):
+        self.assertEqual(self.pacer.capacity, 8)
+        self.send(8, 1000)
+        self.assertEqual(
+            self.pacer.ready_in(PHONE, 1000), 300 + pacing.MARGIN
+        )
+        self.assertEqual(
+            self.pacer.ready_in(PHONE, 1100), 200 + pacing.MARGIN
+        )
+        # Other numbers have buckets of their own.
+        self.assertEqual(self.pacer.ready_in('+1 (415) 555-0008', 1000), 0)
+
+    def test_sends_keep_the_bucket_from_filling(self):
+        # A send less than findtime after the last keeps the count going,
+        # however long ago the first was.
+        for i in range(8):
+            self.send(1, 1000 + i * 200)
+        last = 1000 + 7 * 200
+        self.assertEqual(
+            self.pacer.ready_in(PHONE, last + 1), 300 + pacing.MARGIN - 1
+        )
+
+    def test_fills_after_findtime_and_margin(self):
+        self.send(8, 1000)
+        self.assertGreater(
+            self.pacer.ready_in(PHONE, 1000 + 300 + pacing.MARGIN - 0.01), 0
+        )
+        now = 1000 + 300 + pacing.MARGIN + 0.01
+        self.assertEqual(self.pacer.ready_in(PHONE, now), 0)
+        self.send(1, now)
+        self.assertEqual(self.pacer.buckets[PHONE].count, 1)
+        self.send(7, now)
+        self.assertGreater(self.pacer.ready_in(PHONE, now), 0)
+
+    def test_headroom_must_leave_a_send(self):
+        with self.assertRaises(ValueError):
+            pacing.Pacer(2, 60, headroom=2)
+        self.assertEqual(pacing.Pacer(2, 60, headroom=1).capacity, 1)
+
+    def test_sweep_forgets_full_buckets(self):
+        self.pacer.sent(PHONE, 1000)
+        self.pacer.sent('+1 (415) 555-0008', 1200)
+        self.pacer.sweep(1000 + 300 + pacing.MARGIN + 1)
+        self.assertEqual(list(self.pacer.buckets), ['+1 (415) 555-0008'])
+
+
+class ReadLimitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'application.yml')
+        with open(self.path, 'w') as f:
+            f.write(
+                'development:\n'
+                "  otp_delivery_blocklist_findtime: '5'\n"
+                "  otp_delivery_blocklist_maxretry: '10' # sends\n"
+                '\n'
+                'production:\n'
+                '  otp_delivery_blocklist_maxretry: 3\n'
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_limits(self):
+        self.assertEqual(pacing.read_limits(self.path), (10, 5.0))
+
+    def test_missing_setting(self):
+        with self.assertRaises(ValueError):
+            pacing.read_limits(self.path, 'production')
+
+
+class PacedLeasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.leases = creds.CredentialLeases(
+            10, 2, os.path.join(self.dir, 'leases')
+        )
+        # Long enough that no bucket fills up during the test.
+        self.pacer = pacing.Pacer(2, 3600)
+        pacing.pace(self.leases, self.pacer)
+
+    def tearDown(self):
+        os.close(self.leases._fd)
+        shutil.rmtree(self.dir)
+
+    def test_accounts_with_empty_buckets_are_passed_over(self):
+        self.pacer.sent(creds.phone(10))
+        for _ in range(3):
+            credentials = self.leases.acquire()
+            self.assertEqual(credentials['id'], 11)
+            self.leases.release(credentials)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""
+Tests for timeseries' block format: writing, reading back a window, and
+reading a file cut short.
+
+Usage:
+python -m unittest discover -s scripts/load_testing
+"""
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+import results
+import timeseries
+
+TABLE = 'test timeseries'
+stats = results.table(TABLE, 'Time series test (ms)', ('Group', 'Name'))
+
+
+class TimeSeriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'run.ts')
+
+    def tearDown(self):
+        del stats.taps[:]
+        shutil.rmtree(self.dir)
+
+    def write(self, seconds=35, flush_every=10):
+        """
+        One record a second for `seconds`, the ith of them i ms, and the
+        time the first second started.
+        """
+        writer = timeseries.TimeSeriesWriter(
+            self.path, [TABLE], interval=1.0, flush_every=flush_every
+        )
+        writer.attach()
+        stats.record('GET', '/', 0)
+        start = writer.started
+        for i in range(1, seconds):
+            writer.roll(start + i)
+            stats.record('GET', '/', i)
+        writer.roll(start + seconds)
+        writer.close()
+        del stats.taps[:]
+        return start
+
+    def blocks(self):
+        """
+        (kind, offset of its payload, size) of every block in the file.
+        """
+        found = []
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        pos = len(timeseries.MAGIC)
+        while pos < len(data):
+            kind, size, _, _ = timeseries.BLOCK.unpack_from(data, pos)
+            pos += timeseries.BLOCK.size
+            found.append((kind, pos, size))
+            pos += size
+        return found
+
+    def test_round_trip(self):
+        start = self.write()
+        records = list(timeseries.read_records(self.path))
+        self.assertIn('version', records[0])
+        self.assertEqual(records[0]['tables'][TABLE]['labels'],
+                         ['Group', 'Name'])
+        data = records[1:]
+        self.assertEqual([r['t'] for r in data],
+                         [start + i for i in range(35)])
+
+        (_, _, table), = [
+            (first, seconds, tables[TABLE][1])
+            for first, seconds, tables, _ in timeseries.aggregate([self.path])
+        ]
+        entry = table.entries[('GET', '/')]
+        self.assertEqual(entry.count, 35)
+        self.assertEqual(entry.max, 34)
+
+    def test_blocks_per_flush(self):
+        self.write()
+        kinds = [kind for kind, _, _ in self.blocks()]
+        # A header, then one block per ten seconds and the rest on close.
+        self.assertEqual(kinds, [timeseries.HEADER] + [timeseries.DATA] * 4)
+
+    def test_window(self):
+        start = self.write()
+        found = [
+            record['t'] - start
+            for _, record in timeseries.read([self.path], start + 12,
+                                             start + 15)
+        ]
+        self.assertEqual(found, [12, 13, 14])
+
+        rows = list(timeseries.aggregate(
+            [self.path], start + 10, start + 30, every=10
+        ))
+        # Buckets line up with the clock, not with the window.
+        for first, seconds, tables, _ in rows:
+            self.assertEqual(first % 10, 0)
+        self.assertEqual(sum(
+            tables[TABLE][1].entries[('GET', '/')].count
+            for _, _, tables, _ in rows
+        ), 20)
+
+    def test_blocks_outside_window_are_skipped_unread(self):
+        start = self.write()
+        # Spoil the first data block; a window past it must not read it.
+        _, offset, size = self.blocks()[1]
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(b'\0' * size)
+        found = [
+            record['t'] - start
+            for _, record in timeseries.read([self.path], start + 20)
+        ]
+        self.assertEqual(found, list(range(20, 35)))
+        with self.assertRaises(zlib.error):
+            list(timeseries.read([self.path]))
+
+    def test_file_cut_short(self):
+        start = self.write()
+        _, offset, size = self.blocks()[-1]
+        for cut in (offset + size // 2, offset - 3):
+            with open(self.path, 'r+b') as f:
+                f.truncate(cut)
+            found = [
+                record['t'] - start
+                for _, record in timeseries.read([self.path])
+            ]
+            # Every block but the one cut short.
+            self.assertEqual(found, list(range(30)))
+
+    def test_runs_append(self):
+        self.write(seconds=3)
+        self.write(seconds=3)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read().count(timeseries.MAGIC), 1)
+        kinds = [kind for kind, _, _ in self.blocks()]
+        self.assertEqual(kinds.count(timeseries.HEADER), 2)
+        self.assertEqual(
+            len(list(timeseries.read_records(self.path))), 2 + 3 + 3
+        )
+
+    def test_not_a_time_series(self):
+        with open(self.path, 'wb') as f:
+            f.write(struct.pack('>I', 0))
+        with self.assertRaises(ValueError):
+            list(timeseries.read_records(self.path))
+
+    def test_parse_when(self):
+        self.assertEqual(timeseries.parse_when('2h10m', 1000), 1000 + 7800)
+        self.assertEqual(timeseries.parse_when('90', 1000), 1090)
+        self.assertEqual(
+            timeseries.parse_when('1500000000', 1000), 1500000000
+        )
+        with self.assertRaises(ValueError):
+            timeseries.parse_when('soon', 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
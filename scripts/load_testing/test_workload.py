@@ -0,0 +1,94 @@
+"""
+Tests for workload's journey counts and the weights made from them.
+
+Usage:
+python -m unittest discover -s scripts/load_testing
+"""
+import unittest
+
+import workload
+
+MARKERS = dict(
+    (task, (method or 'GET', controller, action))
+    for task, method, controller, action in workload.JOURNEYS
+)
+
+
+class WorkloadModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = workload.WorkloadModel()
+        self.when = 1500000000.0
+
+    def journeys(self, task, count, status=200, method=None):
+        marker_method, controller, action = MARKERS[task]
+        for _ in range(count):
+            self.when += 1
+            self.model.add(self.when, {
+                'method': method or marker_method,
+                'controller': controller,
+                'action': action,
+                'status': status,
+            })
+
+    def test_overlaps_are_taken_off(self):
+        # Every sign-in ends on /account, and so does every signup; a
+        # password change or partner sign-in starts with a sign-in.
+        self.journeys('idp_change_pass', 10)
+        self.journeys('oidc_sign_in', 5)
+        self.journeys('saml_sign_in', 5, method='POST')
+        self.journeys('idp_login_logout', 100)
+        self.journeys('idp_create_account', 20)
+        self.journeys('idp_signed_in_pages', 300)
+        self.assertEqual(self.model.counts(), {
+            'idp_change_pass': 10,
+            'oidc_sign_in': 5,
+            'saml_sign_in': 5,
+            'idp_login_logout': 80,
+            'idp_create_account': 20,
+            # Less every sign-in, not just the plain ones.
+            'idp_signed_in_pages': 180,
+        })
+
+    def test_overlap_never_goes_negative(self):
+        self.journeys('idp_login_logout', 10)
+        self.journeys('idp_signed_in_pages', 4)
+        counts = self.model.counts()
+        self.assertEqual(counts['idp_signed_in_pages'], 0)
+        self.assertNotIn('idp_signed_in_pages', self.model.weights())
+
+    def test_failed_and_other_requests_are_not_journeys(self):
+        self.journeys('idp_login_logout', 3, status=401)
+        self.journeys('idp_login_logout', 2, method='GET')
+        self.model.add(self.when, {
+            'method': 'GET', 'controller': 'PagesController',
+            'action': 'index', 'status': 200,
+        })
+        self.assertEqual(self.model.counts(), {})
+        self.assertEqual(self.model.requests, 6)
+
+    def test_weights(self):
+        self.journeys('idp_login_logout', 600)
+        self.journeys('idp_create_account', 399)
+        self.journeys('idp_change_pass', 1)
+        self.assertEqual(self.model.weights(), {
+            # 599 of 999, once the password change's sign-in is off.
+            'idp_login_logout': 600,
+            'idp_create_account': 399,
+            'idp_change_pass': 1,
+        })
+
+    def test_rare_journeys_keep_a_weight(self):
+        self.journeys('idp_login_logout', 10000)
+        self.journeys('idp_verify', 1)
+        weights = self.model.weights()
+        self.assertEqual(weights['idp_login_logout'], workload.WEIGHT_SCALE)
+        self.assertEqual(weights['idp_verify'], 1)
+
+    def test_no_journeys(self):
+        self.assertEqual(self.model.counts(), {})
+        self.assertEqual(self.model.weights(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
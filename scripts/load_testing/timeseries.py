@@ -0,0 +1,399 @@
+"""
+Per-second results on disk, for soak runs that last for hours.
+
+End-of-run totals hide what happened along the way, such as latency
+creeping up as NO_LOGOUT runs pile up open sessions. With TIMESERIES
+set, every second's requests and flows (counts, failures and the
+latency distribution of each endpoint and flow, see results.py) and the
+number of running users are appended to a compressed file as the run
+goes. Only the current second and the seconds not yet written are held
+in memory, so however long the run, memory stays the same.
+
+The file starts with MAGIC, then a header block for each run written to
+it, then a data block per TIMESERIES_FLUSH seconds. Each block starts
+with its kind, compressed size and the times of its first and last
+record, then zlib-compressed JSON lines. A reader skips data blocks
+outside the window it wants without decompressing them, and a run that
+was killed part way leaves every block but the last readable.
+
+Settings:
+* TIMESERIES: the file to append to. Workers of a distributed run each
+  write their own, with their WORKER_INDEX appended.
+* TIMESERIES_TABLES: which results tables to record (default
+  'requests,flows,health'; health.py's is empty unless HEALTH_POLL is
+  set).
+* TIMESERIES_INTERVAL: seconds per record (default 1).
+* TIMESERIES_FLUSH: seconds per block on disk (default 10).
+
+Usage, to read one back (files from every worker can be given together):
+python timeseries.py run.ts* --from 2h --to 2h10m [--every 60] [--csv]
+"""
+import argparse
+import csv
+import heapq
+import json
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+
+import gevent
+import locust
+from locust import runners
+
+import results
+
+MAGIC = b'LTS1'
+# Kind, compressed size, and the times of the first and last record.
+BLOCK = struct.Struct('>BIdd')
+HEADER, DATA = 0, 1
+VERSION = 1
+
+
+def worker_path(path):
+    index = os.getenv('WORKER_INDEX')
+    return path if index is None else '{}.{}'.format(path, index)
+
+
+class TimeSeriesWriter(object):
+    """
+    Appends the named tables' records, one interval at a time. The file
+    is opened on the first record.
+    """
+
+    def __init__(self, path, names, interval=1.0, flush_every=10.0):
+        self.path = path
+        self.names = names
+        self.interval = interval
+        self.flush_every = flush_every
+        self.current = {}
+        self.started = None
+        self.pending = []
+        self.file = None
+        self.closed = False
+        self._ticker = None
+
+    def attach(self):
+        for name in self.names:
+            if name in results.tables:
+                results.tables[name][1].taps.append(self._tap(name))
+
+    def _tap(self, name):
+        _, source = results.tables[name]
+
+        def tap(group, entry, ms, failed):
+            if self.closed:
+                return
+            if self.file is None:
+                self.open()
+            table = self.current.get(name)
+            if table is None:
+                table = self.current[name] = results.StatsTable(
+                    source.labels, source.nested, source.backend
+                )
+            table.record(group, entry, ms, failed)
+        return tap
+
+    def open(self):
+        new = not os.path.exists(self.path) or not os.path.getsize(self.path)
+        self.file = open(self.path, 'ab')
+        if new:
+            self.file.write(MAGIC)
+        now = time.time()
+        self.started = now - now % self.interval
+        self._write_block(HEADER, [{
+            'version': VERSION,
+            'run_started': results.started,
+            'interval': self.interval,
+            'tables': dict(
+                (name, {
+                    'title': results.tables[name][0],
+                    'labels': list(results.tables[name][1].labels),
+                    'nested': results.tables[name][1].nested,
+                })
+                for name in self.names if name in results.tables
+            ),
+        }], now, now)
+        self._ticker = gevent.spawn(self._tick)
+
+    def _tick(self):
+        while True:
+            gevent.sleep(self.started + self.interval - time.time())
+            self.roll()
+
+    def roll(self, now=None):
+        """
+        Closes the current interval and starts the next.
+        """
+        now = time.time() if now is None else now
+        if self.current:
+            runner = runners.locust_runner
+            self.pending.append({
+                't': self.started,
+                'dt': round(now - self.started, 3),
+                'users': runner.user_count if runner else None,
+                'tables': dict(
+                    (name, table.serialize())
+                    for name, table in self.current.items()
+                ),
+            })
+            self.current = {}
+        self.started = now
+        if self.pending and (
+            now - self.pending[0]['t'] >= self.flush_every
+        ):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self._write_block(
+                DATA, self.pending, self.pending[0]['t'], self.pending[-1]['t']
+            )
+            self.pending = []
+
+    def _write_block(self, kind, records, first, last):
+        payload = zlib.compress('\n'.join(
+            json.dumps(record, separators=(',', ':')) for record in records
+        ).encode('utf-8'))
+        self.file.write(BLOCK.pack(kind, len(payload), first, last) + payload)
+        self.file.flush()
+
+    def close(self):
+        self.closed = True
+        if self.file is None:
+            return
+        if self._ticker is not None:
+            self._ticker.kill()
+        self.roll()
+        self.flush()
+        self.file.close()
+        self.file = None
+
+
+def read_records(path, start=None, end=None):
+    """
+    Every record (headers included) that could fall in [start, end), in
+    file order. Blocks wholly outside the window are skipped unread.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a time series file'.format(path))
+        while True:
+            header = f.read(BLOCK.size)
+            if len(header) < BLOCK.size:
+                return
+            kind, size, first, last = BLOCK.unpack(header)
+            if kind == DATA and (
+                (start is not None and last < start)
+                or (end is not None and first >= end)
+            ):
+                f.seek(size, os.SEEK_CUR)
+                continue
+            payload = f.read(size)
+            if len(payload) < size:
+                # The run was killed while writing this block.
+                return
+            for line in zlib.decompress(payload).decode('utf-8').split('\n'):
+                yield json.loads(line)
+
+
+def read(paths, start=None, end=None):
+    """
+    (tables, record) for every interval starting in [start, end) across
+    all paths, in time order. tables is {name: (title, labels, nested)}
+    from the headers read so far.
+    """
+    tables = {}
+
+    def intervals(path):
+        for record in read_records(path, start, end):
+            if 'version' in record:
+                for name, meta in record['tables'].items():
+                    tables[name] = (
+                        meta['title'], meta['labels'], meta['nested']
+                    )
+                continue
+            if start is not None and record['t'] < start:
+                continue
+            if end is not None and record['t'] >= end:
+                continue
+            yield record['t'], record
+
+    streams = [intervals(path) for path in paths]
+    for _, record in heapq.merge(*streams, key=lambda item: item[0]):
+        yield tables, record
+
+
+def run_started(paths):
+    """
+    When the earliest run in these files started.
+    """
+    started = None
+    for path in paths:
+        for record in read_records(path, end=0):
+            if 'version' in record:
+                if started is None or record['run_started'] < started:
+                    started = record['run_started']
+                break
+    return started
+
+
+def aggregate(paths, start=None, end=None, every=None):
+    """
+    (start, seconds, {name: (title, StatsTable)}, peak users) for each
+    `every` seconds of the window, or once for all of it.
+    """
+    bucket = None
+    merged = users = None
+    first = last = None
+
+    def done():
+        return first, last - first, merged, users
+
+    for tables, record in read(paths, start, end):
+        key = int(record['t'] // every) if every else 0
+        if bucket is not None and key != bucket:
+            yield done()
+            merged = None
+        if merged is None:
+            bucket = key
+            merged = {}
+            users = None
+            first = record['t'] if not every else key * every
+        for name, stats in record['tables'].items():
+            title, labels, nested = tables[name]
+            if name not in merged:
+                merged[name] = (
+                    title, results.StatsTable(labels, nested, stats['backend'])
+                )
+            merged[name][1].merge(stats)
+        if record.get('users') is not None:
+            users = max(users or 0, record['users'])
+        last = record['t'] + record['dt']
+    if merged is not None:
+        yield done()
+
+
+def parse_when(value, started):
+    """
+    An epoch time, or an offset from the start of the run like '90',
+    '15m' or '2h10m'.
+    """
+    if value is None:
+        return None
+    if re.match(r'^\d+(\.\d+)?$', value) and float(value) > 10 ** 9:
+        return float(value)
+    match = re.match(
+        r'^(?:([\d.]+)h)?(?:([\d.]+)m)?(?:([\d.]+)s?)?$', value
+    )
+    if not value or match is None:
+        raise ValueError('Bad time {!r}'.format(value))
+    hours, minutes, seconds = (float(part or 0) for part in match.groups())
+    return (started or 0) + hours * 3600 + minutes * 60 + seconds
+
+
+def write_series(rows, out):
+    writer = csv.writer(out)
+    writer.writerow([
+        'time', 'seconds', 'users', 'table', 'group', 'name', 'count',
+        'failures', 'per_second', 'avg', 'p50', 'p95', 'p99', 'max',
+    ])
+    for start, seconds, tables, users in rows:
+        for name, (_, table) in tables.items():
+            for group, entry in table.keys():
+                distribution = table.entries[(group, entry)]
+                writer.writerow([
+                    round(start, 3), round(seconds, 3), users, name, group,
+                    entry, distribution.count, distribution.failures,
+                    round(distribution.count / seconds, 3) if seconds else '',
+                ] + [
+                    round(value, 3) for value in (
+                        distribution.avg,
+                        distribution.percentile(0.5),
+                        distribution.percentile(0.95),
+                        distribution.percentile(0.99),
+                        distribution.max,
+                    )
+                ])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Reads back a TIMESERIES file, for a window of the run.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--from', dest='start', metavar='WHEN',
+                        help="from this far into the run ('90', '15m', "
+                             "'2h10m') or epoch time")
+    parser.add_argument('--to', dest='end', metavar='WHEN',
+                        help='up to here, likewise')
+    parser.add_argument('--every', type=float, metavar='SECONDS',
+                        help='one result per this many seconds, rather than '
+                             'one for the whole window')
+    parser.add_argument('--table', action='append',
+                        help='only these tables (default all)')
+    parser.add_argument('--csv', action='store_true',
+                        help='write rows of CSV instead of tables')
+    args = parser.parse_args()
+
+    started = run_started(args.paths)
+    rows = aggregate(
+        args.paths,
+        parse_when(args.start, started),
+        parse_when(args.end, started),
+        args.every,
+    )
+    if args.table:
+        rows = (
+            (start, seconds, dict(
+                (name, table) for name, table in tables.items()
+                if name in args.table
+            ), users)
+            for start, seconds, tables, users in rows
+        )
+    if args.csv:
+        write_series(rows, sys.stdout)
+        return
+    for start, seconds, tables, users in rows:
+        sys.stdout.write(
+            '{} to {} ({:.0f}s into the run, {} users)\n\n'.format(
+                time.strftime('%H:%M:%S', time.localtime(start)),
+                time.strftime('%H:%M:%S', time.localtime(start + seconds)),
+                start - (started or start), users
+            )
+        )
+        for name, (title, table) in tables.items():
+            table.print_table(title)
+
+
+_writer = None
+
+
+def on_start_hatching():
+    # Every results table exists once locust starts hatching. A master
+    # never gets here, nor records anything of its own.
+    global _writer
+    if _writer is None and os.getenv('TIMESERIES'):
+        _writer = TimeSeriesWriter(
+            worker_path(os.getenv('TIMESERIES')),
+            os.getenv('TIMESERIES_TABLES', 'requests,flows,health').split(','),
+            float(os.getenv('TIMESERIES_INTERVAL', 1)),
+            float(os.getenv('TIMESERIES_FLUSH', 10)),
+        )
+        _writer.attach()
+
+
+def on_quitting():
+    if _writer is not None:
+        _writer.close()
+
+
+locust.events.locust_start_hatching += on_start_hatching
+locust.events.quitting += on_quitting
+
+
+if __name__ == '__main__':
+    main()
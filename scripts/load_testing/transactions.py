@@ -0,0 +1,165 @@
+"""
+Flow-level transactions with a per-step latency breakdown.
+
+Locust reports single HTTP requests, but our SLOs are on whole journeys:
+how long login() takes from / through 2FA, how long signup() takes from
+/sign_up/start to the personal key. Wrapping a helper with @flow('name')
+times it as one transaction. Every request it makes, including each
+redirect hop, becomes a step of that transaction, as does the time spent
+parsing pages on the client and any flows nested inside it.
+
+Results go into their own 'flows' table (see results.py), with
+percentiles per flow and per step.
+"""
+import functools
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import gevent
+import locust
+from locust.exception import InterruptTaskSet, StopLocust
+
+import results
+
+flow_stats = results.table(
+    'flows', 'Flow transactions (ms)', ('Flow', 'Step'), nested=True
+)
+
+# Transactions in progress, innermost last, per greenlet.
+_active = {}
+# Called with every outermost transaction as it ends, e.g. by replay.py.
+finished = []
+# How locust stops a user, or leaves a nested TaskSet, part way through
+# a task: none of them mean the flow failed.
+STOPPED = (gevent.GreenletExit, StopLocust, InterruptTaskSet)
+
+
+class Transaction(object):
+    """
+    One run of a flow. `start` defaults to now, but can be an earlier
+    intended start so that any lag counts against the flow.
+    """
+
+    def __init__(self, name, start=None):
+        self.name = name
+        self.start = time.time() if start is None else start
+        self.elapsed = None
+        self.failed = False
+        self.steps = OrderedDict()
+        self._following_redirect = False
+
+    def step(self, name, ms):
+        """
+        Adds ms to the named step; repeated steps accumulate.
+        """
+        self.steps[name] = self.steps.get(name, 0) + ms
+
+    def hop(self, method, url, ms, is_redirect):
+        """
+        Records one HTTP request/response exchange as a step.
+        """
+        name = '{} {}'.format(method, urlparse(url).path)
+        if self._following_redirect:
+            name += ' (redirect)'
+        self._following_redirect = is_redirect
+        self.step(name, ms)
+
+    def __enter__(self):
+        _active.setdefault(gevent.getcurrent(), []).append(self)
+        return self
+
+    def __exit__(self, exc, value, traceback):
+        self.elapsed = (time.time() - self.start) * 1000
+        greenlet = gevent.getcurrent()
+        stack = _active[greenlet]
+        stack.pop()
+
+        if exc is not None and issubclass(exc, STOPPED):
+            # The user was stopped part way through; don't record a
+            # flow that never got the chance to finish.
+            if not stack:
+                del _active[greenlet]
+            return False
+        if exc is not None:
+            self.failed = True
+
+        if stack:
+            # Nested flows show up as one step of the flow around them.
+            stack[-1].step(self.name, self.elapsed)
+            if self.failed:
+                stack[-1].failed = True
+        else:
+            del _active[greenlet]
+            for listener in finished:
+                listener(self)
+        flow_stats.record(self.name, results.TOTAL, self.elapsed, self.failed)
+        for name, ms in self.steps.items():
+            flow_stats.record(self.name, name, ms, self.failed)
+        return False
+
+
+def current():
+    """
+    The innermost transaction running in this greenlet, if any.
+    """
+    stack = _active.get(gevent.getcurrent())
+    return stack[-1] if stack else None
+
+
+def journey():
+    """
+    The outermost transaction running in this greenlet (the task), if any.
+    """
+    stack = _active.get(gevent.getcurrent())
+    return stack[0] if stack else None
+
+
+def step(name, ms):
+    transaction = current()
+    if transaction is not None:
+        transaction.step(name, ms)
+
+
+def hop(method, url, ms, is_redirect=False):
+    transaction = current()
+    if transaction is not None:
+        transaction.hop(method, url, ms, is_redirect)
+
+
+def flow(name):
+    """
+    Decorator that runs a helper as the named flow transaction.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            with Transaction(name):
+                return fn(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def instrument(session):
+    """
+    Reports every response a requests session gets, redirect hops
+    included, as a step of the transaction it happened in.
+    """
+    def on_response(resp, *args, **kwargs):
+        hop(
+            resp.request.method,
+            resp.request.url,
+            resp.elapsed.total_seconds() * 1000,
+            resp.is_redirect
+        )
+    session.hooks['response'].append(on_response)
+    return session
+
+
+def on_request_failure(request_type, name, response_time, exception):
+    transaction = current()
+    if transaction is not None:
+        transaction.failed = True
+
+
+locust.events.request_failure += on_request_failure
@@ -0,0 +1,273 @@
+"""
+The identity verification (/verify/*) flow, step by step.
+
+Proofing is the most expensive journey per user: the IdP encrypts PII,
+calls the profile and phone vendors (the mock ones, in load testing) and
+activates a profile. verify() takes a signed-in user from /verify
+through each step:
+
+* session: the personal details form, then waiting out the vendor check
+* address: choosing phone over mail
+* phone: the phone on the account, then waiting out the vendor check
+* review: re-entering the password, which encrypts the profile
+* confirmations: past the new personal key
+
+Each step is a flow of its own (see transactions.py) and is also
+recorded in a 'verify' table by outcome: 'passed', or why it stopped,
+such as 'duplicate ssn' or 'vendor timed out'. When the run ends, the
+rate at which each step passed is printed, so the table gives
+throughput as well as latency per step.
+
+Every run submits made-up PII with a fresh SSN (see identities.py), so
+an account can only be verified once; accounts for it must not have
+been seeded with VERIFIED. VERIFY_MAX_WAIT is how many seconds to keep
+refreshing a vendor result page, like async_job_refresh_max_wait_seconds.
+"""
+import os
+import re
+import sys
+import time
+
+import gevent
+import locust
+from locust import runners
+
+from extract import resp_to_page
+import identities
+import results
+import transactions
+
+MAX_WAIT = float(os.getenv('VERIFY_MAX_WAIT', 15))
+
+META_REFRESH = re.compile(
+    br'<meta[^>]+http-equiv=["\']refresh["\'][^>]*content=["\'](\d+)'
+)
+
+verify_stats = results.table(
+    'verify', 'Identity verification steps (ms)', ('Step', 'Outcome'),
+    nested=True
+)
+
+
+class StepFailed(Exception):
+    """
+    A step ended somewhere other than the next step: (outcome, url).
+    """
+
+
+def profile_form(identity):
+    """
+    The personal details form, filled in from an identities.Identity.
+    """
+    return {
+        'profile[first_name]': identity.first_name,
+        'profile[last_name]': identity.last_name,
+        'profile[address1]': identity.address1,
+        'profile[address2]': '',
+        'profile[city]': identity.city,
+        'profile[state]': identity.state,
+        'profile[zipcode]': identity.zipcode,
+        'profile[dob]': identity.dob,
+        'profile[ssn]': identity.ssn,
+        'profile[state_id_type]': 'drivers_license',
+        'profile[state_id_number]': identity.state_id_number,
+    }
+
+
+def expect(resp, paths, reasons=()):
+    """
+    Raises StepFailed unless resp ended up at one of paths. reasons
+    pairs other paths with the outcome they mean.
+    """
+    if isinstance(paths, str):
+        paths = (paths,)
+    if any(path in resp.url for path in paths):
+        return
+    for where, reason in reasons:
+        if where in resp.url:
+            raise StepFailed(reason, resp.url)
+    raise StepFailed('unexpected page', resp.url)
+
+
+def wait_for_vendor(t, resp, name):
+    """
+    Follows the meta refresh on a vendor result page until the result
+    is in, the way a browser would.
+    """
+    deadline = time.time() + MAX_WAIT
+    while True:
+        match = META_REFRESH.search(resp.content or b'')
+        if match is None:
+            return resp
+        if time.time() >= deadline:
+            raise StepFailed('vendor timed out', resp.url)
+        gevent.sleep(int(match.group(1)))
+        resp = t.client.get(resp.url, name=name)
+        resp.raise_for_status()
+
+
+@transactions.flow('verify session')
+def session_step(t, identity):
+    resp = t.client.get('/verify')
+    resp = t.client.get('/verify/session')
+    expect(resp, '/verify/session', (
+        ('/verify/activated', 'already verified'),
+    ))
+    page = resp_to_page(resp)
+    data = profile_form(identity)
+    data.update({
+        '_method': 'put',
+        'authenticity_token': page.authenticity_token(),
+        'commit': 'Continue',
+    })
+    resp = t.client.post('/verify/session', data=data)
+    resp.raise_for_status()
+    resp = wait_for_vendor(t, resp, '/verify/session/result')
+    expect(resp, '/verify/address', (
+        ('/verify/session/dupe', 'duplicate ssn'),
+        ('/verify/session', 'vendor failed'),
+        ('/verify/fail', 'too many attempts'),
+    ))
+    return resp
+
+
+@transactions.flow('verify address')
+def address_step(t, resp):
+    page = resp_to_page(resp)
+    resp = t.client.post(
+        '/verify/address',
+        data={
+            'address_delivery_method': 'phone',
+            'authenticity_token': page.authenticity_token(),
+            'commit': 'Continue',
+        }
+    )
+    expect(resp, '/verify/phone')
+    return resp
+
+
+@transactions.flow('verify phone')
+def phone_step(t, resp):
+    # The form starts out filled in with the phone on the account,
+    # which needs no second confirmation.
+    page = resp_to_page(resp)
+    resp = t.client.post(
+        '/verify/phone',
+        data={
+            '_method': 'put',
+            'idv_phone_form[phone]': page.inputs.get('idv_phone_form[phone]'),
+            'authenticity_token': page.authenticity_token(),
+            'commit': 'Continue',
+        }
+    )
+    resp.raise_for_status()
+    resp = wait_for_vendor(t, resp, '/verify/phone/result')
+    expect(resp, '/verify/review', (
+        ('/verify/otp_delivery_method', 'phone needs confirming'),
+        ('/verify/phone', 'vendor failed'),
+        ('/verify/fail', 'too many attempts'),
+    ))
+    return resp
+
+
+@transactions.flow('verify review')
+def review_step(t, resp, password):
+    page = resp_to_page(resp)
+    resp = t.client.post(
+        '/verify/review',
+        data={
+            '_method': 'put',
+            'user[password]': password,
+            'authenticity_token': page.authenticity_token(),
+            'commit': 'Continue',
+        }
+    )
+    expect(resp, '/verify/confirmations', (
+        ('/verify/review', 'wrong password'),
+    ))
+    return resp
+
+
+@transactions.flow('verify confirmations')
+def confirmations_step(t, resp):
+    page = resp_to_page(resp)
+    resp = t.client.post(
+        '/verify/confirmations',
+        data={
+            'authenticity_token': page.authenticity_token(),
+            'commit': 'Continue',
+        }
+    )
+    resp.raise_for_status()
+    # Back to the account page, or on to the SP if one sent the user.
+    expect(resp, ('/account', '/sign_up/completed'))
+    return resp
+
+
+@transactions.flow('verify')
+def verify(t, credentials):
+    """
+    Takes a signed-in, unverified user through identity verification,
+    as the identity signup() made them with if there is one. Returns the
+    last response, or None if a step failed.
+    """
+    identity = credentials.get('identity') or identities.get()
+    steps = (
+        ('session', lambda resp: session_step(t, identity)),
+        ('address', lambda resp: address_step(t, resp)),
+        ('phone', lambda resp: phone_step(t, resp)),
+        ('review', lambda resp: review_step(t, resp, credentials['password'])),
+        ('confirmations', lambda resp: confirmations_step(t, resp)),
+    )
+    resp = None
+    for step, run in steps:
+        start = time.time()
+        try:
+            resp = run(resp)
+        except StepFailed as e:
+            outcome, url = e.args
+            _record(step, outcome, start)
+            # Shows up with locust's failures, and fails the flow.
+            locust.events.request_failure.fire(
+                request_type='verify',
+                name=step,
+                response_time=int((time.time() - start) * 1000),
+                exception=StepFailed('{} at {}'.format(outcome, url)),
+            )
+            return None
+        except Exception:
+            _record(step, 'error', start)
+            raise
+        _record(step, 'passed', start)
+    return resp
+
+
+def _record(step, outcome, start):
+    ms = (time.time() - start) * 1000
+    failed = outcome != 'passed'
+    verify_stats.record(step, results.TOTAL, ms, failed)
+    verify_stats.record(step, outcome, ms, failed)
+
+
+def print_throughput(out=sys.stdout):
+    elapsed = time.time() - results.started
+    out.write('Identity verification steps passed per second\n')
+    steps = []
+    for step, _ in verify_stats.keys():
+        if step not in steps:
+            steps.append(step)
+    for step in steps:
+        passed = verify_stats.entries.get((step, 'passed'))
+        count = passed.count if passed is not None else 0
+        out.write(' {:<22} {:>8.2f}\n'.format(step, count / elapsed))
+    out.write('\n')
+
+
+def on_quitting():
+    if isinstance(runners.locust_runner, runners.SlaveLocustRunner):
+        return
+    if verify_stats.entries:
+        print_throughput()
+
+
+locust.events.quitting += on_quitting
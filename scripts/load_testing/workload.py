@@ -0,0 +1,470 @@
+"""
+Builds a workload profile for the harness from the IdP's production logs.
+
+The @task weights in locustfile.UserBehavior and its 50-100 ms think
+time are guesses. This reads what production actually did instead:
+lograge's JSON request lines (log/production.log) and ahoy's JSON event
+lines (log/events.log), in any mix, plain or gzipped, and works out
+
+* the journey mix: how often each harness task's journey starts, going
+  by the request that marks it (JOURNEYS), as integer task weights;
+* the time between starts of each journey, and how bursty that is (a
+  coefficient of variation near 1 means Poisson-like arrivals);
+* peak-hour arrival rates: the busiest clock hour's requests and
+  journey starts per second;
+* think time: the gap before each ahoy event within a visit, per event
+  and overall.
+
+Files are read a line at a time and merged by timestamp, and every
+distribution is a fixed-size histogram (hdr.py), so memory stays flat
+however big the logs are. The only state that grows is a counter per
+hour of log and an entry per visit seen within the last VISIT_TIMEOUT
+of log time.
+
+Set WORKLOAD_PROFILE to the profile to have the harness use its weights
+and think time in place of UserBehavior's (see apply()). --rates-out
+writes its peak-hour rates in the format ARRIVAL_RATES_FILE reads, for
+open-loop runs (arrivals.py).
+
+Usage:
+python workload.py production.log.gz events.log.gz -o profile.json \
+    [--rates-out rates.json --rate-scale 0.1]
+WORKLOAD_PROFILE=profile.json make load_test
+"""
+import argparse
+import calendar
+import collections
+import gzip
+import heapq
+import json
+import math
+import random
+import re
+import sys
+import time
+
+import hdr
+
+VERSION = 1
+
+# The request that marks one journey of each harness task, as lograge
+# logs it: (task, method or None for any, controller, action).
+JOURNEYS = (
+    ('idp_login_logout', 'POST', 'Users::SessionsController', 'create'),
+    ('idp_create_account', 'POST', 'SignUp::RegistrationsController',
+     'create'),
+    ('idp_change_pass', 'PATCH', 'Users::PasswordsController', 'update'),
+    ('idp_verify', 'PUT', 'Verify::SessionsController', 'create'),
+    ('idp_signed_in_pages', 'GET', 'AccountsController', 'show'),
+    ('oidc_sign_in', 'GET', 'OpenidConnect::AuthorizationController',
+     'index'),
+    ('saml_sign_in', None, 'SamlIdpController', 'auth'),
+)
+
+# Some journeys pass through another's marker: signing in and signing
+# up both end on /account, and changing a password or signing in for
+# a partner starts with a sign-in. Those are taken off the other's
+# count, so each journey is only counted once.
+OVERLAPS = {
+    'idp_signed_in_pages': ('idp_login_logout', 'idp_create_account'),
+    'idp_login_logout': ('idp_change_pass', 'oidc_sign_in', 'saml_sign_in'),
+}
+
+# Like Ahoy.visit_duration: a visit idle this long has ended.
+VISIT_TIMEOUT = 30 * 60
+MAX_OPEN_VISITS = 200000
+# Distinct event names beyond this are counted together.
+MAX_STEPS = 200
+OTHER_STEP = '(other)'
+
+# Weights are repeated task entries (see arrivals.task_weights), so the
+# mix is rounded to parts in this many.
+WEIGHT_SCALE = 1000
+
+TIMESTAMP = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(\.\d+)?'
+    r'\s*(Z|UTC|[+-]\d\d:?\d\d)?'
+)
+
+
+def parse_time(value):
+    """
+    Seconds since the epoch for an ISO 8601 (or Ruby Time#to_s) string,
+    or None.
+    """
+    match = TIMESTAMP.match(value or '')
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    when = calendar.timegm((
+        int(year), int(month), int(day), int(hour), int(minute), int(second)
+    ))
+    if fraction:
+        when += float(fraction)
+    if zone and zone not in ('Z', 'UTC'):
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        when -= offset if zone[0] == '+' else -offset
+    return when
+
+
+def format_time(when):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(when))
+
+
+def open_log(path):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', errors='replace')
+    return open(path, errors='replace')
+
+
+def read_log(path, skipped):
+    """
+    (time, record) for every JSON line in a log, in file order. Other
+    lines, and a logger's prefix before the JSON, are skipped;
+    skipped[path] counts the lines that were.
+    """
+    with open_log(path) as f:
+        for line in f:
+            start = line.find('{')
+            record = when = None
+            if start >= 0:
+                try:
+                    record = json.loads(line[start:])
+                except ValueError:
+                    pass
+            if isinstance(record, dict):
+                when = parse_time(
+                    record.get('timestamp') or record.get('time')
+                )
+            if when is None:
+                skipped[path] += 1
+                continue
+            yield when, record
+
+
+class Gaps(object):
+    """
+    The distribution of gaps (ms) between successive times.
+    """
+
+    def __init__(self):
+        self.histogram = hdr.Histogram()
+        self.last = None
+        self.sum_of_squares = 0.0
+
+    def add(self, when):
+        if self.last is not None:
+            # Lines from different processes can be a little out of order.
+            self.record(max(when - self.last, 0) * 1000)
+        self.last = when if self.last is None else max(when, self.last)
+
+    def record(self, ms):
+        self.histogram.record(ms)
+        self.sum_of_squares += ms * ms
+
+    def summary(self):
+        summary = summarize(self.histogram)
+        if self.histogram.count > 1:
+            mean = self.histogram.avg
+            variance = self.sum_of_squares / self.histogram.count - mean ** 2
+            summary['cv'] = round(
+                math.sqrt(max(variance, 0)) / mean, 3
+            ) if mean else None
+        return summary
+
+
+def summarize(histogram):
+    return {
+        'count': histogram.count,
+        'mean': round(histogram.avg, 1),
+        'p50': round(histogram.percentile(0.5), 1),
+        'p90': round(histogram.percentile(0.9), 1),
+        'p99': round(histogram.percentile(0.99), 1),
+        'max': round(histogram.max, 1),
+    }
+
+
+class WorkloadModel(object):
+    """
+    Everything a profile needs, built up one log record at a time.
+    """
+
+    def __init__(self, max_think=300, visit_timeout=VISIT_TIMEOUT):
+        self.max_think = max_think
+        self.visit_timeout = visit_timeout
+        self.markers = dict(
+            ((method, controller, action), task)
+            for task, method, controller, action in JOURNEYS
+        )
+        self.requests = 0
+        self.events = 0
+        self.first = self.last = None
+        self.journeys = collections.Counter()
+        self.interarrivals = collections.defaultdict(Gaps)
+        self.requests_by_hour = collections.Counter()
+        self.journeys_by_hour = collections.defaultdict(collections.Counter)
+        # visit -> time of its last event, least recently active first.
+        self.visits = collections.OrderedDict()
+        self.think = Gaps()
+        self.steps = {}
+
+    def add(self, when, record):
+        if 'controller' in record and 'action' in record:
+            self._request(when, record)
+        elif 'name' in record and ('visit_id' in record
+                                   or 'visitor_id' in record):
+            self._event(when, record)
+        else:
+            return
+        self.first = when if self.first is None else min(self.first, when)
+        self.last = when if self.last is None else max(self.last, when)
+
+    def _request(self, when, record):
+        self.requests += 1
+        hour = int(when // 3600)
+        self.requests_by_hour[hour] += 1
+        controller, action = record['controller'], record['action']
+        task = self.markers.get((record.get('method'), controller, action))
+        if task is None:
+            task = self.markers.get((None, controller, action))
+        if task is None or int(record.get('status') or 0) >= 400:
+            return
+        self.journeys[task] += 1
+        self.journeys_by_hour[hour][task] += 1
+        self.interarrivals[task].add(when)
+
+    def _event(self, when, record):
+        self.events += 1
+        visit = record.get('visit_id') or record.get('visitor_id')
+        self._end_visits(when)
+        last = self.visits.pop(visit, None)
+        if last is not None:
+            gap = when - last
+            if 0 <= gap <= self.max_think:
+                self.think.record(gap * 1000)
+                self._step(record['name']).record(gap * 1000)
+        self.visits[visit] = when if last is None else max(when, last)
+
+    def _end_visits(self, now):
+        visits = self.visits
+        while visits:
+            visit, last = next(iter(visits.items()))
+            if (last > now - self.visit_timeout
+                    and len(visits) < MAX_OPEN_VISITS):
+                return
+            del visits[visit]
+
+    def _step(self, name):
+        if name not in self.steps and len(self.steps) >= MAX_STEPS:
+            name = OTHER_STEP
+        if name not in self.steps:
+            self.steps[name] = Gaps()
+        return self.steps[name]
+
+    def counts(self):
+        """
+        Journeys per task, net of OVERLAPS.
+        """
+        counts = {}
+        for task, count in self.journeys.items():
+            overlap = sum(
+                self.journeys[other] for other in OVERLAPS.get(task, ())
+            )
+            counts[task] = max(count - overlap, 0)
+        return counts
+
+    def weights(self):
+        counts = self.counts()
+        total = float(sum(counts.values()))
+        weights = {}
+        for task, count in counts.items():
+            if count:
+                weights[task] = max(
+                    int(round(WEIGHT_SCALE * count / total)), 1
+                )
+        return weights
+
+    def peak_hour(self):
+        """
+        The busiest hour by journey starts (or requests, without any),
+        and its rates per second.
+        """
+        if self.journeys_by_hour:
+            hour = max(
+                self.journeys_by_hour,
+                key=lambda h: sum(self.journeys_by_hour[h].values())
+            )
+        elif self.requests_by_hour:
+            hour = max(self.requests_by_hour, key=self.requests_by_hour.get)
+        else:
+            return None
+        journeys = self.journeys_by_hour.get(hour, collections.Counter())
+        return {
+            'start': format_time(hour * 3600),
+            'requests_per_second': round(
+                self.requests_by_hour[hour] / 3600.0, 4
+            ),
+            'journeys_per_second': round(sum(journeys.values()) / 3600.0, 4),
+            'rates': dict(
+                (task, round(count / 3600.0, 4))
+                for task, count in journeys.items()
+            ),
+        }
+
+    def profile(self):
+        counts = self.counts()
+        total = float(sum(counts.values())) or 1
+        return {
+            'version': VERSION,
+            'source': {
+                'requests': self.requests,
+                'events': self.events,
+                'from': format_time(self.first) if self.first else None,
+                'to': format_time(self.last) if self.last else None,
+            },
+            'weights': self.weights(),
+            'journeys': dict(
+                (task, {
+                    'count': count,
+                    'share': round(count / total, 4),
+                    'interarrival_ms': self.interarrivals[task].summary(),
+                })
+                for task, count in counts.items()
+            ),
+            'peak_hour': self.peak_hour(),
+            'think_time_ms': dict(
+                self.think.summary(),
+                quantiles=[
+                    round(self.think.histogram.percentile(p / 100.0), 1)
+                    for p in range(101)
+                ] if self.think.histogram.count else []
+            ),
+            'steps': dict(
+                (name, gaps.summary()) for name, gaps in self.steps.items()
+            ),
+        }
+
+
+def build(paths, max_think=300, visit_timeout=VISIT_TIMEOUT):
+    """
+    The WorkloadModel for a set of logs, and {path: lines skipped}.
+    """
+    model = WorkloadModel(max_think, visit_timeout)
+    skipped = collections.Counter()
+    streams = [read_log(path, skipped) for path in paths]
+    for when, record in heapq.merge(*streams, key=lambda item: item[0]):
+        model.add(when, record)
+    return model, skipped
+
+
+class ThinkTime(object):
+    """
+    Draws think times (ms) from a profile's think time quantiles.
+    """
+
+    def __init__(self, quantiles, rng=random):
+        self.quantiles = quantiles
+        self._rng = rng
+
+    def __call__(self):
+        position = self._rng.random() * (len(self.quantiles) - 1)
+        index = int(position)
+        low = self.quantiles[index]
+        high = self.quantiles[min(index + 1, len(self.quantiles) - 1)]
+        return low + (high - low) * (position - index)
+
+
+def load(path):
+    with open(path) as f:
+        profile = json.load(f)
+    if profile.get('version') != VERSION:
+        raise ValueError('{} is not a version {} workload profile'.format(
+            path, VERSION
+        ))
+    return profile
+
+
+def apply(taskset, profile, out=sys.stderr):
+    """
+    Replaces taskset's @task weights with the profile's, and its think
+    time with draws from the profile's. Tasks the profile has no weight
+    for don't run.
+    """
+    tasks = []
+    for name, weight in sorted(profile['weights'].items()):
+        task = getattr(taskset, name, None)
+        if not hasattr(task, 'locust_task_weight'):
+            out.write('Workload profile: {} has no task {}; skipped.\n'.format(
+                taskset.__name__, name
+            ))
+            continue
+        tasks.extend([task] * weight)
+    if not tasks:
+        raise ValueError('The workload profile weights none of {}'.format(
+            taskset.__name__
+        ))
+    taskset.tasks = tasks
+    quantiles = profile['think_time_ms'].get('quantiles')
+    if quantiles:
+        taskset.think_time = ThinkTime(quantiles)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('logs', nargs='+',
+                        help='lograge and/or ahoy JSON logs (.gz is fine, '
+                             '- for stdin)')
+    parser.add_argument('-o', '--out',
+                        help='where to write the profile (default stdout)')
+    parser.add_argument('--rates-out', metavar='PATH',
+                        help='also write peak-hour rates for '
+                             'ARRIVAL_RATES_FILE')
+    parser.add_argument('--rate-scale', type=float, default=1.0,
+                        help='multiply --rates-out rates by this')
+    parser.add_argument('--max-think', type=float, default=300,
+                        help='seconds; longer gaps in a visit count as the '
+                             'user stepping away, not think time')
+    parser.add_argument('--visit-timeout', type=float, default=VISIT_TIMEOUT,
+                        help='seconds of quiet that end a visit')
+    args = parser.parse_args()
+
+    model, skipped = build(args.logs, args.max_think, args.visit_timeout)
+    profile = model.profile()
+    profile['source']['files'] = args.logs
+    profile['source']['skipped_lines'] = sum(skipped.values())
+
+    text = json.dumps(profile, indent=2, sort_keys=True) + '\n'
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+    if args.rates_out:
+        peak = profile['peak_hour'] or {'rates': {}}
+        with open(args.rates_out, 'w') as f:
+            json.dump(dict(
+                (task, round(rate * args.rate_scale, 6))
+                for task, rate in peak['rates'].items()
+            ), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    sys.stderr.write(
+        '{} requests and {} events from {} to {} ({} lines skipped).\n'.format(
+            model.requests, model.events, profile['source']['from'],
+            profile['source']['to'], profile['source']['skipped_lines']
+        )
+    )
+    if not profile['weights']:
+        sys.stderr.write('No journeys found; is that a lograge log?\n')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())